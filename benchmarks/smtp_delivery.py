@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+# Compares one SMTP connection per email with the pooled delivery used by the notifier, against a local aiosmtpd
+# sink (pip3 install aiosmtpd). Run from the repository root: python3 benchmarks/smtp_delivery.py [emails]
+
+import os
+import smtplib
+import sys
+import time
+from email.message import EmailMessage
+
+from aiosmtpd.controller import Controller
+from aiosmtpd.handlers import Sink
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.smtp_pool import SMTPPool  # noqa: E402
+
+
+def create_message(number: int) -> EmailMessage:
+    msg = EmailMessage()
+    msg['From'] = 'Sender Name <noreply@domain.tld>'
+    msg['To'] = f'user{number}@domain.tld'
+    msg['Subject'] = f'Benchmark email {number}'
+    msg.set_content('x' * 4096)
+
+    return msg
+
+
+def send_single(smtp_relay_server: str, emails: int) -> None:
+    for number in range(emails):
+        with smtplib.SMTP(smtp_relay_server) as s:
+            s.send_message(create_message(number))
+            s.quit()
+
+
+def send_pooled(smtp_relay_server: str, emails: int) -> None:
+    smtp_pool = SMTPPool(smtp_relay_server)
+
+    for number in range(emails):
+        smtp_pool.send_message(create_message(number))
+
+    smtp_pool.close()
+
+
+def main() -> None:
+    emails = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    controller = Controller(Sink(), hostname='127.0.0.1', port=8025)
+    controller.start()
+
+    try:
+        for name, function in (('one connection per email', send_single), ('pooled connections', send_pooled)):
+            start = time.perf_counter()
+            function('127.0.0.1:8025', emails)
+            elapsed = time.perf_counter() - start
+
+            print(f'{name:<26} {emails} emails in {elapsed:.2f}s, {emails / elapsed:.0f} emails/s')
+
+    finally:
+        controller.stop()
+
+
+if __name__ == '__main__':
+    main()
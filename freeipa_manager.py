@@ -15,283 +15,322 @@
 # Copyright (C) 2021  Unai Goikoetxeta
 
 import os
+import sys
+from argparse import ArgumentParser
 from argparse import Namespace
+from typing import TextIO
 
+from utils.daemon import Daemon
 from utils.utils import Utils
 
 
-def app_option_check_cache(app_utils: Utils, quiet: bool) -> None:
+def app_option_check_cache(app_utils: Utils, quiet: bool, output: TextIO) -> None:
     status = app_utils.get_cache_handler().is_cache_outdated()
 
     if status and not quiet:
-        print('Cache is outdated')
+        print('Cache is outdated', file=output)
     elif not status and not quiet:
-        print('Cache is up-to-date')
+        print('Cache is up-to-date', file=output)
 
 
-def app_option_check_servers(app_utils: Utils, quiet: bool) -> None:
-    ad_reachable, freeipa_reachable, smtp_reachable = app_utils.check_server_connectivity()
+def app_option_check_servers(app_utils: Utils, quiet: bool, output: TextIO) -> None:
+    ad_reachable, freeipa_reachable, smtp_reachable = app_utils.check_server_connectivity(use_health_state=False)
 
     if ad_reachable == freeipa_reachable == smtp_reachable is True and not quiet:
-        print('FreeIPA, AD and SMTP servers are reachable')
+        print('FreeIPA, AD and SMTP servers are reachable', file=output)
     elif not quiet:
         if not ad_reachable:
-            print('AD server is not reachable')
+            print('AD server is not reachable', file=output)
         if not freeipa_reachable:
-            print('FreeIPA server is not reachable')
+            print('FreeIPA server is not reachable', file=output)
         if not smtp_reachable:
-            print('SMTP server is not reachable')
+            print('SMTP server is not reachable', file=output)
 
 
-def app_option_delete_cache(app_utils: Utils, quiet: bool) -> None:
+def app_option_daemon(socket_file: str, app_utils: Utils) -> None:
+    daemon_settings = app_utils.get_daemon_settings()
+
+    daemon = Daemon(app_utils=app_utils,
+                    socket_file=socket_file,
+                    command_runner=run_command,
+                    job_intervals=daemon_settings['jobs'],
+                    connection_lifetime=daemon_settings['connection_lifetime'])
+    daemon.run()
+
+
+def app_option_delete_cache(app_utils: Utils, quiet: bool, output: TextIO) -> None:
     status = app_utils.get_cache_handler().delete_cache()
 
     if status and not quiet:
-        print('Cache files have been deleted')
+        print('Cache files have been deleted', file=output)
     elif not quiet:
-        print('Cache files were not deleted because they do not exist')
+        print('Cache files were not deleted because they do not exist', file=output)
 
 
-def app_option_delete_user(user_id: str, app_utils: Utils, quiet: bool) -> None:
+def app_option_delete_user(user_id: str, app_utils: Utils, quiet: bool, output: TextIO) -> None:
     status = app_utils.get_freeipa_handler().delete_freeipa_user(user_id)
 
     if status and not quiet:
-        print(f'User {user_id} deleted successfully')
+        print(f'User {user_id} deleted successfully', file=output)
     elif not quiet:
-        print(f'User {user_id} could not be deleted')
+        print(f'User {user_id} could not be deleted', file=output)
 
 
-def app_option_delete_user_otp_tokens(user_id: str, app_utils: Utils, quiet: bool) -> None:
+def app_option_delete_user_otp_tokens(user_id: str, app_utils: Utils, quiet: bool, output: TextIO) -> None:
     status = app_utils.get_freeipa_handler().delete_freeipa_user_otp_tokens(user_id)
 
     if status and not quiet:
-        print(f'OTP token(s) removed for user {user_id}')
+        print(f'OTP token(s) removed for user {user_id}', file=output)
     elif not quiet:
-        print(f'OTP token(s) could not be removed for user {user_id}')
+        print(f'OTP token(s) could not be removed for user {user_id}', file=output)
 
 
-def app_option_disable_user(user_id: str, app_utils: Utils, quiet: bool) -> None:
+def app_option_disable_user(user_id: str, app_utils: Utils, quiet: bool, output: TextIO) -> None:
     status = app_utils.get_freeipa_handler().disable_freeipa_user(user_id)
 
     if status and not quiet:
-        print(f'User {user_id} disabled successfully')
+        print(f'User {user_id} disabled successfully', file=output)
     elif not quiet:
-        print(f'User {user_id} could not be disabled')
+        print(f'User {user_id} could not be disabled', file=output)
 
 
-def app_option_enable_user(user_id: str, app_utils: Utils, quiet: bool) -> None:
+def app_option_dispatch_mail(app_utils: Utils, quiet: bool, output: TextIO) -> None:
+    dispatched_emails = app_utils.get_notifier().dispatch_mail()
+
+    if dispatched_emails and not quiet:
+        print(f'{dispatched_emails} spooled email(s) sent for delivery, failed emails will be retried later',
+              file=output)
+    elif not quiet:
+        print('No spooled emails pending delivery at this time', file=output)
+
+
+def app_option_enable_user(user_id: str, app_utils: Utils, quiet: bool, output: TextIO) -> None:
     status = app_utils.get_freeipa_handler().enable_freeipa_user(user_id)
 
     if status and not quiet:
-        print(f'User {user_id} enabled successfully')
+        print(f'User {user_id} enabled successfully', file=output)
     elif not quiet:
-        print(f'User {user_id} could not be enabled')
+        print(f'User {user_id} could not be enabled', file=output)
 
 
-def app_option_export_file(export_file: str, app_utils: Utils, quiet: bool) -> None:
-    if export_file and export_file[:1] not in ['.', '/']:
-        export_file = os.getcwd() + '/' + export_file
-    elif not export_file:
-        export_file = os.getcwd() + '/' + app_utils.get_csv_files()['export_file']
+def app_option_export_file(export_file: str, app_utils: Utils, quiet: bool, output: TextIO, cwd: str) -> None:
+    export_file = os.path.join(cwd, export_file or app_utils.get_csv_files()['export_file'])
 
     status = app_utils.get_freeipa_handler().export_to_csv(export_file)
 
     if status and not quiet:
-        print(f'FreeIPA users exported successfully to {export_file}')
+        print(f'FreeIPA users exported successfully to {export_file}', file=output)
     elif not quiet:
-        print(f'FreeIPA users could not be exported to {export_file}')
+        print(f'FreeIPA users could not be exported to {export_file}', file=output)
 
 
-def app_option_import_file(import_file: str, app_utils: Utils, quiet: bool) -> None:
-    if import_file and import_file[:1] not in ['.', '/']:
-        import_file = os.getcwd() + '/' + import_file
-    elif not import_file:
-        import_file = os.getcwd() + '/' + app_utils.get_csv_files()['import_file']
+def app_option_import_file(import_file: str, app_utils: Utils, quiet: bool, output: TextIO, cwd: str) -> None:
+    import_file = os.path.join(cwd, import_file or app_utils.get_csv_files()['import_file'])
 
     imported_users, updated_users, skipped_users, not_imported_users = app_utils.import_csv(import_file)
 
     if imported_users and not quiet:
-        print('The following users were imported to FreeIPA:')
+        print('The following users were imported to FreeIPA:', file=output)
         for user in imported_users:
-            print(f"   - {user} with temporary password '{imported_users[user]}'")
+            print(f"   - {user} with temporary password '{imported_users[user]}'", file=output)
 
     if updated_users and not quiet:
-        print('The following users were updated in FreeIPA:')
+        print('The following users were updated in FreeIPA:', file=output)
         for user in updated_users:
-            print(f'   - {user}')
+            print(f'   - {user}', file=output)
 
     if skipped_users and not quiet:
-        print('The following users required no update and were skipped:')
+        print('The following users required no update and were skipped:', file=output)
         for user in skipped_users:
-            print(f'   - {user}')
+            print(f'   - {user}', file=output)
 
     if not_imported_users and not quiet:
-        print('The following users were not imported to FreeIPA due to errors:')
+        print('The following users were not imported to FreeIPA due to errors:', file=output)
         for user in not_imported_users:
-            print(f'   - {user}')
+            print(f'   - {user}', file=output)
 
     if (imported_users or updated_users or skipped_users or not_imported_users) and not quiet:
-        print('FreeIPA user import completed.')
+        print('FreeIPA user import completed.', file=output)
     elif not quiet:
-        print('No users to import at this time.')
+        print('No users to import at this time.', file=output)
 
 
-def app_option_list_expired_users(app_utils: Utils, quiet: bool) -> None:
+def app_option_list_expired_users(app_utils: Utils, quiet: bool, output: TextIO) -> None:
     expired_users, expired_users_disabled = app_utils.get_freeipa_handler().get_expired_users()
 
     if expired_users and not quiet:
         print('The passwords of the following users have expired within the last '
-              f'{app_utils.get_password_gracious_period()} days:')
+              f'{app_utils.get_password_gracious_period()} days:', file=output)
         for user_id in expired_users:
-            print(f'  - {user_id}')
+            print(f'  - {user_id}', file=output)
 
     if expired_users_disabled and not quiet:
         print('The following user accounts have been disabled for not changing their password within '
-              f'{app_utils.get_password_gracious_period()} days after expiration:')
+              f'{app_utils.get_password_gracious_period()} days after expiration:', file=output)
         for user_id in expired_users_disabled:
-            print(f'  - {user_id}')
+            print(f'  - {user_id}', file=output)
 
     if not expired_users and not expired_users_disabled and not quiet:
-        print('There are no expired users at this time')
+        print('There are no expired users at this time', file=output)
 
 
-def app_option_list_users_no_password(app_utils: Utils, quiet: bool) -> None:
+def app_option_list_users_no_password(app_utils: Utils, quiet: bool, output: TextIO) -> None:
 
     users_no_password = app_utils.get_freeipa_handler().get_users_no_password()
 
     if users_no_password and not quiet:
-        print('The following users must change their password: ')
+        print('The following users must change their password: ', file=output)
         for user_id in users_no_password:
-            print(f'  - {user_id}')
+            print(f'  - {user_id}', file=output)
     elif not quiet:
-        print('There are no users pending password change at this time')
+        print('There are no users pending password change at this time', file=output)
+
+
+def app_option_migrate_cache(cache_backend: str, app_utils: Utils, quiet: bool, output: TextIO) -> None:
+    status = app_utils.get_cache_handler().migrate_cache(cache_backend)
 
+    if status and not quiet:
+        print(f'Cache migrated to the {cache_backend} backend, update cache_settings.backend to start using it',
+              file=output)
+    elif not quiet:
+        print(f'Cache could not be migrated to the {cache_backend} backend', file=output)
 
-def app_option_process_password_expirations(app_utils: Utils, quiet: bool) -> None:
+
+def app_option_plan_from_ad(app_utils: Utils, quiet: bool, output: TextIO) -> None:
+    update_plan, terminated_plan = app_utils.plan_user_changes()
+
+    for action, plan in (('update_from_ad', update_plan), ('terminated_users', terminated_plan)):
+        if plan is None and not quiet:
+            print(f'The {action} plan could not be calculated', file=output)
+        elif not plan['operations'] and not quiet:
+            print(f'The {action} plan is empty, no changes to apply at this time', file=output)
+        elif not quiet:
+            print(f"The {action} plan with {len(plan['operations'])} user(s) was saved to "
+                  f'{app_utils.get_plan_file(action)}', file=output)
+
+
+def app_option_process_password_expirations(app_utils: Utils, quiet: bool, output: TextIO) -> None:
     notified, expired, disabled = app_utils.process_password_expirations()
 
     if notified and not quiet:
-        print('The following users were notified for upcoming password expiration:')
+        print('The following users were notified for upcoming password expiration:', file=output)
         for user in notified:
-            print(f'   - {user}')
+            print(f'   - {user}', file=output)
     elif not quiet:
-        print('No user password expiration reminders to send at this time')
+        print('No user password expiration reminders to send at this time', file=output)
 
     if expired and not quiet:
-        print('Passwords for the following users have expired:')
+        print('Passwords for the following users have expired:', file=output)
         for user in expired:
-            print(f'   - {user}')
+            print(f'   - {user}', file=output)
 
     if disabled and not quiet:
         print('The following users were disabled for not changing their passwords within '
-              f'the gracious period of {app_utils.get_password_gracious_period()} days:')
+              f'the gracious period of {app_utils.get_password_gracious_period()} days:', file=output)
         for user in disabled:
-            print(f'   - {user}')
+            print(f'   - {user}', file=output)
 
     if not notified and not expired and not disabled and not quiet:
-        print('No upcoming password expirations or expired users found.')
+        print('No upcoming password expirations or expired users found.', file=output)
 
 
-def app_option_process_terminated_users(app_utils: Utils, quiet: bool) -> None:
+def app_option_process_terminated_users(app_utils: Utils, quiet: bool, output: TextIO) -> None:
     deleted_users, not_deleted_users = app_utils.delete_terminated_users()
 
     if deleted_users and not quiet:
-        print(f'The following terminated users were deleted from FreeIPA:')
+        print(f'The following terminated users were deleted from FreeIPA:', file=output)
         for user in deleted_users:
-            print(f'   - {user}')
+            print(f'   - {user}', file=output)
 
     if not_deleted_users and not quiet:
-        print('The following terminated users could not be deleted from FreeIPA:')
+        print('The following terminated users could not be deleted from FreeIPA:', file=output)
         for user in not_deleted_users:
-            print(f'   - {user}')
+            print(f'   - {user}', file=output)
 
     if not deleted_users and not not_deleted_users and not quiet:
-        print('No terminated users identified at this time')
+        print('No terminated users identified at this time', file=output)
 
 
-def add_option_remind_password_change(app_utils: Utils, quiet: bool) -> None:
+def add_option_remind_password_change(app_utils: Utils, quiet: bool, output: TextIO) -> None:
     status, users_no_password = app_utils.remind_password_change()
 
     if status and not quiet:
-        print('The following users have been notified to change their passwords: ')
+        print('The following users have been notified to change their passwords: ', file=output)
         for user in users_no_password:
-            print(f'   - {user}')
+            print(f'   - {user}', file=output)
 
     elif not quiet:
-        print('No user found to be notified for password change')
+        print('No user found to be notified for password change', file=output)
 
 
-def app_option_reset_user_password(user_id: str, app_utils: Utils, quiet: bool) -> None:
+def app_option_reset_user_password(user_id: str, app_utils: Utils, quiet: bool, output: TextIO) -> None:
     success, password = app_utils.reset_user_password(user_id)
 
     if success and not quiet:
-        print(f"Password for user {user_id} successfully changed to '{password}', user notified")
+        print(f"Password for user {user_id} successfully changed to '{password}', user notified", file=output)
 
     elif not quiet:
-        print(f'Password could not be changed for user {user_id}')
+        print(f'Password could not be changed for user {user_id}', file=output)
 
 
-def app_option_template_file(template_file: str, app_utils: Utils, quiet: bool) -> None:
-    if template_file and template_file[:1] not in ['.', '/']:
-        template_file = os.getcwd() + '/' + template_file
-    elif not template_file:
-        template_file = os.getcwd() + '/' + app_utils.get_csv_files()['import_template']
+def app_option_template_file(template_file: str, app_utils: Utils, quiet: bool, output: TextIO, cwd: str) -> None:
+    template_file = os.path.join(cwd, template_file or app_utils.get_csv_files()['import_template'])
 
     status = app_utils.get_freeipa_handler().create_csv_template(template_file)
 
     if status and not quiet:
-        print(f'Import CSV template successfully created at {template_file}')
+        print(f'Import CSV template successfully created at {template_file}', file=output)
     elif not quiet:
-        print(f'Could not create the CSV template file at {template_file}')
+        print(f'Could not create the CSV template file at {template_file}', file=output)
 
 
-def app_option_update_ad_cache(app_utils: Utils, quiet: bool) -> None:
+def app_option_update_ad_cache(app_utils: Utils, quiet: bool, output: TextIO) -> None:
     ad_users = app_utils.get_ad_handler().get_ad_users(force_update_cache=True)
 
     if ad_users and not quiet:
-        print('AD user cache has been updated')
+        print('AD user cache has been updated', file=output)
     elif not ad_users and not quiet:
-        print('AD user cache could not be updated')
+        print('AD user cache could not be updated', file=output)
 
 
-def app_option_update_cache_files(app_utils: Utils, quiet: bool) -> None:
+def app_option_update_cache_files(app_utils: Utils, quiet: bool, output: TextIO) -> None:
     ad_users = app_utils.get_ad_handler().get_ad_users(force_update_cache=True)
     freeipa_users = app_utils.get_freeipa_handler().get_freeipa_users(force_update_cache=True)
 
     if ad_users and freeipa_users and not quiet:
-        print('FreeIPA and AD user caches have been updated')
+        print('FreeIPA and AD user caches have been updated', file=output)
     elif ad_users and not quiet:
-        print('AD users cache has been updated but could not update the FreeIPA cache')
+        print('AD users cache has been updated but could not update the FreeIPA cache', file=output)
     elif freeipa_users and not quiet:
-        print('FreeIPA users cache has been updated but could not update the AD cache')
+        print('FreeIPA users cache has been updated but could not update the AD cache', file=output)
     elif not quiet:
-        print('FreeIPA and AD user cache files could not be updated')
+        print('FreeIPA and AD user cache files could not be updated', file=output)
 
 
-def app_option_update_freeipa_cache(app_utils: Utils, quiet: bool) -> None:
+def app_option_update_freeipa_cache(app_utils: Utils, quiet: bool, output: TextIO) -> None:
     freeipa_users = app_utils.get_freeipa_handler().get_freeipa_users(force_update_cache=True)
 
     if freeipa_users and not quiet:
-        print('FreeIPA user cache has been updated')
+        print('FreeIPA user cache has been updated', file=output)
     elif not freeipa_users and not quiet:
-        print('FreeIPA user cache could not be updated')
+        print('FreeIPA user cache could not be updated', file=output)
 
 
-def app_option_update_from_ad(app_utils: Utils, quiet: bool) -> None:
+def app_option_update_from_ad(app_utils: Utils, quiet: bool, output: TextIO) -> None:
     updates_success, updates_unsuccessful = app_utils.update_user_data_from_ad()
 
     if updates_success and not quiet:
-        print('The following users were updated:')
+        print('The following users were updated:', file=output)
         for user in updates_success:
-            print(f'   - {user}')
+            print(f'   - {user}', file=output)
 
     if updates_unsuccessful and not quiet:
-        print('The following users could not be updated: ')
+        print('The following users could not be updated: ', file=output)
         for user in updates_unsuccessful:
-            print(f'   - {user}')
+            print(f'   - {user}', file=output)
 
     if not updates_success and not updates_unsuccessful and not quiet:
-        print('No users to update at this time')
+        print('No users to update at this time', file=output)
 
 
 def check_for_logging_args(app_utils: Utils, args: Namespace) -> None:
@@ -306,82 +345,140 @@ def check_for_logging_args(app_utils: Utils, args: Namespace) -> None:
         logger.set_level_debug()
 
 
-if __name__ == "__main__":
-    valid_environment = False
-    config_file = os.path.dirname(os.path.realpath(__file__)) + '/config.yaml'
+def get_required_servers(cli_args: Namespace) -> list:
+    # Servers each option talks to, options not listed here only work with local files
+    required_servers = {'update_ad_cache': ['ad'],
+                        'update_freeipa_cache': ['freeipa'],
+                        'update_cache_files': ['ad', 'freeipa'],
+                        'list_expired_users': ['freeipa'],
+                        'list_users_no_password': ['freeipa'],
+                        'disable_user': ['freeipa'],
+                        'enable_user': ['freeipa'],
+                        'delete_user': ['freeipa'],
+                        'delete_user_otp_tokens': ['freeipa'],
+                        'reset_user_password': ['freeipa', 'smtp'],
+                        'export_file': ['freeipa'],
+                        'import_file': ['freeipa', 'smtp'],
+                        'update_from_ad': ['ad', 'freeipa', 'smtp'],
+                        'plan_from_ad': ['ad', 'freeipa'],
+                        'process_password_expirations': ['freeipa', 'smtp'],
+                        'process_terminated_users': ['ad', 'freeipa', 'smtp'],
+                        'remind_password_change': ['freeipa', 'smtp'],
+                        'dispatch_mail': ['smtp'],
+                        'daemon': ['ad', 'freeipa', 'smtp']}
 
-    if os.path.isfile(config_file):
-        utils = Utils(config_file)
-        parser, cli_args = utils.get_menu().generate_menu()
+    for option in required_servers:
+        if getattr(cli_args, option) not in [None, False]:
+            return required_servers[option]
 
-        if utils.validate_running_environment(cli_args.check_servers):
-            valid_environment = True
+    return []
 
-            check_for_logging_args(utils, cli_args)
 
-            if cli_args.check_servers:
-                app_option_check_servers(utils, cli_args.quiet)
+def run_command(app_utils: Utils, parser: ArgumentParser, cli_args: Namespace, output: TextIO, cwd: str) -> None:
+    if cli_args.check_servers:
+        app_option_check_servers(app_utils, cli_args.quiet, output)
+
+    elif cli_args.check_cache:
+        app_option_check_cache(app_utils, cli_args.quiet, output)
+
+    elif cli_args.update_ad_cache:
+        app_option_update_ad_cache(app_utils, cli_args.quiet, output)
+
+    elif cli_args.update_freeipa_cache:
+        app_option_update_freeipa_cache(app_utils, cli_args.quiet, output)
+
+    elif cli_args.update_cache_files:
+        app_option_update_cache_files(app_utils, cli_args.quiet, output)
+
+    elif cli_args.delete_cache:
+        app_option_delete_cache(app_utils, cli_args.quiet, output)
 
-            elif cli_args.check_cache:
-                app_option_check_cache(utils, cli_args.quiet)
+    elif cli_args.migrate_cache:
+        app_option_migrate_cache(cli_args.migrate_cache, app_utils, cli_args.quiet, output)
 
-            elif cli_args.update_ad_cache:
-                app_option_update_ad_cache(utils, cli_args.quiet)
+    elif cli_args.list_expired_users:
+        app_option_list_expired_users(app_utils, cli_args.quiet, output)
 
-            elif cli_args.update_freeipa_cache:
-                app_option_update_freeipa_cache(utils, cli_args.quiet)
+    elif cli_args.list_users_no_password:
+        app_option_list_users_no_password(app_utils, cli_args.quiet, output)
 
-            elif cli_args.update_cache_files:
-                app_option_update_cache_files(utils, cli_args.quiet)
+    elif cli_args.disable_user:
+        app_option_disable_user(cli_args.disable_user.lower().strip(), app_utils, cli_args.quiet, output)
 
-            elif cli_args.delete_cache:
-                app_option_delete_cache(utils, cli_args.quiet)
+    elif cli_args.enable_user:
+        app_option_enable_user(cli_args.enable_user.lower().strip(), app_utils, cli_args.quiet, output)
 
-            elif cli_args.list_expired_users:
-                app_option_list_expired_users(utils, cli_args.quiet)
+    elif cli_args.delete_user:
+        app_option_delete_user(cli_args.delete_user.lower().strip(), app_utils, cli_args.quiet, output)
 
-            elif cli_args.list_users_no_password:
-                app_option_list_users_no_password(utils, cli_args.quiet)
+    elif cli_args.delete_user_otp_tokens:
+        app_option_delete_user_otp_tokens(cli_args.delete_user_otp_tokens.lower().strip(), app_utils,
+                                          cli_args.quiet, output)
 
-            elif cli_args.disable_user:
-                app_option_disable_user(cli_args.disable_user.lower().strip(), utils, cli_args.quiet)
+    elif cli_args.reset_user_password:
+        app_option_reset_user_password(cli_args.reset_user_password.lower().strip(), app_utils, cli_args.quiet, output)
 
-            elif cli_args.enable_user:
-                app_option_enable_user(cli_args.enable_user.lower().strip(), utils, cli_args.quiet)
+    elif cli_args.export_file is not None:
+        app_option_export_file(cli_args.export_file.lower().strip(), app_utils, cli_args.quiet, output, cwd)
 
-            elif cli_args.delete_user:
-                app_option_delete_user(cli_args.delete_user.lower().strip(), utils, cli_args.quiet)
+    elif cli_args.import_file is not None:
+        app_option_import_file(cli_args.import_file.lower().strip(), app_utils, cli_args.quiet, output, cwd)
 
-            elif cli_args.delete_user_otp_tokens:
-                app_option_delete_user_otp_tokens(cli_args.delete_user_otp_tokens.lower().strip(), utils,
-                                                  cli_args.quiet)
+    elif cli_args.template_file is not None:
+        app_option_template_file(cli_args.template_file.lower().strip(), app_utils, cli_args.quiet, output, cwd)
 
-            elif cli_args.reset_user_password:
-                app_option_reset_user_password(cli_args.reset_user_password.lower().strip(), utils, cli_args.quiet)
+    elif cli_args.update_from_ad:
+        app_option_update_from_ad(app_utils, cli_args.quiet, output)
 
-            elif cli_args.export_file is not None:
-                app_option_export_file(cli_args.export_file.lower().strip(), utils, cli_args.quiet)
+    elif cli_args.plan_from_ad:
+        app_option_plan_from_ad(app_utils, cli_args.quiet, output)
 
-            elif cli_args.import_file is not None:
-                app_option_import_file(cli_args.import_file.lower().strip(), utils, cli_args.quiet)
+    elif cli_args.process_password_expirations:
+        app_option_process_password_expirations(app_utils, cli_args.quiet, output)
 
-            elif cli_args.template_file is not None:
-                app_option_template_file(cli_args.template_file.lower().strip(), utils, cli_args.quiet)
+    elif cli_args.process_terminated_users:
+        app_option_process_terminated_users(app_utils, cli_args.quiet, output)
 
-            elif cli_args.update_from_ad:
-                app_option_update_from_ad(utils, cli_args.quiet)
+    elif cli_args.remind_password_change:
+        add_option_remind_password_change(app_utils, cli_args.quiet, output)
 
-            elif cli_args.process_password_expirations:
-                app_option_process_password_expirations(utils, cli_args.quiet)
+    elif cli_args.dispatch_mail:
+        app_option_dispatch_mail(app_utils, cli_args.quiet, output)
 
-            elif cli_args.process_terminated_users:
-                app_option_process_terminated_users(utils, cli_args.quiet)
+    else:
+        parser.print_help(file=output)
 
-            elif cli_args.remind_password_change:
-                add_option_remind_password_change(utils, cli_args.quiet)
 
+if __name__ == "__main__":
+    valid_environment = False
+    app_path = os.path.dirname(os.path.realpath(__file__))
+    config_file = app_path + '/config.yaml'
+    socket_file = app_path + '/freeipa_manager.sock'
+
+    if os.path.isfile(config_file):
+        # Handlers and server connections are created on first use, parsing the arguments here is cheap
+        utils = Utils(config_file)
+        parser, cli_args = utils.get_menu().generate_menu()
+
+        daemon_output = None
+
+        if not cli_args.daemon:
+            daemon_output = Daemon.send_command(socket_file, sys.argv[1:])
+
+        if daemon_output is not None:
+            valid_environment = True
+            print(daemon_output, end='')
+
+        elif utils.validate_running_environment(get_required_servers(cli_args)):
+            valid_environment = True
+
+            check_for_logging_args(utils, cli_args)
+
+            if cli_args.daemon:
+                app_option_daemon(socket_file, utils)
             else:
-                parser.print_help()
+                run_command(utils, parser, cli_args, sys.stdout, os.getcwd())
+                utils.log_request_metrics()
 
     if not valid_environment:
         print('The program is missing required files or server connectivity to run and cannot be executed')
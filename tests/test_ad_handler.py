@@ -0,0 +1,355 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import datetime
+import os
+import re
+import tempfile
+import unittest
+from unittest import mock
+
+from utils.cache_handler import CacheHandler
+
+try:
+    import ldap
+    from utils.ad_handler import ADHandler
+except ImportError:
+    ldap = ADHandler = None
+
+BASE = 'OU=Domain Users,DC=example,DC=com'
+
+
+class FakeADConnection:
+
+    def __init__(self):
+        self.entries = {}
+        self.usn = 0
+        self.server = 'CN=NTDS Settings,CN=DC1,CN=Servers,DC=example,DC=com'
+        self.searches = []
+        self.attribute_lists = []
+        self.bind_error = None
+        self.searches_before_failure = None
+
+    def add_user(self, user_id: str, cn: str, manager_cn: str = None, email_domain: str = 'example.com') -> str:
+        self.usn += 1
+        dn = f'CN={cn},{BASE}'
+        attributes = {'mail': [f'{user_id}@{email_domain}'.encode()], 'cn': [cn.encode()],
+                      'givenName': [cn.split()[0].encode()], 'title': [b'Engineer'], 'uSNChanged': self.usn}
+
+        if manager_cn:
+            attributes['manager'] = [f'CN={manager_cn},{BASE}'.encode()]
+
+        self.entries[dn] = attributes
+        return dn
+
+    def modify_user(self, dn: str, **attributes) -> None:
+        self.usn += 1
+        self.entries[dn].update({name: [value.encode()] for name, value in attributes.items()})
+        self.entries[dn]['uSNChanged'] = self.usn
+
+    def delete_user(self, dn: str) -> None:
+        self.usn += 1
+        del self.entries[dn]
+
+    def set_option(self, option: int, value) -> None:
+        pass
+
+    def simple_bind_s(self, username: str, password: str) -> None:
+        if self.bind_error:
+            raise self.bind_error
+
+    def unbind_s(self) -> None:
+        pass
+
+    def search_ext(self, base: str, scope: int, filterstr: str, attrlist: list, serverctrls: list = None) -> tuple:
+        if self.searches_before_failure is not None:
+            if self.searches_before_failure == 0:
+                raise ldap.SERVER_DOWN('Can\'t contact LDAP server')
+            self.searches_before_failure -= 1
+
+        self.searches.append(filterstr)
+        self.attribute_lists.append(attrlist)
+
+        if base == '':
+            return [('', {'dsServiceName': [self.server.encode()], 'highestCommittedUSN': [str(self.usn).encode()]})]
+
+        usn = re.search(r'\(uSNChanged>=(\d+)\)', filterstr)
+        min_usn = int(usn.group(1)) if usn else 0
+        mail = re.search(r'\(mail=([^*)]+)\*\)', filterstr)
+        cn_bounds = re.findall(r'(!?)\(cn>=(\w+)\)', filterstr)
+
+        return [(dn, {name: self.entries[dn][name] for name in attrlist if name in self.entries[dn]})
+                for dn in self.entries if self.entries[dn]['uSNChanged'] >= min_usn
+                and (mail is None or self.entries[dn]['mail'][0].decode().startswith(mail.group(1)))
+                and all((self.entries[dn]['cn'][0].decode().lower() >= bound) != bool(negated)
+                        for negated, bound in cn_bounds)]
+
+    @staticmethod
+    def result3(msgid: tuple) -> tuple:
+        return 101, msgid, 1, []
+
+
+@unittest.skipIf(ldap is None, 'python-ldap is not installed')
+class TestIncrementalSync(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+        cache_files = {cache: os.path.join(self.temp_dir.name, f'{cache}.json')
+                       for cache in ['ad_cache', 'freeipa_cache', 'ad_sync_state']}
+        self.cache_handler = CacheHandler(cache_files)
+
+        self.connection = FakeADConnection()
+        self.jane_dn = self.connection.add_user('jane.roe', 'Jane Roe')
+        self.john_dn = self.connection.add_user('john.doe', 'John Doe', manager_cn='Jane Roe')
+
+        patcher = mock.patch('ldap.initialize', return_value=self.connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_ad_handler(self, full_sync_interval: int = 24) -> ADHandler:
+        ad_settings = {'credentials': {'proto': 'ldap://', 'host': 'dc1.example.com', 'port': 389,
+                                       'username': 'ldap_username', 'password': 'ldap_password'},
+                       'base': BASE}
+
+        return ADHandler(ad_settings, self.cache_handler, ['example.com'], ignore_keys_on_sync=['member_of'],
+                         sync_mode='incremental', full_sync_interval=full_sync_interval)
+
+    def sync(self, **ad_handler_args) -> dict:
+        self.connection.searches = []
+        return self.get_ad_handler(**ad_handler_args).get_ad_users(force_update_cache=True)
+
+    def get_user_searches(self) -> list:
+        return [search for search in self.connection.searches if search != '(objectClass=*)']
+
+    def test_first_sync_is_full(self):
+        ad_users = self.sync()
+
+        self.assertEqual(set(ad_users), {'jane.roe', 'john.doe'})
+        self.assertEqual(ad_users['john.doe']['manager'], 'jane.roe')
+        self.assertEqual(self.get_user_searches(), ['(objectClass=person)'])
+
+        sync_state = self.cache_handler.get_ad_sync_state()
+        self.assertEqual(sync_state['usn'], self.connection.usn)
+        self.assertEqual(sync_state['entries'][self.john_dn], ['john.doe', 'John Doe'])
+
+    def test_only_changed_users_downloaded(self):
+        self.sync()
+        self.connection.modify_user(self.john_dn, title='Manager')
+
+        ad_users = self.sync()
+
+        self.assertEqual(self.get_user_searches(), [f'(&(objectClass=person)(uSNChanged>={self.connection.usn}))'])
+        self.assertEqual(ad_users['john.doe']['job_title'], 'Manager')
+        self.assertEqual(ad_users['john.doe']['manager'], 'jane.roe')
+        self.assertEqual(self.cache_handler.get_ad_cache(ignore_validity=True), ad_users)
+
+    def test_renamed_user(self):
+        self.sync()
+        self.connection.modify_user(self.jane_dn, mail='jane.doe@example.com')
+
+        ad_users = self.sync()
+
+        self.assertEqual(set(ad_users), {'jane.doe', 'john.doe'})
+        self.assertEqual(ad_users['john.doe']['manager'], 'jane.doe')
+
+    def test_user_no_longer_valid(self):
+        self.sync()
+        self.connection.modify_user(self.john_dn, mail='john.doe@partner.com')
+
+        self.assertEqual(set(self.sync()), {'jane.roe'})
+
+    def test_deleted_user_removed_on_full_sync(self):
+        self.sync()
+        self.connection.delete_user(self.john_dn)
+
+        # Deletions are not visible to incremental synchronizations, only to the next full one
+        self.assertEqual(set(self.sync()), {'jane.roe', 'john.doe'})
+
+        sync_state = self.cache_handler.get_ad_sync_state()
+        sync_state['last_full_sync'] = (datetime.datetime.now() - datetime.timedelta(hours=25)).isoformat()
+        self.cache_handler.save_ad_sync_state(sync_state)
+
+        self.assertEqual(set(self.sync()), {'jane.roe'})
+        self.assertEqual(self.get_user_searches(), ['(objectClass=person)'])
+
+    def test_full_sync_after_domain_controller_change(self):
+        self.sync()
+        self.connection.server = 'CN=NTDS Settings,CN=DC2,CN=Servers,DC=example,DC=com'
+
+        self.sync()
+
+        self.assertEqual(self.get_user_searches(), ['(objectClass=person)'])
+
+    def test_full_sync_after_usn_rollback(self):
+        self.sync()
+
+        sync_state = self.cache_handler.get_ad_sync_state()
+        sync_state['usn'] = self.connection.usn + 100
+        self.cache_handler.save_ad_sync_state(sync_state)
+
+        self.sync()
+
+        self.assertEqual(self.get_user_searches(), ['(objectClass=person)'])
+
+
+@unittest.skipIf(ldap is None, 'python-ldap is not installed')
+class TestAttributeProjection(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+        cache_files = {cache: os.path.join(self.temp_dir.name, f'{cache}.json')
+                       for cache in ['ad_cache', 'freeipa_cache']}
+        self.cache_handler = CacheHandler(cache_files)
+
+        self.connection = FakeADConnection()
+        self.connection.add_user('jane.roe', 'Jane Roe')
+        self.connection.add_user('john.doe', 'John Doe', manager_cn='Jane Roe')
+
+        patcher = mock.patch('ldap.initialize', return_value=self.connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        ad_settings = {'credentials': {'proto': 'ldap://', 'host': 'dc1.example.com', 'port': 389,
+                                       'username': 'ldap_username', 'password': 'ldap_password'},
+                       'base': BASE}
+        ignore_keys_on_sync = [field for field in ADHandler.attribute_map if field not in ['job_title', 'manager']]
+
+        self.ad_handler = ADHandler(ad_settings, self.cache_handler, ['example.com'],
+                                    ignore_keys_on_sync=ignore_keys_on_sync)
+
+    def test_only_synchronized_attributes_requested(self):
+        ad_users = self.ad_handler.get_ad_users()
+
+        self.assertEqual(self.ad_handler.user_fields, ['email', 'job_title', 'manager'])
+        self.assertEqual(self.connection.attribute_lists, [['mail', 'title', 'manager', 'cn']])
+        self.assertEqual(ad_users['john.doe'], {'email': 'john.doe@example.com', 'job_title': 'Engineer',
+                                                'manager': 'jane.roe'})
+
+    def test_cached_fields_served_from_cache(self):
+        self.ad_handler.get_ad_users()
+
+        self.assertEqual(self.ad_handler.get_ad_users(fields=['email', 'job_title'])['jane.roe']['job_title'],
+                         'Engineer')
+        self.assertEqual(self.ad_handler.get_ad_user('jane.roe', fields=['email'])['email'], 'jane.roe@example.com')
+        self.assertEqual(len(self.connection.searches), 1)
+
+    def test_fields_not_cached_requested_from_ad(self):
+        self.ad_handler.get_ad_users()
+        cached_users = self.cache_handler.get_ad_cache()
+
+        ad_users = self.ad_handler.get_ad_users(fields=['email', 'name'])
+
+        self.assertEqual(ad_users['jane.roe'], {'email': 'jane.roe@example.com', 'name': 'Jane'})
+        self.assertEqual(self.connection.attribute_lists[-1], ['mail', 'givenName'])
+        self.assertEqual(self.cache_handler.get_ad_cache(), cached_users)
+        self.assertEqual(self.ad_handler.get_ad_user('john.doe', fields=['name'])['name'], 'John')
+
+
+@unittest.skipIf(ldap is None, 'python-ldap is not installed')
+class TestDomainControllerFailover(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+        cache_files = {cache: os.path.join(self.temp_dir.name, f'{cache}.json')
+                       for cache in ['ad_cache', 'freeipa_cache']}
+        self.cache_handler = CacheHandler(cache_files)
+
+        self.connections = {}
+        self.latencies = {}
+
+        for ad_server, latency in [('dc1.example.com:389', 0.03), ('dc2.example.com:389', 0.01),
+                                   ('dc3.example.com:389', 0.02)]:
+            self.connections[ad_server] = FakeADConnection()
+            self.connections[ad_server].add_user('adam.smith', 'Adam Smith')
+            self.connections[ad_server].add_user('jane.roe', 'Jane Roe', manager_cn='Adam Smith')
+            self.connections[ad_server].add_user('zoe.young', 'Zoe Young', manager_cn='Jane Roe')
+            self.latencies[ad_server] = latency
+
+        patcher = mock.patch('ldap.initialize', side_effect=lambda uri: self.connections[uri[len('ldap://'):]])
+        self.ldap_initialize = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(ADHandler, '_ADHandler__probe_ad_server',
+                                    side_effect=lambda ad_server: self.latencies[ad_server])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_ad_handler(self) -> ADHandler:
+        ad_settings = {'credentials': {'proto': 'ldap://', 'host': 'dc1.example.com', 'port': 389,
+                                       'domain_controllers': ['dc2.example.com', 'dc3.example.com:389'],
+                                       'username': 'ldap_username', 'password': 'ldap_password'},
+                       'base': BASE}
+
+        return ADHandler(ad_settings, self.cache_handler, ['example.com'], ignore_keys_on_sync=['member_of'])
+
+    def get_bound_servers(self) -> list:
+        return [call.args[0][len('ldap://'):] for call in self.ldap_initialize.call_args_list]
+
+    def test_fastest_domain_controller_used(self):
+        ad_handler = self.get_ad_handler()
+
+        self.assertEqual(set(ad_handler.get_ad_users()), {'adam.smith', 'jane.roe', 'zoe.young'})
+        self.assertEqual(ad_handler.ad_server, 'dc2.example.com:389')
+        self.assertEqual(self.get_bound_servers(), ['dc2.example.com:389'])
+        self.assertEqual(self.connections['dc1.example.com:389'].searches, [])
+
+    def test_unreachable_domain_controller_tried_last(self):
+        self.latencies['dc2.example.com:389'] = None
+        self.connections['dc3.example.com:389'].bind_error = ldap.SERVER_DOWN('Can\'t contact LDAP server')
+        ad_handler = self.get_ad_handler()
+
+        self.assertIsNotNone(ad_handler.ad_connection)
+        self.assertEqual(self.get_bound_servers(), ['dc3.example.com:389', 'dc1.example.com:389'])
+        self.assertEqual(ad_handler.ad_server, 'dc1.example.com:389')
+
+    def test_invalid_credentials_not_retried(self):
+        self.connections['dc2.example.com:389'].bind_error = ldap.INVALID_CREDENTIALS('Invalid credentials')
+
+        self.assertIsNone(self.get_ad_handler().ad_connection)
+        self.assertEqual(self.get_bound_servers(), ['dc2.example.com:389'])
+
+    def test_fail_over_during_partitioned_search(self):
+        # The first partitions are read completely before the domain controller goes down
+        self.connections['dc2.example.com:389'].searches_before_failure = 10
+        ad_handler = self.get_ad_handler()
+
+        ad_users = ad_handler.get_ad_users()
+
+        self.assertEqual(set(ad_users), {'adam.smith', 'jane.roe', 'zoe.young'})
+        self.assertEqual(ad_users['zoe.young']['manager'], 'jane.roe')
+        self.assertEqual(ad_handler.ad_server, 'dc3.example.com:389')
+
+        failed_searches = self.connections['dc2.example.com:389'].searches
+        resumed_searches = self.connections['dc3.example.com:389'].searches
+
+        self.assertEqual(len(failed_searches), 10)
+        self.assertEqual(len(failed_searches) + len(resumed_searches), len(ADHandler.search_partition_bounds) + 1)
+        self.assertFalse(set(failed_searches) & set(resumed_searches))
+
+    def test_fail_over_exhausted(self):
+        for ad_server in self.connections:
+            self.connections[ad_server].searches_before_failure = 2
+
+        with self.assertLogs('freeipa_manager', level='ERROR'):
+            self.assertIsNone(self.get_ad_handler().get_ad_users())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import datetime
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from utils.cache_handler import CacheHandler
+from utils.cache_store import CacheStore
+from utils.cache_store import JSONCacheStore
+from utils.cache_store import SQLiteCacheStore
+from utils.json_file import load_json_file
+
+
+class CacheStoreTests:
+
+    users = {'john.doe': {'email': 'john.doe@example.com', 'manager': 'jane.roe', 'member_of': ['admins', 'users']},
+             'jane.roe': {'email': 'jane.roe@example.com', 'manager': '', 'member_of': ['users']}}
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.store = self.get_store(self.temp_dir.name)
+
+    def get_store(self, path: str) -> CacheStore:
+        raise NotImplementedError
+
+    def test_load_missing_cache(self):
+        self.assertIsNone(self.store.load('ad_cache'))
+        self.assertIsNone(self.store.get_update_time('ad_cache'))
+        self.assertFalse(self.store.exists('ad_cache'))
+
+    def test_save_and_load(self):
+        self.assertTrue(self.store.save('ad_cache', self.users))
+
+        self.assertEqual(self.store.load('ad_cache'), self.users)
+        self.assertEqual(self.store.get_user('ad_cache', 'jane.roe'), self.users['jane.roe'])
+        self.assertIsNone(self.store.get_user('ad_cache', 'missing.user'))
+        self.assertIsNone(self.store.load('freeipa_cache'))
+
+    def test_save_keeps_update_time(self):
+        update_time = datetime.datetime(2021, 5, 1, 10, 30)
+
+        self.store.save('ad_cache', self.users, update_time)
+
+        self.assertEqual(self.store.get_update_time('ad_cache'), update_time)
+
+    def test_find_users(self):
+        self.store.save('freeipa_cache', self.users)
+
+        self.assertEqual(list(self.store.find_users('freeipa_cache', email='jane.roe@example.com')), ['jane.roe'])
+        self.assertEqual(list(self.store.find_users('freeipa_cache', manager='jane.roe')), ['john.doe'])
+        self.assertEqual(list(self.store.find_users('freeipa_cache', group='admins')), ['john.doe'])
+        self.assertEqual(set(self.store.find_users('freeipa_cache', group='users')), {'john.doe', 'jane.roe'})
+        self.assertEqual(self.store.find_users('freeipa_cache', group='users', manager='nobody'), {})
+
+    def test_patch_users_keeps_update_time(self):
+        update_time = datetime.datetime(2021, 5, 1, 10, 30)
+        self.store.save('ad_cache', self.users, update_time)
+
+        self.assertTrue(self.store.upsert_users('ad_cache', {'new.user': {'email': 'new.user@example.com',
+                                                                          'manager': '', 'member_of': []}}))
+        self.assertTrue(self.store.delete_users('ad_cache', ['john.doe']))
+
+        self.assertEqual(set(self.store.load('ad_cache')), {'jane.roe', 'new.user'})
+        self.assertEqual(self.store.get_update_time('ad_cache'), update_time)
+        self.assertEqual(self.store.find_users('ad_cache', group='admins'), {})
+
+    def test_patch_missing_cache(self):
+        self.assertFalse(self.store.upsert_users('ad_cache', self.users))
+        self.assertFalse(self.store.delete_users('ad_cache', ['john.doe']))
+
+        self.assertIsNone(self.store.load('ad_cache'))
+
+    def test_returned_users_are_copies(self):
+        self.store.save('freeipa_cache', self.users)
+
+        self.store.get_user('freeipa_cache', 'john.doe')['member_of'].append('editors')
+        self.store.find_users('freeipa_cache', group='users')['jane.roe']['email'] = 'changed@example.com'
+
+        self.assertEqual(self.store.get_user('freeipa_cache', 'john.doe'), self.users['john.doe'])
+        self.assertEqual(self.store.find_users('freeipa_cache', group='users'), self.users)
+
+    def test_delete(self):
+        self.store.save('ad_cache', self.users)
+
+        self.assertTrue(self.store.delete('ad_cache'))
+        self.assertFalse(self.store.delete('ad_cache'))
+        self.assertIsNone(self.store.load('ad_cache'))
+
+
+class TestJSONCacheStore(CacheStoreTests, unittest.TestCase):
+
+    def get_store(self, path: str) -> CacheStore:
+        return JSONCacheStore({'ad_cache': os.path.join(path, 'ad_users.json'),
+                               'freeipa_cache': os.path.join(path, 'freeipa_users.json')})
+
+    def test_document_loaded_once(self):
+        self.store.save('freeipa_cache', self.users)
+
+        with mock.patch('utils.cache_store.load_json_file', wraps=load_json_file) as load_file:
+            self.store.find_users('freeipa_cache', group='admins')
+            self.store.get_user('freeipa_cache', 'jane.roe')
+            self.store.find_users('freeipa_cache', email='jane.roe@example.com')
+
+        self.assertEqual(load_file.call_count, 1)
+
+    def test_patched_document_not_loaded_again(self):
+        self.store.save('freeipa_cache', self.users)
+        self.store.upsert_users('freeipa_cache', {'new.user': {'email': 'new.user@example.com', 'manager': '',
+                                                               'member_of': ['admins']}})
+
+        with mock.patch('utils.cache_store.load_json_file', wraps=load_json_file) as load_file:
+            self.assertEqual(set(self.store.find_users('freeipa_cache', group='admins')), {'john.doe', 'new.user'})
+
+        self.assertEqual(load_file.call_count, 0)
+
+    def test_document_updated_by_another_process_loaded_again(self):
+        update_time = datetime.datetime(2021, 5, 1, 10, 30)
+        self.store.save('freeipa_cache', self.users, update_time)
+        self.store.get_user('freeipa_cache', 'john.doe')
+
+        # Same size and update time, only the replaced file tells the document apart
+        changed_users = {'john.doe': dict(self.users['john.doe'], email='john.roe@example.com'),
+                         'jane.roe': self.users['jane.roe']}
+        self.get_store(self.temp_dir.name).save('freeipa_cache', changed_users, update_time)
+
+        self.assertEqual(self.store.get_user('freeipa_cache', 'john.doe')['email'], 'john.roe@example.com')
+
+
+class TestCacheHandler(unittest.TestCase):
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.cache_handler = CacheHandler({'ad_cache': os.path.join(temp_dir.name, 'ad_users.json'),
+                                           'freeipa_cache': os.path.join(temp_dir.name, 'freeipa_users.json')})
+        self.cache_handler.save_cache(freeipa_users=dict(CacheStoreTests.users))
+
+    def test_users_found_in_loaded_cache(self):
+        self.cache_handler.get_freeipa_cache()
+
+        with mock.patch.object(self.cache_handler.cache_store, 'find_users') as find_users:
+            self.assertEqual(list(self.cache_handler.get_freeipa_cache_users(group='admins')), ['john.doe'])
+            self.assertEqual(list(self.cache_handler.get_freeipa_cache_users(manager='jane.roe')), ['john.doe'])
+
+        find_users.assert_not_called()
+
+    def test_users_found_in_store(self):
+        self.assertEqual(list(self.cache_handler.get_freeipa_cache_users(group='admins')), ['john.doe'])
+
+
+class TestSQLiteCacheStore(CacheStoreTests, unittest.TestCase):
+
+    def get_store(self, path: str) -> CacheStore:
+        store = SQLiteCacheStore(os.path.join(path, 'users_cache.sqlite'))
+        self.addCleanup(store.connection.close)
+        return store
+
+
+class TestCacheStore(unittest.TestCase):
+
+    def test_cache_store_is_abstract(self):
+        with self.assertRaises(TypeError):
+            CacheStore()
+
+
+if __name__ == '__main__':
+    unittest.main()
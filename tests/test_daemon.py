@@ -0,0 +1,140 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import os
+import signal
+import socket
+import threading
+import time
+import unittest
+
+from freeipa_manager import run_command
+from tests.test_utils import FakeADHandler
+from tests.test_utils import UtilsTestCase
+from utils.daemon import Daemon
+
+
+class TestDaemon(UtilsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.socket_file = os.path.join(self.temp_dir.name, 'freeipa_manager.sock')
+        self.commands = []
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+
+    def record_command(self, app_utils, parser, cli_args, output, cwd) -> None:
+        self.commands.append({'cli_args': cli_args, 'cwd': cwd, 'thread': threading.current_thread(),
+                              'socket_mode': os.stat(self.socket_file).st_mode & 0o777})
+        print(f'Command run from {cwd}', file=output)
+
+    def run_daemon(self, commands: list, command_runner=None, job_intervals: dict = None) -> list:
+        daemon = Daemon(self.utils, self.socket_file, command_runner or self.record_command, job_intervals or {},
+                        connection_lifetime=15)
+        outputs = []
+
+        def send_commands():
+            try:
+                # The socket file exists once bound, connections are only accepted after the server listens
+                for _ in range(500):
+                    try:
+                        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                            s.connect(self.socket_file)
+                        break
+
+                    except OSError:
+                        time.sleep(0.01)
+
+                for args in commands:
+                    outputs.append(Daemon.send_command(self.socket_file, args))
+
+            finally:
+                daemon.stop_event.set()
+
+        client = threading.Thread(target=send_commands)
+        client.start()
+
+        # Signal handlers can only be installed by the main thread, the daemon runs there like in production
+        daemon.run()
+        client.join()
+
+        return outputs
+
+    def test_command_run_by_main_thread(self):
+        outputs = self.run_daemon([['-u', '-q']])
+
+        self.assertEqual(outputs, [f'Command run from {os.getcwd()}\n'])
+        self.assertTrue(self.commands[0]['cli_args'].update_from_ad)
+        self.assertTrue(self.commands[0]['cli_args'].quiet)
+        self.assertIs(self.commands[0]['thread'], threading.main_thread())
+
+    def test_commands_run_in_order(self):
+        self.run_daemon([['-u'], ['-l'], ['-k']])
+
+        self.assertEqual([(command['cli_args'].update_from_ad, command['cli_args'].process_terminated_users,
+                           command['cli_args'].process_password_expirations) for command in self.commands],
+                         [(True, False, False), (False, True, False), (False, False, True)])
+
+    def test_socket_only_accessible_by_owner(self):
+        self.run_daemon([['-b']])
+
+        self.assertEqual(self.commands[0]['socket_mode'], 0o600)
+        self.assertFalse(os.path.exists(self.socket_file))
+
+    def test_command_output_returned(self):
+        outputs = self.run_daemon([['-b']], command_runner=run_command)
+
+        self.assertEqual(outputs, ['Cache is outdated\n'])
+
+    def test_usage_error_returned(self):
+        outputs = self.run_daemon([['-b', '--unknown-option'], ['-b']])
+
+        self.assertIn('unrecognized arguments: --unknown-option', outputs[0])
+        self.assertEqual(len(self.commands), 1)
+
+    def test_help_returned(self):
+        outputs = self.run_daemon([['-h']])
+
+        self.assertIn('--daemon', outputs[0])
+        self.assertEqual(self.commands, [])
+
+    def test_daemon_not_started_twice(self):
+        outputs = self.run_daemon([['-D']])
+
+        self.assertEqual(outputs, ['The daemon is already running\n'])
+
+    def test_failed_command_reported(self):
+        def fail(app_utils, parser, cli_args, output, cwd):
+            raise RuntimeError('connection lost')
+
+        outputs = self.run_daemon([['-u'], ['-b']], command_runner=fail)
+
+        self.assertEqual(outputs, ['The command failed inside the daemon: connection lost\n'] * 2)
+
+    def test_jobs_not_run_on_startup(self):
+        job_runs = []
+        self.utils.update_user_data_from_ad = lambda: job_runs.append('update_from_ad')
+        self.utils.delete_terminated_users = lambda: job_runs.append('process_terminated_users')
+
+        self.run_daemon([['-b']], job_intervals={'update_from_ad': 60, 'process_terminated_users': 60})
+
+        self.assertEqual(job_runs, [])
+
+    def test_no_daemon_running(self):
+        self.assertIsNone(Daemon.send_command(self.socket_file, ['-b']))
+
+
+if __name__ == '__main__':
+    unittest.main()
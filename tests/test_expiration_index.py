@@ -0,0 +1,68 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import datetime
+import unittest
+
+from utils.expiration_index import ExpirationIndex
+
+
+class TestExpirationIndex(unittest.TestCase):
+
+    @staticmethod
+    def get_user(days: int) -> dict:
+        expiration = datetime.datetime.combine(datetime.date.today() + datetime.timedelta(days=days),
+                                               datetime.time(23, 59, 59))
+
+        return {'krbpasswordexpiration': [{'__datetime__': expiration.strftime('%Y%m%d%H%M%SZ')}]}
+
+    def setUp(self):
+        self.freeipa_users = {'expired.user': self.get_user(-3),
+                              'today.user': self.get_user(0),
+                              'soon.user': self.get_user(5),
+                              'same.day.user': self.get_user(5),
+                              'later.user': self.get_user(40),
+                              'no.password.user': {}}
+        self.expiration_index = ExpirationIndex(self.freeipa_users)
+
+    def test_users_without_expiration_skipped(self):
+        self.assertIsNone(self.expiration_index.get_expiration('no.password.user'))
+        self.assertIsNone(self.expiration_index.get_expiration('missing.user'))
+        self.assertEqual(len(self.expiration_index.get_users_expiring()), 5)
+
+    def test_get_expiration(self):
+        self.assertEqual(self.expiration_index.get_expiration('soon.user'),
+                         (5, datetime.date.today() + datetime.timedelta(days=5)))
+        self.assertEqual(self.expiration_index.get_expiration('expired.user')[0], -3)
+
+    def test_get_users_expiring_on_a_day(self):
+        self.assertEqual(self.expiration_index.get_users_expiring(5, 5), {'soon.user': 5, 'same.day.user': 5})
+        self.assertEqual(self.expiration_index.get_users_expiring(6, 6), {})
+
+    def test_get_users_expiring_in_range(self):
+        self.assertEqual(set(self.expiration_index.get_users_expiring(0, 5)), {'today.user', 'soon.user',
+                                                                               'same.day.user'})
+
+    def test_get_expired_users(self):
+        self.assertEqual(self.expiration_index.get_users_expiring(max_days=-1), {'expired.user': -3})
+
+    def test_get_users_expiring_open_range(self):
+        self.assertEqual(set(self.expiration_index.get_users_expiring(min_days=6)), {'later.user'})
+
+    def test_empty_index(self):
+        self.assertEqual(ExpirationIndex({}).get_users_expiring(0, 10), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import python_freeipa
+import requests
+from python_freeipa import exceptions as freeipa_exceptions
+
+from utils.freeipa_client import FreeIPAClient
+
+
+def get_connection_error(abort_after_request: bool) -> requests.exceptions.ConnectionError:
+    with socket.socket() as server:
+        server.bind(('127.0.0.1', 0))
+        port = server.getsockname()[1]
+
+        if abort_after_request:
+            # The server reads the request and closes the connection without answering it
+            server.listen(1)
+
+            def abort():
+                connection, _ = server.accept()
+                connection.recv(65536)
+                connection.close()
+
+            threading.Thread(target=abort, daemon=True).start()
+
+        try:
+            requests.post(f'http://127.0.0.1:{port}/ipa/session/json', data='{}', timeout=5)
+
+        except requests.exceptions.ConnectionError as e:
+            return e
+
+    raise AssertionError('The request did not fail')
+
+
+class TestFreeIPAClientFailover(unittest.TestCase):
+
+    hosts = ['ipa1.example.com', 'ipa2.example.com']
+
+    @classmethod
+    def setUpClass(cls):
+        cls.refused_error = get_connection_error(abort_after_request=False)
+        cls.aborted_error = get_connection_error(abort_after_request=True)
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+        self.client = FreeIPAClient(self.hosts, os.path.join(self.temp_dir.name, 'freeipa_session.json'),
+                                    username='admin', password='password')
+        self.requests = []
+
+        patcher = mock.patch.object(FreeIPAClient, '_FreeIPAClient__login')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send_request(self, method: str, errors: dict) -> dict:
+        def request(client, method, args, params):
+            self.requests.append((client._host, method))
+
+            if client._host in errors:
+                raise errors[client._host]
+
+            return {'result': {'host': client._host}}
+
+        with mock.patch.object(python_freeipa.ClientMeta, '_request', autospec=True, side_effect=request):
+            return self.client._request(method, [], {})
+
+    def test_read_fails_over_after_lost_connection(self):
+        result = self.send_request('user_show', {'ipa1.example.com': self.aborted_error})
+
+        self.assertEqual(result['result']['host'], 'ipa2.example.com')
+
+    def test_write_fails_over_when_connection_refused(self):
+        result = self.send_request('user_add', {'ipa1.example.com': self.refused_error})
+
+        self.assertEqual(result['result']['host'], 'ipa2.example.com')
+        self.assertEqual(self.requests, [('ipa1.example.com', 'user_add'), ('ipa2.example.com', 'user_add')])
+
+    def test_write_not_sent_again_after_lost_connection(self):
+        # The first server may have applied the change before the connection was lost
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.send_request('group_add_member', {'ipa1.example.com': self.aborted_error})
+
+        self.assertEqual(self.requests, [('ipa1.example.com', 'group_add_member')])
+
+    def test_write_batch_not_sent_again_after_lost_connection(self):
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.send_request('batch', {'ipa1.example.com': self.aborted_error})
+
+        self.assertEqual(len(self.requests), 1)
+
+
+class TestFreeIPAClientSession(unittest.TestCase):
+
+    hosts = ['ipa1.example.com']
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+        self.session_file = os.path.join(self.temp_dir.name, 'freeipa_session.json')
+        self.logins = []
+        self.sent_cookies = []
+        self.rejected_cookies = set()
+
+        def login(client, username, password):
+            self.logins.append(username)
+            client._session.cookies.set('ipa_session', f'session-{len(self.logins)}', domain=client._host,
+                                        path='/ipa', secure=True)
+
+        def request(client, method, args, params):
+            cookie = client._session.cookies.get('ipa_session')
+            self.sent_cookies.append(cookie)
+
+            if cookie in self.rejected_cookies:
+                raise freeipa_exceptions.Unauthorized(message='Session expired', code=401)
+
+            return {'result': {}}
+
+        for method, side_effect in [('login', login), ('_request', request)]:
+            patcher = mock.patch.object(python_freeipa.ClientMeta, method, autospec=True, side_effect=side_effect)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def send_request(self, username: str = 'admin') -> None:
+        client = FreeIPAClient(self.hosts, self.session_file, username=username, password='password')
+        client.open_session()
+        client._request('user_show', [], {})
+
+    def test_session_stored_privately(self):
+        self.send_request()
+
+        self.assertEqual(self.logins, ['admin'])
+        self.assertEqual(os.stat(self.session_file).st_mode & 0o777, 0o600)
+
+        with open(self.session_file) as fp:
+            self.assertEqual(json.load(fp)['password:admin@ipa1.example.com']['cookie'], 'session-1')
+
+    def test_stored_session_reused(self):
+        self.send_request()
+        self.send_request()
+
+        self.assertEqual(self.logins, ['admin'])
+        self.assertEqual(self.sent_cookies, ['session-1', 'session-1'])
+
+    def test_expired_session_not_reused(self):
+        self.send_request()
+
+        with open(self.session_file) as fp:
+            sessions = json.load(fp)
+
+        sessions['password:admin@ipa1.example.com']['expires'] = time.time() - 1
+
+        with open(self.session_file, 'w') as fp:
+            json.dump(sessions, fp)
+
+        self.send_request()
+
+        self.assertEqual(self.logins, ['admin', 'admin'])
+        self.assertEqual(self.sent_cookies, ['session-1', 'session-2'])
+
+    def test_rejected_session_replaced(self):
+        self.send_request()
+        self.rejected_cookies.add('session-1')
+
+        self.send_request()
+        self.send_request()
+
+        # The new session replaces the rejected one in the session file
+        self.assertEqual(self.sent_cookies, ['session-1', 'session-1', 'session-2', 'session-2'])
+        self.assertEqual(self.logins, ['admin', 'admin'])
+
+    def test_sessions_kept_per_user(self):
+        self.send_request('admin')
+        self.send_request('operator')
+        self.send_request('admin')
+
+        self.assertEqual(self.logins, ['admin', 'operator'])
+        self.assertEqual(self.sent_cookies, ['session-1', 'session-2', 'session-1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
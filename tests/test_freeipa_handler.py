@@ -0,0 +1,530 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import csv
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from requests.exceptions import ConnectionError
+
+from utils.cache_handler import CacheHandler
+
+try:
+    import ldap
+    from utils.freeipa_handler import FreeIPAHandler
+except ImportError:
+    ldap = FreeIPAHandler = None
+
+BASE = 'dc=example,dc=com'
+
+
+class FakeFreeIPAConnection:
+
+    def __init__(self):
+        self.users = {}
+        self.failing_users = set()
+        self.requests = []
+        self.threads = set()
+        self.lock = threading.Lock()
+
+    def add_user(self, user_id: str, groups: list, **attributes) -> None:
+        name, lastname = user_id.split('.')
+        self.users[user_id] = {'uid': [user_id], 'mail': [f'{user_id}@example.com'], 'givenname': [name.title()],
+                               'sn': [lastname.title()], 'cn': [f'{name.title()} {lastname.title()}'],
+                               'title': ['Engineer'], 'krbprincipalname': [f'{user_id}@EXAMPLE.COM'],
+                               'memberof_group': list(groups), 'preserved': False}
+        self.users[user_id].update({key: [value] for key, value in attributes.items()})
+
+    def get_requests(self, method: str) -> list:
+        return [request[1] for request in self.requests if request[0] == method]
+
+    def get_batch_threads(self, command: str) -> set:
+        return {request[2] for request in self.requests if request[0] == 'batch' and command in request[1]}
+
+    def __record(self, method: str, data) -> None:
+        with self.lock:
+            self.requests.append((method, data, threading.current_thread()))
+            self.threads.add(threading.current_thread())
+
+    def __find_users(self, uid: str = None, in_group: str = None, preserved: bool = False,
+                     krbprincipalname: str = None) -> list:
+        return [self.users[user_id] for user_id in self.users
+                if (uid is None or user_id == uid)
+                and (in_group is None or in_group in self.users[user_id]['memberof_group'])
+                and self.users[user_id]['preserved'] == preserved
+                and (krbprincipalname is None or any(principal.split('@')[0] == krbprincipalname
+                                                     for principal in self.users[user_id]['krbprincipalname']))]
+
+    def __run_command(self, method: str, args: list, options: dict) -> dict:
+        if args and args[-1] in self.failing_users:
+            return {'error': 'Insufficient access', 'error_name': 'ACIError'}
+
+        if method == 'user_find':
+            users = self.__find_users(krbprincipalname=options.get('krbprincipalname'))
+            return {'result': users, 'count': len(users)}
+
+        if method == 'user_add':
+            self.add_user(args[0], [], mail=options['mail'], title=options['title'])
+            return {'result': self.users[args[0]]}
+
+        if method in ['group_add_member', 'group_remove_member']:
+            failed = []
+
+            for user_id in options['user']:
+                if user_id not in self.users or user_id in self.failing_users:
+                    failed.append((user_id, 'no such entry'))
+                elif method == 'group_add_member':
+                    self.users[user_id]['memberof_group'].append(args[0])
+                else:
+                    self.users[user_id]['memberof_group'].remove(args[0])
+
+            return {'result': {'cn': [args[0]]}, 'failed': {'member': {'user': failed}}}
+
+        if args[0] not in self.users:
+            return {'error': f'{args[0]}: user not found', 'error_name': 'NotFound'}
+
+        if method == 'user_show':
+            return {'result': dict(self.users[args[0]])}
+
+        if method == 'user_del':
+            self.users.pop(args[0])
+            return {'result': {'failed': []}}
+
+        if method == 'user_mod':
+            self.users[args[0]].update({key: [value] for key, value in options.items()})
+            return {'result': self.users[args[0]]}
+
+        if method == 'user_add_principal':
+            self.users[args[0]]['krbprincipalname'].append(f'{args[1]}@EXAMPLE.COM')
+            return {'result': self.users[args[0]]}
+
+        raise NotImplementedError(method)
+
+    def batch(self, a_methods: list) -> dict:
+        self.__record('batch', [command['method'] for command in a_methods])
+
+        with self.lock:
+            return {'results': [self.__run_command(command['method'], *command['params']) for command in a_methods]}
+
+    def user_find(self, o_uid: str = None, o_in_group: str = None, o_preserved: bool = False,
+                  o_pkey_only: bool = False, o_sizelimit: int = None) -> dict:
+        self.__record('user_find', o_in_group)
+
+        with self.lock:
+            users = self.__find_users(uid=o_uid, in_group=o_in_group, preserved=o_preserved)
+
+        if o_pkey_only:
+            users = [{'uid': user['uid']} for user in users]
+
+        return {'result': users, 'count': len(users), 'truncated': False}
+
+    def user_del(self, user_id: str, o_preserve: bool = True) -> dict:
+        self.__record('user_del', user_id)
+
+        with self.lock:
+            return self.__run_command('user_del', [user_id], {})
+
+
+class FakeFreeIPALDAPConnection:
+
+    def __init__(self, connection: FakeFreeIPAConnection):
+        self.connection = connection
+        self.modified_users = set()
+        self.searches = []
+
+    @staticmethod
+    def get_user_dn(user_id: str) -> str:
+        return f'uid={user_id},cn=users,cn=accounts,{BASE}'
+
+    def __get_user_entry(self, user_id: str) -> tuple:
+        user = self.connection.users[user_id]
+        entry = {'uid': user['uid'], 'mail': user['mail'], 'givenName': user['givenname'], 'sn': user['sn'],
+                 'cn': user['cn'], 'title': user['title'], 'krbPrincipalName': user['krbprincipalname'],
+                 'krbCanonicalName': user['krbprincipalname'][:1]}
+
+        if 'manager' in user:
+            entry['manager'] = [self.get_user_dn(manager) for manager in user['manager']]
+        if 'krbpasswordexpiration' in user:
+            entry['krbPasswordExpiration'] = [value['__datetime__'] for value in user['krbpasswordexpiration']]
+
+        return self.get_user_dn(user_id), {name: [value.encode() for value in entry[name]] for name in entry}
+
+    def set_option(self, option: int, value) -> None:
+        pass
+
+    def simple_bind_s(self, username: str, password: str) -> None:
+        pass
+
+    def search_ext(self, base: str, scope: int, filterstr: str, attrlist: list, serverctrls: list = None) -> list:
+        self.searches.append(filterstr)
+        user_ids = [user_id for user_id in self.connection.users if not self.connection.users[user_id]['preserved']]
+
+        if 'modifyTimestamp' in filterstr:
+            return [(self.get_user_dn(user_id), {'uid': [user_id.encode()]}) for user_id in user_ids
+                    if user_id in self.modified_users]
+
+        if filterstr == '(objectClass=groupOfNames)':
+            groups = {}
+
+            for user_id in user_ids:
+                for group in self.connection.users[user_id]['memberof_group']:
+                    groups.setdefault(group, []).append(self.get_user_dn(user_id).upper().encode())
+
+            return [(f'cn={group},cn=groups,cn=accounts,{BASE}', {'cn': [group.encode()], 'member': groups[group]})
+                    for group in groups]
+
+        return [self.__get_user_entry(user_id) for user_id in user_ids]
+
+    @staticmethod
+    def result3(msgid: list) -> tuple:
+        return 101, msgid, 1, []
+
+
+@unittest.skipIf(ldap is None, 'python-ldap is not installed')
+class FreeIPAHandlerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+        cache_files = {cache: os.path.join(self.temp_dir.name, f'{cache}.json')
+                       for cache in ['ad_cache', 'freeipa_cache']}
+        self.cache_handler = CacheHandler(cache_files)
+
+        self.connection = FakeFreeIPAConnection()
+        self.connection.add_user('jane.roe', ['managers'])
+        self.connection.add_user('john.doe', ['engineers'], manager='jane.roe')
+        self.connection.add_user('max.mustermann', ['engineers', 'managers'])
+        self.connection.add_user('external.user', ['contractors'])
+
+        # Every FreeIPA session, including the ones opened by worker threads, goes to the fake server
+        patcher = mock.patch.object(FreeIPAHandler, '_FreeIPAHandler__connect_to_freeipa',
+                                    return_value=self.connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.ldap_connection = FakeFreeIPALDAPConnection(self.connection)
+        self.ldap_settings = {'proto': 'ldap://', 'port': 389, 'base': BASE, 'bind': 'simple', 'page_size': 1000}
+
+        patcher = mock.patch('ldap.initialize', return_value=self.ldap_connection)
+        self.ldap_initialize = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_freeipa_handler(self, **freeipa_handler_args) -> FreeIPAHandler:
+        freeipa_credentials = {'host': 'ipa1.example.com', 'username': 'admin', 'password': 'password'}
+        freeipa_gids = {'engineers': 1000, 'managers': 1001}
+        csv_files = {'import_template': 'import_template.csv', 'import_file': 'import_data.csv'}
+
+        return FreeIPAHandler(freeipa_credentials, freeipa_gids, self.cache_handler, csv_files,
+                              password_gracious_period=7, **freeipa_handler_args)
+
+
+class TestCachePatching(FreeIPAHandlerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.freeipa_handler = self.get_freeipa_handler()
+        self.freeipa_handler.get_freeipa_users()
+        self.update_time = self.cache_handler.get_cache_update_time('freeipa_cache')
+        self.connection.requests = []
+
+    def test_updated_user_patched(self):
+        self.assertTrue(self.freeipa_handler.update_freeipa_user('john.doe', job_title='Manager'))
+
+        self.assertEqual(self.cache_handler.get_freeipa_cache_user('john.doe')['job_title'], 'Manager')
+        self.assertEqual(self.connection.get_requests('batch'), [['user_mod'], ['user_show']])
+        self.assertEqual(self.connection.get_requests('user_find'), [])
+
+    def test_patch_keeps_cache_update_time(self):
+        self.freeipa_handler.update_freeipa_users({'john.doe': {'job_title': 'Manager'}})
+
+        self.assertEqual(self.cache_handler.get_cache_update_time('freeipa_cache'), self.update_time)
+
+    def test_deleted_user_removed(self):
+        self.assertTrue(self.freeipa_handler.delete_freeipa_user('john.doe'))
+
+        self.assertIsNone(self.cache_handler.get_freeipa_cache_user('john.doe'))
+        self.assertIn('jane.roe', self.cache_handler.get_freeipa_cache())
+        self.assertEqual(self.connection.get_requests('batch'), [])
+
+    def test_user_leaving_managed_groups_removed(self):
+        self.connection.users['john.doe']['memberof_group'] = ['contractors']
+
+        self.freeipa_handler.update_freeipa_user('john.doe', job_title='Contractor')
+
+        self.assertIsNone(self.cache_handler.get_freeipa_cache_user('john.doe'))
+
+    def test_cache_not_patched_when_not_requested(self):
+        self.freeipa_handler.update_freeipa_users({'john.doe': {'job_title': 'Manager'}}, update_cache=False)
+
+        self.assertEqual(self.connection.get_requests('batch'), [['user_mod']])
+        self.assertEqual(self.cache_handler.get_freeipa_cache_user('john.doe')['job_title'], 'Engineer')
+
+
+class TestBatchDeletion(FreeIPAHandlerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.freeipa_handler = self.get_freeipa_handler(batch_size=2)
+        self.freeipa_handler.get_freeipa_users()
+        self.connection.requests = []
+
+    def test_users_deleted_in_batches(self):
+        user_ids = ['jane.roe', 'john.doe', 'max.mustermann']
+
+        self.assertEqual(self.freeipa_handler.delete_freeipa_users(user_ids), (user_ids, []))
+
+        self.assertEqual(self.connection.get_requests('batch'), [['user_del', 'user_del'], ['user_del']])
+        self.assertEqual(self.cache_handler.get_freeipa_cache(), {})
+
+    def test_failed_deletions_reported(self):
+        self.connection.failing_users.add('john.doe')
+
+        self.assertEqual(self.freeipa_handler.delete_freeipa_users(['jane.roe', 'john.doe', 'missing.user']),
+                         (['jane.roe'], ['john.doe', 'missing.user']))
+
+        self.assertEqual(set(self.cache_handler.get_freeipa_cache()), {'john.doe', 'max.mustermann'})
+
+    def test_failed_batch_reported(self):
+        with mock.patch.object(self.connection, 'batch', side_effect=ConnectionError('connection lost')):
+            self.assertEqual(self.freeipa_handler.delete_freeipa_users(['jane.roe', 'john.doe']),
+                             ([], ['jane.roe', 'john.doe']))
+
+        self.assertEqual(len(self.cache_handler.get_freeipa_cache()), 3)
+
+
+class TestBatchImport(FreeIPAHandlerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.freeipa_handler = self.get_freeipa_handler()
+        self.import_file = os.path.join(self.temp_dir.name, 'import_data.csv')
+        self.freeipa_handler.create_csv_template(self.import_file)
+
+    def write_import_file(self, rows: list) -> None:
+        with open(self.import_file, newline='') as fp:
+            header = next(csv.reader(fp))
+
+        with open(self.import_file, 'a', newline='') as fp:
+            csv.DictWriter(fp, header, restval='').writerows(rows)
+
+    @staticmethod
+    def get_row(user_id: str, **fields) -> dict:
+        name, _, lastname = user_id.partition('.')
+        row = {'user_id': user_id, 'email': f'{user_id}@example.com', 'user_group': 'engineers', 'name': name.title(),
+               'lastname': lastname.title(), 'job_title': 'Engineer'}
+        row.update(fields)
+        return row
+
+    def test_users_imported_in_batches(self):
+        self.write_import_file([self.get_row('alice.smith'), self.get_row('bob.jones'),
+                                self.get_row('john.doe', job_title='Manager')])
+
+        imported_users, updated_users, skipped_users, not_imported_users = self.freeipa_handler.import_from_csv(
+            self.import_file)
+
+        self.assertEqual(set(imported_users), {'alice.smith', 'bob.jones'})
+        self.assertEqual((updated_users, skipped_users, not_imported_users), (['john.doe'], [], []))
+
+        # Alias probes, first commands, follow-up commands and the cache patch, whatever the number of users
+        self.assertEqual(self.connection.get_requests('batch'),
+                         [['user_find'] * 2,
+                          ['user_add', 'user_add', 'user_mod'],
+                          ['user_add_principal', 'group_add_member'] * 2,
+                          ['user_show'] * 3])
+
+        self.assertEqual(self.cache_handler.get_freeipa_cache_user('alice.smith')['alias'], ['asmith'])
+        self.assertEqual(self.cache_handler.get_freeipa_cache_user('alice.smith')['member_of'], ['engineers'])
+        self.assertEqual(self.cache_handler.get_freeipa_cache_user('john.doe')['job_title'], 'Manager')
+
+    def test_unique_aliases_generated(self):
+        self.connection.users['jane.roe']['krbprincipalname'].append('asmith@EXAMPLE.COM')
+        self.write_import_file([self.get_row('alice.smith'), self.get_row('adam.smith')])
+
+        self.freeipa_handler.import_from_csv(self.import_file)
+
+        self.assertEqual(self.connection.users['alice.smith']['krbprincipalname'][1], 'asmith1@EXAMPLE.COM')
+        # As in the baseline, the counter is appended to the previous candidate
+        self.assertEqual(self.connection.users['adam.smith']['krbprincipalname'][1], 'asmith12@EXAMPLE.COM')
+
+    def test_failed_user_creation_not_followed_up(self):
+        self.connection.failing_users.add('bob.jones')
+        self.write_import_file([self.get_row('alice.smith'), self.get_row('bob.jones'),
+                                self.get_row('invalid', user_group='contractors')])
+
+        imported_users, _, _, not_imported_users = self.freeipa_handler.import_from_csv(self.import_file)
+
+        self.assertEqual(list(imported_users), ['alice.smith'])
+        self.assertEqual(set(not_imported_users), {'bob.jones', 'invalid'})
+        self.assertEqual(self.connection.get_requests('batch')[2], ['user_add_principal', 'group_add_member'])
+
+
+class TestFullRefresh(FreeIPAHandlerTestCase):
+
+    def test_groups_fetched_in_parallel(self):
+        freeipa_users = self.get_freeipa_handler(fetch_workers=2).get_freeipa_users()
+
+        self.assertEqual(set(freeipa_users), {'jane.roe', 'john.doe', 'max.mustermann'})
+        self.assertEqual(sorted(self.connection.get_requests('user_find')), ['engineers', 'managers'])
+        self.assertNotIn(threading.main_thread(), self.connection.threads)
+
+    def test_users_of_several_groups_deduplicated(self):
+        freeipa_users = self.get_freeipa_handler().get_freeipa_users()
+
+        self.assertEqual(sorted(freeipa_users['max.mustermann']['member_of']), ['engineers', 'managers'])
+        self.assertEqual(freeipa_users['john.doe']['manager'], 'jane.roe')
+
+    def test_combined_fetch(self):
+        freeipa_users = self.get_freeipa_handler(fetch_mode='combined').get_freeipa_users()
+
+        self.assertEqual(set(freeipa_users), {'jane.roe', 'john.doe', 'max.mustermann'})
+        self.assertEqual(self.connection.get_requests('user_find'), [None])
+
+
+class TestDeltaRefresh(FreeIPAHandlerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.get_freeipa_handler().get_freeipa_users()
+        self.connection.requests = []
+
+    def refresh(self) -> dict:
+        freeipa_handler = self.get_freeipa_handler(refresh_mode='delta', ldap_settings=self.ldap_settings)
+        return freeipa_handler.get_freeipa_users(force_update_cache=True)
+
+    def test_only_changed_users_downloaded(self):
+        self.connection.users['john.doe']['title'] = ['Manager']
+        self.ldap_connection.modified_users.add('john.doe')
+        self.connection.add_user('alice.smith', ['engineers'])
+
+        freeipa_users = self.refresh()
+
+        self.assertEqual(self.connection.get_requests('batch'), [['user_show', 'user_show']])
+        self.assertEqual(set(freeipa_users), {'jane.roe', 'john.doe', 'max.mustermann', 'alice.smith'})
+        self.assertEqual(freeipa_users['john.doe']['job_title'], 'Manager')
+        self.assertEqual(self.cache_handler.get_freeipa_cache(), freeipa_users)
+        self.assertIn('(modifyTimestamp>=', self.ldap_connection.searches[0])
+
+    def test_removed_users_dropped(self):
+        del self.connection.users['jane.roe']
+        self.connection.users['max.mustermann']['memberof_group'] = ['contractors']
+
+        self.assertEqual(set(self.refresh()), {'john.doe'})
+        self.assertEqual(self.connection.get_requests('batch'), [])
+
+    def test_full_refresh_without_ldap(self):
+        self.ldap_initialize.side_effect = ldap.SERVER_DOWN('ldap://ipa1.example.com:389')
+        self.connection.users['john.doe']['title'] = ['Manager']
+
+        freeipa_users = self.refresh()
+
+        self.assertEqual(freeipa_users['john.doe']['job_title'], 'Manager')
+        self.assertEqual(self.connection.get_requests('batch'), [])
+
+
+class TestLDAPReadEngine(FreeIPAHandlerTestCase):
+
+    def get_ldap_freeipa_handler(self) -> FreeIPAHandler:
+        return self.get_freeipa_handler(read_engine='ldap', ldap_settings=self.ldap_settings)
+
+    @staticmethod
+    def sort_groups(freeipa_users: dict) -> dict:
+        return {user_id: dict(freeipa_users[user_id], member_of=sorted(freeipa_users[user_id]['member_of']))
+                for user_id in freeipa_users}
+
+    def test_same_users_as_jsonrpc(self):
+        self.connection.users['john.doe']['krbpasswordexpiration'] = [{'__datetime__': '20300101000000Z'}]
+        self.connection.users['john.doe']['krbprincipalname'].append('jdoe@EXAMPLE.COM')
+
+        jsonrpc_users = self.get_freeipa_handler().get_freeipa_users(force_update_cache=True)
+        ldap_users = self.get_ldap_freeipa_handler().get_freeipa_users(force_update_cache=True)
+
+        self.assertEqual(set(ldap_users), {'jane.roe', 'john.doe', 'max.mustermann'})
+        self.assertEqual(self.sort_groups(ldap_users), self.sort_groups(jsonrpc_users))
+        self.assertEqual(ldap_users['john.doe']['alias'], ['jdoe'])
+
+    def test_users_read_without_jsonrpc_searches(self):
+        self.get_ldap_freeipa_handler().get_freeipa_users()
+
+        self.assertEqual(self.connection.get_requests('user_find'), [])
+        self.assertEqual(self.ldap_connection.searches, ['(objectClass=groupOfNames)', '(objectClass=posixAccount)'])
+
+    def test_jsonrpc_used_without_ldap(self):
+        self.ldap_initialize.side_effect = ldap.SERVER_DOWN('ldap://ipa1.example.com:389')
+
+        freeipa_users = self.get_ldap_freeipa_handler().get_freeipa_users()
+
+        self.assertEqual(set(freeipa_users), {'jane.roe', 'john.doe', 'max.mustermann'})
+        self.assertEqual(sorted(self.connection.get_requests('user_find')), ['engineers', 'managers'])
+
+
+class TestParallelUpdate(FreeIPAHandlerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.connection.add_user('erika.musterfrau', ['engineers'])
+        self.freeipa_handler = self.get_freeipa_handler(update_workers=2)
+        self.freeipa_handler.get_freeipa_users()
+        self.connection.requests = []
+
+    def get_group_requests(self) -> list:
+        return [methods for methods in self.connection.get_requests('batch') if 'user_mod' not in methods
+                and 'user_show' not in methods]
+
+    def test_users_updated_by_worker_threads(self):
+        user_updates = {user_id: {'job_title': 'Manager'} for user_id in ['jane.roe', 'john.doe', 'max.mustermann']}
+
+        self.assertEqual(self.freeipa_handler.update_freeipa_users(user_updates), (list(user_updates), []))
+
+        self.assertEqual(sorted(methods for methods in self.connection.get_requests('batch') if 'user_mod' in methods),
+                         [['user_mod'], ['user_mod', 'user_mod']])
+        self.assertNotIn(threading.main_thread(), self.connection.get_batch_threads('user_mod'))
+        self.assertEqual({self.connection.users[user_id]['title'][0] for user_id in user_updates}, {'Manager'})
+        self.assertEqual(self.cache_handler.get_freeipa_cache_user('max.mustermann')['job_title'], 'Manager')
+
+    def test_group_changes_sent_once_per_group(self):
+        user_updates = {'john.doe': {'user_group': 'managers'}, 'erika.musterfrau': {'user_group': 'managers'}}
+
+        self.assertEqual(self.freeipa_handler.update_freeipa_users(user_updates), (list(user_updates), []))
+
+        # Users leave their previous groups before joining the new ones
+        self.assertEqual(self.get_group_requests(), [['group_remove_member', 'group_add_member']])
+        self.assertEqual(self.connection.users['john.doe']['memberof_group'], ['managers'])
+        self.assertEqual(self.connection.users['erika.musterfrau']['memberof_group'], ['managers'])
+
+    def test_rejected_member_reported(self):
+        self.connection.failing_users.add('john.doe')
+        user_updates = {'john.doe': {'user_group': 'managers'}, 'erika.musterfrau': {'user_group': 'managers'},
+                        'jane.roe': {'job_title': 'Director'}}
+
+        self.assertEqual(self.freeipa_handler.update_freeipa_users(user_updates),
+                         (['erika.musterfrau', 'jane.roe'], ['john.doe']))
+
+        self.assertEqual(self.connection.users['erika.musterfrau']['memberof_group'], ['managers'])
+        self.assertEqual(self.cache_handler.get_freeipa_cache_user('john.doe')['member_of'], ['engineers'])
+
+    def test_invalid_updates_not_sent(self):
+        user_updates = {'john.doe': {'user_group': 'contractors'}, 'jane.roe': {'manager': 'missing.user'},
+                        'missing.user': {'job_title': 'Engineer'}}
+
+        self.assertEqual(self.freeipa_handler.update_freeipa_users(user_updates), ([], list(user_updates)))
+
+        self.assertEqual(self.connection.get_requests('batch'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from utils.health_monitor import HealthMonitor
+
+
+class TestHealthMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.state_file = os.path.join(self.temp_dir.name, 'health_state.json')
+        self.health_monitor = HealthMonitor(self.state_file, validity=60, backoff=30, max_backoff=100)
+
+    def test_unknown_server(self):
+        self.assertIsNone(self.health_monitor.get_status('ad:dc1'))
+
+    def test_reachable_server_reused_within_validity(self):
+        self.health_monitor.record('ad:dc1', True)
+
+        self.assertTrue(self.health_monitor.get_status('ad:dc1'))
+
+        self.health_monitor.state['ad:dc1']['checked_at'] -= 61
+
+        self.assertIsNone(self.health_monitor.get_status('ad:dc1'))
+
+    def test_backoff_doubles_up_to_max_backoff(self):
+        retry_delays = []
+
+        for _ in range(4):
+            self.health_monitor.record('freeipa:ipa1', False)
+            server_state = self.health_monitor.state['freeipa:ipa1']
+            retry_delays.append(round(server_state['retry_after'] - server_state['checked_at']))
+
+        self.assertEqual(retry_delays, [30, 60, 100, 100])
+        self.assertEqual(self.health_monitor.state['freeipa:ipa1']['failures'], 4)
+        self.assertFalse(self.health_monitor.get_status('freeipa:ipa1'))
+
+    def test_failed_server_checked_again_after_backoff(self):
+        self.health_monitor.record('smtp', False)
+        retry_after = self.health_monitor.state['smtp']['retry_after']
+
+        with mock.patch('utils.health_monitor.datetime') as mock_datetime:
+            mock_datetime.datetime.now.return_value.timestamp.return_value = retry_after + 1
+
+            self.assertIsNone(self.health_monitor.get_status('smtp'))
+
+    def test_success_resets_failures(self):
+        self.health_monitor.record('smtp', False)
+        self.health_monitor.record('smtp', False)
+        self.health_monitor.record('smtp', True)
+
+        self.assertEqual(self.health_monitor.state['smtp']['failures'], 0)
+        self.assertTrue(self.health_monitor.get_status('smtp'))
+
+    def test_state_shared_between_executions(self):
+        self.health_monitor.record('ad:dc1', False)
+
+        health_monitor = HealthMonitor(self.state_file, validity=60, backoff=30, max_backoff=100)
+
+        self.assertFalse(health_monitor.get_status('ad:dc1'))
+
+    def test_invalid_state_file(self):
+        with open(self.state_file, 'w') as fp:
+            fp.write('{not json')
+
+        health_monitor = HealthMonitor(self.state_file)
+
+        self.assertEqual(health_monitor.state, {})
+        self.assertIsNone(health_monitor.get_status('ad:dc1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import os
+import smtplib
+import tempfile
+import time
+import unittest
+from email.message import EmailMessage
+from unittest import mock
+
+from utils.mail_spool import MailSpool
+
+
+class FakeSMTPPool:
+
+    def __init__(self, errors: list = None):
+        self.errors = list(errors or [])
+        self.sent_messages = []
+
+    def send_message(self, msg: EmailMessage) -> None:
+        if self.errors:
+            raise self.errors.pop(0)
+
+        self.sent_messages.append(msg)
+
+
+class TestMailSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.spool_path = os.path.join(self.temp_dir.name, 'spool')
+
+    def get_spool(self, smtp_pool: FakeSMTPPool, max_attempts: int = 8) -> MailSpool:
+        # A single worker delivers the emails in order, so waiting for a later task waits for all of them
+        spool = MailSpool(self.spool_path, smtp_pool, workers=1, max_attempts=max_attempts, backoff=60)
+        self.addCleanup(spool.executor.shutdown)
+        return spool
+
+    @staticmethod
+    def get_message(recipient: str = 'john.doe@example.com') -> EmailMessage:
+        msg = EmailMessage()
+        msg['To'] = recipient
+        msg['Subject'] = 'Password expiration'
+        msg.set_content('Your password expires soon')
+        return msg
+
+    @staticmethod
+    def wait_for_delivery(spool: MailSpool) -> None:
+        spool.executor.submit(lambda: None).result()
+
+    def get_files(self, directory: str) -> list:
+        return sorted(os.listdir(os.path.join(self.spool_path, directory)))
+
+    def test_email_delivered(self):
+        smtp_pool = FakeSMTPPool()
+        spool = self.get_spool(smtp_pool)
+
+        self.assertTrue(spool.enqueue(self.get_message()))
+        self.wait_for_delivery(spool)
+
+        self.assertEqual([msg['To'] for msg in smtp_pool.sent_messages], ['john.doe@example.com'])
+        self.assertEqual(self.get_files('outbox'), [])
+
+    def test_email_spooled_privately(self):
+        spool = self.get_spool(FakeSMTPPool([smtplib.SMTPServerDisconnected('connection lost')]))
+
+        spool.enqueue(self.get_message())
+        self.wait_for_delivery(spool)
+
+        self.assertEqual(os.stat(self.spool_path).st_mode & 0o777, 0o700)
+        spool_file = os.path.join(self.spool_path, 'outbox', self.get_files('outbox')[0])
+        self.assertEqual(os.stat(spool_file).st_mode & 0o777, 0o600)
+
+    def test_temporary_failure_deferred(self):
+        smtp_pool = FakeSMTPPool([smtplib.SMTPServerDisconnected('connection lost')])
+        spool = self.get_spool(smtp_pool)
+
+        spool.enqueue(self.get_message())
+        self.wait_for_delivery(spool)
+
+        spool_files = self.get_files('outbox')
+        self.assertEqual(len(spool_files), 1)
+
+        not_before, attempts, _ = spool_files[0][:-len('.eml')].split('-', 2)
+        self.assertEqual(attempts, '1')
+        self.assertGreater(int(not_before), time.time() + 50)
+
+        # Not due yet, the email stays in the spool
+        self.assertEqual(spool.dispatch(), 0)
+        self.assertEqual(smtp_pool.sent_messages, [])
+
+    def test_due_email_sent_by_later_dispatch(self):
+        smtp_pool = FakeSMTPPool([smtplib.SMTPServerDisconnected('connection lost')])
+        spool = self.get_spool(smtp_pool)
+
+        spool.enqueue(self.get_message())
+        self.wait_for_delivery(spool)
+
+        spool_file = self.get_files('outbox')[0]
+        due_file = '0-' + spool_file.split('-', 1)[1]
+        os.replace(os.path.join(self.spool_path, 'outbox', spool_file),
+                   os.path.join(self.spool_path, 'outbox', due_file))
+
+        # A later execution sends the emails deferred by previous ones
+        spool = self.get_spool(smtp_pool)
+
+        self.assertEqual(spool.dispatch(), 1)
+        self.wait_for_delivery(spool)
+
+        self.assertEqual(len(smtp_pool.sent_messages), 1)
+        self.assertEqual(self.get_files('outbox'), [])
+
+    def test_permanent_failure_moved_to_dead_letter(self):
+        smtp_pool = FakeSMTPPool([smtplib.SMTPRecipientsRefused({'john.doe@example.com': (550, b'No such user')})])
+        spool = self.get_spool(smtp_pool)
+
+        spool.enqueue(self.get_message())
+        self.wait_for_delivery(spool)
+
+        dead_letter_files = self.get_files('dead_letter')
+
+        self.assertEqual(self.get_files('outbox'), [])
+        self.assertEqual([os.path.splitext(file)[1] for file in dead_letter_files], ['.eml', '.error'])
+
+        with open(os.path.join(self.spool_path, 'dead_letter', dead_letter_files[1])) as fp:
+            self.assertIn('No such user', fp.read())
+
+    def test_max_attempts_moved_to_dead_letter(self):
+        smtp_pool = FakeSMTPPool([smtplib.SMTPServerDisconnected('connection lost')])
+        spool = self.get_spool(smtp_pool, max_attempts=1)
+
+        spool.enqueue(self.get_message())
+        self.wait_for_delivery(spool)
+
+        self.assertEqual(self.get_files('outbox'), [])
+        self.assertEqual(len(self.get_files('dead_letter')), 2)
+
+    def test_email_renamed_by_another_process_not_sent(self):
+        smtp_pool = FakeSMTPPool()
+        spool = self.get_spool(smtp_pool)
+        os.makedirs(os.path.join(self.spool_path, 'outbox'))
+        spool_file = os.path.join(self.spool_path, 'outbox', '0-0-1234.eml')
+
+        with open(spool_file, 'wb') as fp:
+            fp.write(self.get_message().as_bytes())
+
+        # Another process defers the email between the spool listing and the lock
+        def defer_email(fp, operation):
+            os.replace(spool_file, os.path.join(self.spool_path, 'outbox', '9999999999-1-1234.eml'))
+
+        with mock.patch('utils.mail_spool.fcntl.flock', side_effect=defer_email):
+            self.assertEqual(spool.dispatch(), 1)
+            self.wait_for_delivery(spool)
+
+        self.assertEqual(smtp_pool.sent_messages, [])
+        self.assertEqual(self.get_files('outbox'), ['9999999999-1-1234.eml'])
+
+    def test_email_replaced_by_another_process_not_sent(self):
+        smtp_pool = FakeSMTPPool()
+        spool = self.get_spool(smtp_pool)
+        os.makedirs(os.path.join(self.spool_path, 'outbox'))
+        spool_file = os.path.join(self.spool_path, 'outbox', '0-0-1234.eml')
+
+        with open(spool_file, 'wb') as fp:
+            fp.write(self.get_message().as_bytes())
+
+        # The path now holds a different file than the one opened
+        def replace_email(fp, operation):
+            with open(spool_file + '.new', 'wb') as new_fp:
+                new_fp.write(self.get_message('jane.doe@example.com').as_bytes())
+
+            os.replace(spool_file + '.new', spool_file)
+
+        with mock.patch('utils.mail_spool.fcntl.flock', side_effect=replace_email):
+            spool.dispatch()
+            self.wait_for_delivery(spool)
+
+        self.assertEqual(smtp_pool.sent_messages, [])
+
+    def test_unexpected_files_ignored(self):
+        spool = self.get_spool(FakeSMTPPool())
+        os.makedirs(os.path.join(self.spool_path, 'outbox'))
+
+        with open(os.path.join(self.spool_path, 'outbox', 'unexpected.eml'), 'w') as fp:
+            fp.write('')
+
+        self.assertEqual(spool.dispatch(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
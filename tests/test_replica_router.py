@@ -0,0 +1,112 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import os
+import tempfile
+import unittest
+
+from utils.health_monitor import HealthMonitor
+from utils.replica_router import ReplicaRouter
+
+
+class TestReplicaRouter(unittest.TestCase):
+
+    hosts = ['ipa1.example.com', 'ipa2.example.com', 'ipa3.example.com']
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.health_monitor = HealthMonitor(os.path.join(self.temp_dir.name, 'health_state.json'))
+        self.router = ReplicaRouter(self.hosts, self.health_monitor)
+
+    def send_request(self, read_only: bool, latency: float = 0.1, excluded_hosts: set = None) -> str:
+        host = self.router.select_host(read_only, excluded_hosts or set())
+        self.router.finish_request(host, latency, False)
+        return host
+
+    def test_replicas_without_samples_tried_first(self):
+        hosts = [self.send_request(read_only=True) for _ in self.hosts]
+
+        self.assertEqual(sorted(hosts), self.hosts)
+
+    def test_reads_sent_to_fastest_replica(self):
+        for host, latency in zip(self.hosts, [0.5, 0.1, 0.3]):
+            self.router.latencies[host] = latency
+
+        self.assertEqual(self.send_request(read_only=True), 'ipa2.example.com')
+
+    def test_busy_replica_looks_slower(self):
+        self.router.latencies = {'ipa1.example.com': 0.1, 'ipa2.example.com': 0.15, 'ipa3.example.com': 1.0}
+
+        first_host = self.router.select_host(True, set())
+        second_host = self.router.select_host(True, set())
+
+        self.assertEqual((first_host, second_host), ('ipa1.example.com', 'ipa2.example.com'))
+
+    def test_latency_moving_average(self):
+        self.router.select_host(True, set())
+        self.router.finish_request('ipa1.example.com', 1.0, False)
+        self.router.select_host(True, set())
+        self.router.finish_request('ipa1.example.com', 2.0, False)
+
+        self.assertAlmostEqual(self.router.latencies['ipa1.example.com'], 1.0 + ReplicaRouter.latency_weight)
+
+    def test_failed_request_not_sampled(self):
+        host = self.router.select_host(True, set())
+        self.router.finish_request(host, 5.0, True)
+
+        self.assertIsNone(self.router.latencies[host])
+        self.assertEqual(self.router.requests_in_flight[host], 0)
+
+    def test_writes_stay_on_main_server(self):
+        self.router.latencies = {'ipa1.example.com': 1.0, 'ipa2.example.com': 0.1, 'ipa3.example.com': 0.1}
+
+        self.assertEqual([self.send_request(read_only=False) for _ in range(3)], ['ipa1.example.com'] * 3)
+
+    def test_writes_fail_over_and_stay_on_new_server(self):
+        self.router.mark_host_down('ipa1.example.com')
+
+        self.assertEqual(self.send_request(read_only=False), 'ipa2.example.com')
+
+        # The main server coming back does not split the writes of the run between servers
+        self.health_monitor.record('freeipa:ipa1.example.com', True)
+
+        self.assertEqual(self.send_request(read_only=False), 'ipa2.example.com')
+
+    def test_down_replicas_skipped(self):
+        self.router.mark_host_down('ipa1.example.com')
+        self.router.mark_host_down('ipa2.example.com')
+
+        self.assertEqual({self.send_request(read_only=True) for _ in range(3)}, {'ipa3.example.com'})
+
+    def test_excluded_hosts_skipped(self):
+        self.assertEqual(self.send_request(read_only=False, excluded_hosts={'ipa1.example.com'}), 'ipa2.example.com')
+
+    def test_all_hosts_down(self):
+        for host in self.hosts:
+            self.router.mark_host_down(host)
+
+        # One server is still tried instead of failing without sending any request
+        self.assertEqual(self.send_request(read_only=True), 'ipa1.example.com')
+        self.assertIsNone(self.router.select_host(True, set(self.hosts)))
+
+    def test_without_health_monitor(self):
+        router = ReplicaRouter(self.hosts)
+        router.mark_host_down('ipa1.example.com')
+
+        self.assertEqual(router.select_host(False, set()), 'ipa1.example.com')
+
+
+if __name__ == '__main__':
+    unittest.main()
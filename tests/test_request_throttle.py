@@ -0,0 +1,120 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import threading
+import time
+import unittest
+
+from utils.request_throttle import RequestThrottle
+
+
+class TestRequestThrottle(unittest.TestCase):
+
+    @staticmethod
+    def run_requests(throttle: RequestThrottle, count: int, latency: float = 0.1, failed: bool = False) -> None:
+        for _ in range(count):
+            throttle.acquire()
+            throttle.release('user_show', latency, failed)
+
+    def test_additive_increase(self):
+        throttle = RequestThrottle(min_concurrency=1, max_concurrency=8)
+
+        self.run_requests(throttle, 1)
+        self.assertEqual(throttle.concurrency_limit, 2)
+
+        # Each success adds 1 / limit, about one extra request per round of requests
+        self.run_requests(throttle, 2)
+        self.assertAlmostEqual(throttle.concurrency_limit, 2.9)
+
+    def test_increase_capped_by_max_concurrency(self):
+        throttle = RequestThrottle(min_concurrency=1, max_concurrency=4)
+
+        self.run_requests(throttle, 100)
+
+        self.assertEqual(throttle.concurrency_limit, 4)
+
+    def test_multiplicative_decrease_on_failure(self):
+        throttle = RequestThrottle(min_concurrency=1, max_concurrency=8, decrease_factor=0.5)
+        throttle.concurrency_limit = 8
+
+        self.run_requests(throttle, 1, failed=True)
+
+        self.assertEqual(throttle.concurrency_limit, 4)
+
+    def test_multiplicative_decrease_on_slow_request(self):
+        throttle = RequestThrottle(min_concurrency=1, max_concurrency=8, latency_threshold=2.0)
+        throttle.concurrency_limit = 8
+
+        self.run_requests(throttle, 1, latency=3.0)
+
+        self.assertEqual(throttle.concurrency_limit, 4)
+
+    def test_single_decrease_per_congestion_event(self):
+        throttle = RequestThrottle(min_concurrency=1, max_concurrency=8)
+        throttle.concurrency_limit = 8
+
+        # Requests sent before the first decrease fail too, they must not lower the limit again
+        self.run_requests(throttle, 3, failed=True)
+
+        self.assertEqual(throttle.concurrency_limit, 4)
+
+    def test_decrease_bounded_by_min_concurrency(self):
+        throttle = RequestThrottle(min_concurrency=2, max_concurrency=8)
+
+        self.run_requests(throttle, 1, failed=True)
+
+        self.assertEqual(throttle.concurrency_limit, 2)
+
+    def test_acquire_waits_for_concurrency_limit(self):
+        throttle = RequestThrottle(min_concurrency=1, max_concurrency=1)
+        acquired = threading.Event()
+
+        def acquire():
+            throttle.acquire()
+            acquired.set()
+
+        throttle.acquire()
+        thread = threading.Thread(target=acquire)
+        thread.start()
+
+        self.assertFalse(acquired.wait(0.2))
+
+        throttle.release('user_show', 0.1, False)
+        thread.join(timeout=5)
+
+        self.assertTrue(acquired.is_set())
+
+    def test_rate_limit(self):
+        throttle = RequestThrottle(rate_limit=20, burst=2, min_concurrency=4, max_concurrency=4)
+
+        start = time.monotonic()
+        self.run_requests(throttle, 4)
+
+        # The burst is sent right away, the next two requests wait for a token each
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_metrics(self):
+        throttle = RequestThrottle()
+
+        throttle.acquire()
+        throttle.release('user_mod', 1.0, False)
+        throttle.acquire()
+        throttle.release('user_mod', 3.0, True)
+
+        self.assertEqual(throttle.get_metrics(), {'user_mod': {'requests': 2, 'errors': 1, 'avg_latency': 2.0,
+                                                               'max_latency': 3.0}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import smtplib
+import threading
+import time
+import unittest
+from email.message import EmailMessage
+from unittest import mock
+
+from utils.smtp_pool import SMTPPool
+
+
+class FakeSMTP:
+
+    def __init__(self, smtp_relay_server: str, timeout: int):
+        self.errors = []
+        self.sent_messages = []
+        self.closed = False
+
+    def close(self) -> None:
+        self.closed = True
+
+    def quit(self) -> None:
+        self.closed = True
+
+    def send_message(self, msg: EmailMessage) -> None:
+        if self.errors:
+            raise self.errors.pop(0)
+
+        self.sent_messages.append(msg['To'])
+
+
+class TestSMTPPool(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = []
+
+        def open_connection(smtp_relay_server: str, timeout: int) -> FakeSMTP:
+            self.connections.append(FakeSMTP(smtp_relay_server, timeout))
+            self.connections[-1].errors = list(self.connection_errors.pop(0)) if self.connection_errors else []
+            return self.connections[-1]
+
+        self.connection_errors = []
+
+        patcher = mock.patch('utils.smtp_pool.smtplib.SMTP', side_effect=open_connection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_pool(self, **pool_args) -> SMTPPool:
+        smtp_pool = SMTPPool('smtp.example.com', **pool_args)
+        self.addCleanup(smtp_pool.close)
+        return smtp_pool
+
+    @staticmethod
+    def get_message(recipient: str = 'john.doe@example.com') -> EmailMessage:
+        msg = EmailMessage()
+        msg['To'] = recipient
+        msg.set_content('Your password expires soon')
+        return msg
+
+    def get_sent_messages(self) -> list:
+        return [connection.sent_messages for connection in self.connections]
+
+    def test_connection_reused(self):
+        smtp_pool = self.get_pool()
+
+        for _ in range(3):
+            smtp_pool.send_message(self.get_message())
+
+        self.assertEqual(len(self.connections), 1)
+        self.assertFalse(self.connections[0].closed)
+
+        smtp_pool.close()
+
+        self.assertTrue(self.connections[0].closed)
+
+    def test_connection_closed_after_message_limit(self):
+        smtp_pool = self.get_pool(messages_per_connection=2)
+
+        for _ in range(3):
+            smtp_pool.send_message(self.get_message())
+
+        self.assertEqual([len(messages) for messages in self.get_sent_messages()], [2, 1])
+        self.assertTrue(self.connections[0].closed)
+
+    def test_idle_connection_replaced(self):
+        smtp_pool = self.get_pool(idle_timeout=0)
+
+        smtp_pool.send_message(self.get_message())
+        smtp_pool.send_message(self.get_message())
+
+        self.assertEqual(len(self.connections), 2)
+        self.assertTrue(self.connections[0].closed)
+
+    def test_dropped_connection_sent_again(self):
+        smtp_pool = self.get_pool()
+        smtp_pool.send_message(self.get_message())
+        self.connections[0].errors = [smtplib.SMTPServerDisconnected('connection lost')]
+
+        smtp_pool.send_message(self.get_message('jane.roe@example.com'))
+
+        self.assertEqual(self.get_sent_messages(), [['john.doe@example.com'], ['jane.roe@example.com']])
+        self.assertTrue(self.connections[0].closed)
+
+    def test_refused_recipient_keeps_connection(self):
+        smtp_pool = self.get_pool()
+        self.connection_errors = [[smtplib.SMTPRecipientsRefused({'john.doe@example.com': (550, b'No such user')})]]
+
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            smtp_pool.send_message(self.get_message())
+
+        smtp_pool.send_message(self.get_message('jane.roe@example.com'))
+
+        self.assertEqual(self.get_sent_messages(), [['jane.roe@example.com']])
+
+    def test_failed_connection_not_reused(self):
+        smtp_pool = self.get_pool()
+        self.connection_errors = [[smtplib.SMTPServerDisconnected('connection lost')],
+                                  [smtplib.SMTPServerDisconnected('connection lost')]]
+
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            smtp_pool.send_message(self.get_message())
+
+        smtp_pool.send_message(self.get_message())
+
+        self.assertEqual([connection.closed for connection in self.connections], [True, True, False])
+
+    def test_connections_limited(self):
+        smtp_pool = self.get_pool(max_connections=2)
+        sending = []
+        max_sending = []
+
+        def send_message(msg: EmailMessage) -> None:
+            sending.append(msg)
+            max_sending.append(len(sending))
+            time.sleep(0.01)
+            sending.remove(msg)
+
+        with mock.patch.object(FakeSMTP, 'send_message', side_effect=send_message):
+            threads = [threading.Thread(target=smtp_pool.send_message, args=(self.get_message(),)) for _ in range(8)]
+
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertLessEqual(max(max_sending), 2)
+        self.assertLessEqual(len(self.connections), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import datetime
+import json
+import os
+import tempfile
+import unittest
+
+from utils.sync_plan import SyncPlan
+
+
+class OperationRunner:
+
+    def __init__(self, failing_keys: set = None, crash_after: int = None):
+        self.failing_keys = failing_keys or set()
+        self.crash_after = crash_after
+        self.calls = []
+
+    def __call__(self, operations: dict) -> dict:
+        if self.crash_after is not None and len(self.calls) >= self.crash_after:
+            raise KeyboardInterrupt
+
+        self.calls.append(list(operations))
+        return {key: key not in self.failing_keys for key in operations}
+
+
+class TestSyncPlan(unittest.TestCase):
+
+    operations = {'jane.roe': {'job_title': 'Manager'},
+                  'john.doe': {'city': 'Bilbao'},
+                  'max.mustermann': {'state': 'Bizkaia'}}
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.sync_plan = SyncPlan(self.temp_dir.name, max_age=60)
+
+    def get_journal_file(self) -> str:
+        return os.path.join(self.temp_dir.name, 'update_from_ad_plan.journal')
+
+    def test_plan_saved_privately(self):
+        plan = self.sync_plan.create('update_from_ad', self.operations, metadata={'source': 'test'})
+        plan_file = self.sync_plan.get_plan_file('update_from_ad')
+
+        self.assertEqual(os.stat(plan_file).st_mode & 0o777, 0o600)
+        self.assertEqual(self.sync_plan.load('update_from_ad'), plan)
+
+    def test_empty_plan_not_saved(self):
+        self.sync_plan.create('update_from_ad', {})
+
+        self.assertIsNone(self.sync_plan.load('update_from_ad'))
+
+    def test_apply(self):
+        plan = self.sync_plan.create('update_from_ad', self.operations)
+        run_operations = OperationRunner()
+
+        results = self.sync_plan.apply(plan, run_operations, chunk_size=2)
+
+        self.assertEqual(results, {key: True for key in self.operations})
+        self.assertEqual(run_operations.calls, [['jane.roe', 'john.doe'], ['max.mustermann']])
+        self.assertIsNone(self.sync_plan.load('update_from_ad'))
+        self.assertFalse(os.path.exists(self.get_journal_file()))
+
+    def test_apply_keep(self):
+        plan = self.sync_plan.create('update_from_ad', self.operations)
+
+        self.sync_plan.apply(plan, OperationRunner(), keep=True)
+
+        self.assertEqual(self.sync_plan.load('update_from_ad'), plan)
+
+    def test_resume_after_crash(self):
+        plan = self.sync_plan.create('update_from_ad', self.operations)
+
+        with self.assertRaises(KeyboardInterrupt):
+            self.sync_plan.apply(plan, OperationRunner(crash_after=1), chunk_size=2)
+
+        plan = self.sync_plan.load('update_from_ad')
+        run_operations = OperationRunner()
+
+        self.assertEqual(self.sync_plan.get_completed(plan), {'jane.roe': True, 'john.doe': True})
+        self.assertEqual(self.sync_plan.apply(plan, run_operations, chunk_size=2),
+                         {key: True for key in self.operations})
+        self.assertEqual(run_operations.calls, [['max.mustermann']])
+
+    def test_failed_operations_retried(self):
+        plan = self.sync_plan.create('update_from_ad', self.operations)
+
+        results = self.sync_plan.apply(plan, OperationRunner(failing_keys={'john.doe'}), keep=True)
+
+        self.assertFalse(results['john.doe'])
+        self.assertNotIn('john.doe', self.sync_plan.get_completed(plan))
+
+        run_operations = OperationRunner()
+        self.sync_plan.apply(plan, run_operations)
+
+        self.assertEqual(run_operations.calls, [['john.doe']])
+
+    def test_truncated_journal_entry(self):
+        plan = self.sync_plan.create('update_from_ad', self.operations)
+
+        with open(self.get_journal_file(), 'w') as fp:
+            fp.write(json.dumps({'plan_id': plan['plan_id'], 'key': 'jane.roe', 'done': True}) + '\n')
+            fp.write('{"plan_id": "' + plan['plan_id'][:10])
+
+        run_operations = OperationRunner()
+        self.sync_plan.apply(plan, run_operations, chunk_size=3, keep=True)
+
+        # The entry cut short is ignored and the entries written after it are still read
+        self.assertEqual(run_operations.calls, [['john.doe', 'max.mustermann']])
+        self.assertEqual(set(self.sync_plan.get_completed(plan)), set(self.operations))
+
+    def test_journal_of_another_plan_ignored(self):
+        previous_plan = self.sync_plan.create('update_from_ad', self.operations)
+        self.sync_plan.apply(previous_plan, OperationRunner(), keep=True)
+
+        plan = self.sync_plan.create('update_from_ad', self.operations)
+
+        self.assertEqual(self.sync_plan.get_completed(plan), {})
+
+    def test_old_plan_discarded(self):
+        plan = self.sync_plan.create('update_from_ad', self.operations)
+        plan['created'] = (datetime.datetime.now() - datetime.timedelta(minutes=61)).isoformat()
+
+        with open(self.sync_plan.get_plan_file('update_from_ad'), 'w') as fp:
+            json.dump(plan, fp)
+
+        self.assertIsNone(self.sync_plan.load('update_from_ad'))
+        self.assertFalse(os.path.exists(self.sync_plan.get_plan_file('update_from_ad')))
+
+    def test_invalid_plan(self):
+        with open(self.sync_plan.get_plan_file('update_from_ad'), 'w') as fp:
+            fp.write('{not json')
+
+        self.assertIsNone(self.sync_plan.load('update_from_ad'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import os
+import string
+import tempfile
+import unittest
+
+from utils.template_registry import TemplateRegistry
+
+
+TEMPLATE = ('<html><head><style>p {{ margin: 0; }}</style></head><body>'
+            '<img src="cid:{company_logo_cid}"/>\n<p>Hello {name},</p>\n'
+            '<p>Your password expires in {days} days.</p>\n<p>{details}</p></body></html>')
+
+
+class TestTemplateRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+        self.template_files = {'notify_expiration': self.write_file('notify_expiration.template', TEMPLATE),
+                               'company_logo': self.write_file('company_logo.png', 'PNG')}
+
+    def write_file(self, file_name: str, content: str) -> str:
+        file_path = os.path.join(self.temp_dir.name, file_name)
+
+        with open(file_path, 'w') as template:
+            template.write(content)
+
+        return file_path
+
+    def render(self, template_registry: TemplateRegistry, details: str = 'Nothing else to do.') -> (str, str):
+        return template_registry.render('notify_expiration', {'name': 'John', 'days': 5, 'details': details})
+
+    def test_render(self):
+        template_registry = TemplateRegistry(self.template_files)
+
+        plain_body, html_body = self.render(template_registry)
+
+        self.assertIn('<p>Hello John,</p>', html_body)
+        self.assertIn(f'cid:{template_registry.logo_cid[1:-1]}', html_body)
+        self.assertIn('p { margin: 0; }', html_body)
+        self.assertIn('Hello John,', plain_body)
+        self.assertIn('Your password expires in 5 days.', plain_body)
+        self.assertNotIn('<', plain_body)
+        self.assertNotIn('\n\n\n', plain_body)
+
+    def test_field_markup_converted(self):
+        template_registry = TemplateRegistry(self.template_files)
+
+        plain_body, html_body = self.render(template_registry, details='Reset it at <b>{portal}</b>.')
+
+        self.assertIn('<p>Reset it at <b>{portal}</b>.</p>', html_body)
+        self.assertIn('Reset it at {portal}.', plain_body)
+
+    def test_templates_loaded_once(self):
+        template_registry = TemplateRegistry(self.template_files)
+        first_render = self.render(template_registry)
+
+        os.remove(self.template_files['notify_expiration'])
+        os.remove(self.template_files['company_logo'])
+
+        self.assertEqual(self.render(template_registry), first_render)
+        self.assertEqual(template_registry.get_logo_part().get_content(), b'PNG')
+
+    def test_missing_templates(self):
+        self.template_files['report_expirations'] = os.path.join(self.temp_dir.name, 'missing.template')
+        self.template_files['company_logo'] = os.path.join(self.temp_dir.name, 'missing.png')
+
+        with self.assertLogs('freeipa_manager', level='ERROR'):
+            template_registry = TemplateRegistry(self.template_files)
+
+        self.assertIn('Hello John,', self.render(template_registry)[0])
+
+        with self.assertRaises(OSError):
+            template_registry.render('report_expirations', {})
+        with self.assertRaises(OSError):
+            template_registry.get_logo_part()
+
+    def test_bundled_templates(self):
+        templates_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'templates')
+        template_files = {os.path.splitext(file_name)[0]: os.path.join(templates_path, file_name)
+                          for file_name in os.listdir(templates_path)}
+
+        template_registry = TemplateRegistry(template_files)
+
+        for template_name in template_registry.templates:
+            html_body = template_registry.templates[template_name]['html']
+            template_fields = {field: f'{field} value' for _, field, _, _ in string.Formatter().parse(html_body)
+                               if field and field != 'company_logo_cid'}
+
+            plain_body, html_body = template_registry.render(template_name, template_fields)
+
+            for field in template_fields:
+                self.assertIn(template_fields[field], plain_body)
+                self.assertIn(template_fields[field], html_body)
+
+
+if __name__ == '__main__':
+    unittest.main()
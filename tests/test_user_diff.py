@@ -0,0 +1,102 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import unittest
+
+from utils.user_diff import UserDiff
+
+
+class TestUserDiff(unittest.TestCase):
+
+    sync_fields = ['email', 'job_title', 'city', 'manager', 'member_of']
+
+    def setUp(self):
+        self.user_diff = UserDiff(is_email_valid=lambda email: email.endswith('@example.com'),
+                                  ignore_keys_on_sync=['member_of'])
+
+    @staticmethod
+    def get_user(email: str, job_title: str = 'Engineer', manager: str = '', member_of: list = None) -> dict:
+        return {'email': email, 'job_title': job_title, 'manager': manager, 'member_of': member_of or []}
+
+    def test_no_changes(self):
+        users = {'john.doe': self.get_user('john.doe@example.com')}
+
+        self.assertEqual(self.user_diff.compare(users, dict(users), self.sync_fields), {'update': {}, 'create': [], 'terminate': []})
+
+    def test_updated_fields(self):
+        freeipa_users = {'john.doe': self.get_user('john.doe@example.com'),
+                         'jane.roe': self.get_user('jane.roe@example.com')}
+        ad_users = {'john.doe': self.get_user('john.doe@example.com', job_title='Manager'),
+                    'jane.roe': self.get_user('jane.roe@example.com')}
+
+        self.assertEqual(self.user_diff.compare(freeipa_users, ad_users, self.sync_fields)['update'],
+                         {'john.doe': {'job_title': 'Manager'}})
+
+    def test_ignored_fields(self):
+        freeipa_users = {'john.doe': self.get_user('john.doe@example.com', member_of=['admins'])}
+        ad_users = {'john.doe': self.get_user('john.doe@example.com', member_of=['Domain Users'])}
+
+        self.assertEqual(self.user_diff.compare(freeipa_users, ad_users, self.sync_fields)['update'], {})
+
+    def test_manager_missing_from_freeipa(self):
+        freeipa_users = {'john.doe': self.get_user('john.doe@example.com'),
+                         'jane.roe': self.get_user('jane.roe@example.com')}
+        ad_users = {'john.doe': self.get_user('john.doe@example.com', manager='new.manager'),
+                    'jane.roe': self.get_user('jane.roe@example.com', manager='john.doe')}
+
+        self.assertEqual(self.user_diff.compare(freeipa_users, ad_users, self.sync_fields)['update'],
+                         {'jane.roe': {'manager': 'john.doe'}})
+
+    def test_fields_missing_from_a_user(self):
+        freeipa_users = {'john.doe': {'email': 'john.doe@example.com', 'job_title': 'Engineer'}}
+        ad_users = {'john.doe': {'email': 'john.doe@example.com', 'job_title': 'Manager', 'city': 'Bilbao'}}
+
+        self.assertEqual(self.user_diff.compare(freeipa_users, ad_users, self.sync_fields)['update'],
+                         {'john.doe': {'job_title': 'Manager'}})
+
+    def test_fields_missing_from_the_first_user(self):
+        freeipa_users = {'john.doe': {'email': 'john.doe@example.com', 'job_title': 'Engineer'},
+                         'jane.roe': self.get_user('jane.roe@example.com')}
+        ad_users = {'john.doe': {'email': 'john.doe@example.com', 'job_title': 'Engineer'},
+                    'jane.roe': self.get_user('jane.roe@example.com', manager='john.doe')}
+
+        # The compared fields never depend on the fields held by the first user
+        self.assertEqual(self.user_diff.compare(freeipa_users, ad_users, self.sync_fields)['update'],
+                         {'jane.roe': {'manager': 'john.doe'}})
+
+    def test_only_sync_fields_compared(self):
+        freeipa_users = {'john.doe': self.get_user('john.doe@example.com', job_title='Engineer')}
+        ad_users = {'john.doe': self.get_user('john.doe@example.com', job_title='Manager')}
+
+        self.assertEqual(self.user_diff.compare(freeipa_users, ad_users, ['email'])['update'], {})
+
+    def test_created_users(self):
+        ad_users = {'john.doe': self.get_user('john.doe@example.com'),
+                    'external.user': self.get_user('external.user@partner.com')}
+
+        self.assertEqual(self.user_diff.compare({}, ad_users, self.sync_fields)['create'], ['john.doe'])
+
+    def test_terminated_users(self):
+        freeipa_users = {'john.doe': self.get_user('john.doe@example.com'),
+                         'jane.roe': self.get_user('jane.roe@example.com'),
+                         'service.account': self.get_user('service.account@partner.com'),
+                         'no.email': self.get_user('')}
+        ad_users = {'john.doe': self.get_user('john.doe@example.com')}
+
+        # Only users with an email of the synchronized domains are managed from AD
+        self.assertEqual(self.user_diff.compare(freeipa_users, ad_users, self.sync_fields)['terminate'], ['jane.roe'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,415 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import datetime
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from utils.expiration_index import ExpirationIndex
+from utils.utils import Utils
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeADHandler:
+
+    user_fields = ['email', 'job_title']
+
+    def __init__(self, ad_users: dict):
+        self.ad_users = ad_users
+
+    def get_ad_users(self, force_update_cache: bool = False, fields: list = None) -> dict:
+        return self.ad_users
+
+
+class FakeFreeIPAHandler:
+
+    user_fields = ['email', 'job_title', 'krbpasswordexpiration']
+
+    def __init__(self, freeipa_users: dict, preserved_users: set = None, failing_users: set = None):
+        self.freeipa_users = freeipa_users
+        self.preserved_users = preserved_users or set()
+        self.failing_users = failing_users or set()
+        self.deleted_users = []
+        self.disabled_users = []
+        self.updated_users = {}
+
+    def delete_freeipa_users(self, user_ids: list, preserve: bool = True) -> (list, list):
+        deleted_users = [user_id for user_id in user_ids if user_id not in self.failing_users]
+        self.deleted_users.extend(deleted_users)
+        return deleted_users, [user_id for user_id in user_ids if user_id in self.failing_users]
+
+    def disable_freeipa_user(self, user_id: str) -> bool:
+        self.disabled_users.append(user_id)
+        return True
+
+    def get_expiration_index(self) -> ExpirationIndex:
+        return ExpirationIndex(self.freeipa_users)
+
+    def get_freeipa_users(self, force_update_cache: bool = False) -> dict:
+        return self.freeipa_users
+
+    def get_preserved_users(self) -> set:
+        return self.preserved_users
+
+    def update_freeipa_users(self, user_updates: dict, update_cache: bool = True) -> (list, list):
+        updated_users = [user_id for user_id in user_updates if user_id not in self.failing_users]
+        self.updated_users.update({user_id: user_updates[user_id] for user_id in updated_users})
+        return updated_users, [user_id for user_id in user_updates if user_id in self.failing_users]
+
+
+class FakeNotifier:
+
+    def __init__(self):
+        self.reports = []
+
+    def notify_expiration(self, user_id: str, user_email: str, user_name: str, days: int,
+                          expiration_date: datetime.date) -> bool:
+        self.reports.append(('expiration', user_id, days))
+        return True
+
+    def report_ad_updates(self, updated_users_list: list) -> bool:
+        self.reports.append(('ad_updates', updated_users_list))
+        return True
+
+    def report_expirations(self, expired_users: list, disabled_users: list) -> bool:
+        self.reports.append(('expirations', expired_users, disabled_users))
+        return True
+
+    def report_terminated(self, deleted_users_list: list, not_deleted_users_list: list) -> bool:
+        self.reports.append(('terminated', deleted_users_list, not_deleted_users_list))
+        return True
+
+
+class UtilsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+        os.mkdir(os.path.join(self.temp_dir.name, 'cache'))
+        config_file = os.path.join(self.temp_dir.name, 'config.yaml')
+        shutil.copy(os.path.join(ROOT_PATH, 'config.yaml'), config_file)
+
+        self.utils = Utils(config_file)
+        self.addCleanup(self.remove_log_handlers)
+
+        self.utils.terminated_grace_refreshes = 1
+        self.utils.terminated_max_deletions = 50
+        self.utils.notifier = FakeNotifier()
+        self.ad_refreshes = 0
+
+    @staticmethod
+    def remove_log_handlers():
+        log = logging.getLogger('freeipa_manager')
+
+        for handler in list(log.handlers):
+            log.removeHandler(handler)
+            handler.close()
+
+    @staticmethod
+    def get_user(user_id: str, job_title: str = 'Engineer') -> dict:
+        return {'email': f'{user_id}@mycompany.com', 'job_title': job_title}
+
+    def set_directories(self, ad_user_ids: list, freeipa_user_ids: list, **freeipa_handler_args) -> None:
+        ad_users = {user_id: self.get_user(user_id) for user_id in ad_user_ids}
+        freeipa_users = {user_id: self.get_user(user_id) for user_id in freeipa_user_ids}
+
+        self.utils.ad_handler = FakeADHandler(ad_users)
+        self.utils.freeipa_handler = FakeFreeIPAHandler(freeipa_users, **freeipa_handler_args)
+
+        self.refresh_ad_cache()
+        self.utils.get_cache_handler().save_cache(freeipa_users=freeipa_users,
+                                                  update_time=datetime.datetime(2021, 5, 1))
+
+    def refresh_ad_cache(self) -> None:
+        self.ad_refreshes += 1
+        update_time = datetime.datetime(2021, 5, 1) + datetime.timedelta(hours=self.ad_refreshes)
+
+        self.utils.get_cache_handler().save_cache(ad_users=self.utils.ad_handler.ad_users, update_time=update_time)
+
+
+class TestTerminatedUsers(UtilsTestCase):
+
+    def test_missing_users_deleted(self):
+        self.set_directories(['john.doe'], ['john.doe', 'jane.roe', 'max.mustermann'])
+
+        self.assertEqual(self.utils.delete_terminated_users(), (['jane.roe', 'max.mustermann'], []))
+        self.assertEqual(self.utils.freeipa_handler.deleted_users, ['jane.roe', 'max.mustermann'])
+        self.assertEqual(self.utils.notifier.reports, [('terminated', ['jane.roe', 'max.mustermann'], [])])
+
+    def test_no_terminated_users(self):
+        self.set_directories(['john.doe'], ['john.doe'])
+
+        self.assertEqual(self.utils.delete_terminated_users(), (None, None))
+        self.assertEqual(self.utils.notifier.reports, [])
+
+    def test_preserved_users_not_deleted(self):
+        self.set_directories(['john.doe'], ['john.doe', 'jane.roe'], preserved_users={'jane.roe'})
+
+        self.assertEqual(self.utils.delete_terminated_users(), (None, None))
+        self.assertEqual(self.utils.freeipa_handler.deleted_users, [])
+
+    def test_failed_deletions_reported(self):
+        self.set_directories(['john.doe'], ['john.doe', 'jane.roe'], failing_users={'jane.roe'})
+
+        self.assertEqual(self.utils.delete_terminated_users(), ([], ['jane.roe']))
+
+    def test_grace_window(self):
+        self.utils.terminated_grace_refreshes = 2
+        self.set_directories(['john.doe'], ['john.doe', 'jane.roe'])
+
+        self.assertEqual(self.utils.delete_terminated_users(), (None, None))
+
+        # Runs without an AD refresh in between do not count towards the grace window
+        self.assertEqual(self.utils.delete_terminated_users(), (None, None))
+        self.assertEqual(self.utils.get_cache_handler().get_terminated_users_state()['jane.roe']['missing_refreshes'],
+                         1)
+
+        self.refresh_ad_cache()
+
+        self.assertEqual(self.utils.delete_terminated_users(), (['jane.roe'], []))
+
+    def test_grace_window_reset_when_user_back_in_ad(self):
+        self.utils.terminated_grace_refreshes = 2
+        self.set_directories(['john.doe'], ['john.doe', 'jane.roe'])
+
+        self.utils.delete_terminated_users()
+
+        self.utils.ad_handler.ad_users['jane.roe'] = self.get_user('jane.roe')
+        self.refresh_ad_cache()
+        self.utils.delete_terminated_users()
+
+        del self.utils.ad_handler.ad_users['jane.roe']
+        self.refresh_ad_cache()
+
+        self.assertEqual(self.utils.delete_terminated_users(), (None, None))
+        self.assertEqual(self.utils.freeipa_handler.deleted_users, [])
+
+    def test_max_deletions(self):
+        self.utils.terminated_max_deletions = 2
+        self.set_directories(['john.doe'], ['john.doe', 'jane.roe', 'max.mustermann', 'erika.mustermann'])
+
+        self.assertEqual(self.utils.delete_terminated_users(), (None, None))
+        self.assertEqual(self.utils.freeipa_handler.deleted_users, [])
+        self.assertFalse(os.path.exists(self.utils.get_plan_file('terminated_users')))
+
+
+
+class TestSyncPlans(UtilsTestCase):
+
+    def test_pending_update_plan_applied(self):
+        self.set_directories(['john.doe', 'jane.roe'], ['john.doe', 'jane.roe'])
+        self.utils.ad_handler.ad_users['jane.roe']['job_title'] = 'Manager'
+        self.refresh_ad_cache()
+
+        update_plan, _ = self.utils.plan_user_changes()
+
+        self.assertEqual(update_plan['operations'], {'jane.roe': {'job_title': 'Manager'}})
+        self.assertTrue(os.path.exists(self.utils.get_plan_file('update_from_ad')))
+
+        self.assertEqual(self.utils.update_user_data_from_ad(), (['jane.roe'], []))
+        self.assertEqual(self.utils.freeipa_handler.updated_users, {'jane.roe': {'job_title': 'Manager'}})
+        self.assertFalse(os.path.exists(self.utils.get_plan_file('update_from_ad')))
+
+    def test_interrupted_deletion_resumed(self):
+        self.set_directories(['john.doe'], ['john.doe', 'jane.roe', 'max.mustermann'])
+
+        _, terminated_plan = self.utils.plan_user_changes()
+        self.utils.sync_plan.apply(terminated_plan, lambda operations: {'jane.roe': True}, keep=True)
+
+        self.assertEqual(self.utils.delete_terminated_users(), (['jane.roe', 'max.mustermann'], []))
+
+        # Only the deletion missing from the journal is sent again
+        self.assertEqual(self.utils.freeipa_handler.deleted_users, ['max.mustermann'])
+
+    def test_plan_discarded_after_cache_refresh(self):
+        self.set_directories(['john.doe'], ['john.doe', 'jane.roe', 'max.mustermann'])
+        self.utils.plan_user_changes()
+
+        self.utils.ad_handler.ad_users['jane.roe'] = self.get_user('jane.roe')
+        self.refresh_ad_cache()
+
+        self.assertEqual(self.utils.delete_terminated_users(), (['max.mustermann'], []))
+        self.assertEqual(self.utils.freeipa_handler.deleted_users, ['max.mustermann'])
+
+    def test_old_plan_discarded(self):
+        self.set_directories(['john.doe'], ['john.doe', 'jane.roe', 'max.mustermann'])
+        self.utils.sync_plan.max_age = 60
+        _, terminated_plan = self.utils.plan_user_changes()
+
+        terminated_plan['created'] = (datetime.datetime.now() - datetime.timedelta(hours=2)).isoformat()
+        terminated_plan['operations'] = {'john.doe': terminated_plan['operations']['jane.roe']}
+
+        with open(self.utils.get_plan_file('terminated_users'), 'w') as fp:
+            json.dump(terminated_plan, fp)
+
+        self.assertEqual(self.utils.delete_terminated_users(), (['jane.roe', 'max.mustermann'], []))
+        self.assertNotIn('john.doe', self.utils.freeipa_handler.deleted_users)
+
+    def test_pending_plan_over_max_deletions_discarded(self):
+        self.set_directories(['john.doe'], ['john.doe', 'jane.roe', 'max.mustermann'])
+        self.utils.plan_user_changes()
+
+        self.utils.terminated_max_deletions = 1
+
+        self.assertEqual(self.utils.delete_terminated_users(), (None, None))
+        self.assertEqual(self.utils.freeipa_handler.deleted_users, [])
+        self.assertFalse(os.path.exists(self.utils.get_plan_file('terminated_users')))
+
+
+class TestPasswordExpirations(UtilsTestCase):
+
+    def set_expirations(self, expirations: dict) -> None:
+        freeipa_users = {}
+
+        for user_id in expirations:
+            expiration = datetime.date.today() + datetime.timedelta(days=expirations[user_id])
+            freeipa_users[user_id] = dict(self.get_user(user_id), name=user_id,
+                                          krbpasswordexpiration=[{'__datetime__': f"{expiration:%Y%m%d}000000Z"}])
+
+        self.utils.freeipa_handler = FakeFreeIPAHandler(freeipa_users)
+
+    def test_reminder_sent_once(self):
+        self.set_expirations({'john.doe': 359, 'jane.roe': 358})
+
+        self.assertEqual(self.utils.process_password_expirations()[0], ['john.doe'])
+        self.assertEqual(self.utils.process_password_expirations()[0], [])
+        self.assertEqual(self.utils.notifier.reports, [('expiration', 'john.doe', 359)])
+
+    def test_no_reminders_on_notification_days(self):
+        self.set_expirations({'john.doe': 14, 'jane.roe': 7, 'max.mustermann': 1})
+
+        self.assertEqual(self.utils.process_password_expirations(), ([], [], []))
+        self.assertEqual(set(self.utils.get_cache_handler().get_notification_history_cache()),
+                         {'john.doe', 'jane.roe', 'max.mustermann'})
+
+    def test_expired_users(self):
+        gracious_period = self.utils.password_gracious_period
+        self.set_expirations({'john.doe': -1, 'jane.roe': -gracious_period - 1, 'max.mustermann': 30})
+
+        self.assertEqual(self.utils.process_password_expirations(), ([], ['john.doe'], ['jane.roe']))
+        self.assertEqual(self.utils.freeipa_handler.disabled_users, ['jane.roe'])
+
+        # Users already disabled are reported again but not disabled twice
+        self.utils.process_password_expirations()
+
+        self.assertEqual(self.utils.freeipa_handler.disabled_users, ['jane.roe'])
+        self.assertEqual(self.utils.notifier.reports, [('expirations', ['john.doe'], ['jane.roe'])] * 2)
+
+
+class TestLazyHandlers(UtilsTestCase):
+
+    def run_command(self, args: list) -> str:
+        from freeipa_manager import run_command
+
+        output = io.StringIO()
+        parser, cli_args = self.utils.get_menu().generate_menu(args, output)
+        run_command(self.utils, parser, cli_args, output, self.temp_dir.name)
+
+        return output.getvalue()
+
+    def test_cache_only_commands_need_no_server(self):
+        from freeipa_manager import get_required_servers
+
+        for args in [['-b'], ['-g'], ['-j', 'sqlite']]:
+            self.assertEqual(get_required_servers(self.utils.get_menu().generate_menu(args)[1]), [])
+
+        self.assertEqual(get_required_servers(self.utils.get_menu().generate_menu(['-u'])[1]),
+                         ['ad', 'freeipa', 'smtp'])
+
+    def test_cache_only_command_creates_no_handler(self):
+        self.assertEqual(self.run_command(['-b']), 'Cache is outdated\n')
+
+        self.assertIsNone(self.utils.ad_handler)
+        self.assertIsNone(self.utils.freeipa_handler)
+
+    def test_cache_only_command_imports_no_server_library(self):
+        script = ('import io, sys\n'
+                  'from freeipa_manager import run_command\n'
+                  'from utils.utils import Utils\n'
+                  'utils = Utils(sys.argv[1])\n'
+                  'parser, cli_args = utils.get_menu().generate_menu(["-b"])\n'
+                  'run_command(utils, parser, cli_args, io.StringIO(), ".")\n'
+                  'print(sorted(set(sys.modules) & {"html2text", "ldap", "python_freeipa", "requests"}))\n')
+
+        result = subprocess.run([sys.executable, '-c', script, self.utils.config_file], cwd=ROOT_PATH,
+                                capture_output=True, text=True, check=True)
+
+        self.assertEqual(result.stdout, '[]\n')
+
+
+class TestSettingsSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.addCleanup(UtilsTestCase.remove_log_handlers)
+
+        self.config_file = os.path.join(self.temp_dir.name, 'config.yaml')
+        self.snapshot_file = os.path.join(self.temp_dir.name, 'cache', Utils.settings_snapshot_file)
+        shutil.copy(os.path.join(ROOT_PATH, 'config.yaml'), self.config_file)
+
+    def get_utils(self) -> (Utils, bool):
+        with mock.patch.object(Utils, '_Utils__load_config_file', autospec=True,
+                               side_effect=Utils._Utils__load_config_file) as load_config_file:
+            utils = Utils(self.config_file)
+
+        return utils, load_config_file.called
+
+    def test_snapshot_saved_on_first_run(self):
+        _, config_loaded = self.get_utils()
+
+        self.assertTrue(config_loaded)
+        self.assertEqual(os.stat(self.snapshot_file).st_mode & 0o777, 0o600)
+
+    def test_settings_loaded_from_snapshot(self):
+        utils, _ = self.get_utils()
+        snapshot_utils, config_loaded = self.get_utils()
+
+        self.assertFalse(config_loaded)
+        self.assertEqual(snapshot_utils.cache_files, utils.cache_files)
+        self.assertEqual(snapshot_utils.notification_days, utils.notification_days)
+
+    def test_snapshot_outdated_by_config_change(self):
+        self.get_utils()
+
+        with open(self.config_file, 'a') as fp:
+            fp.write('\n')
+
+        _, config_loaded = self.get_utils()
+
+        self.assertTrue(config_loaded)
+
+    def test_snapshot_outdated_by_new_version(self):
+        self.get_utils()
+
+        with mock.patch.object(Utils, 'settings_snapshot_version', Utils.settings_snapshot_version + 1):
+            _, config_loaded = self.get_utils()
+            _, snapshot_config_loaded = self.get_utils()
+
+        self.assertTrue(config_loaded)
+        self.assertFalse(snapshot_config_loaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
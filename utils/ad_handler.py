@@ -12,62 +12,194 @@
 #
 # Copyright (C) 2021  Unai Goikoetxeta
 
+import datetime
 import logging
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import ldap
 from ldap.controls import SimplePagedResultsControl
 
 from utils.cache_handler import CacheHandler
+from utils.health_monitor import HealthMonitor
 
 
 class ADHandler:
 
-    def __init__(self, ad_settings: dict, cache_handler: CacheHandler, corporate_email_domains: list):
+    attribute_map = {'email': 'mail', 'alias': 'sAMAccountName', 'full_name': 'name', 'name': 'givenName',
+                     'lastname': 'sn', 'job_title': 'title', 'street_address': 'streetAddress', 'city': 'l',
+                     'state': 'st', 'zip_code': 'postalCode', 'org_unit': 'department', 'employee_number': 'employeeID',
+                     'employee_type': 'extensionAttribute6', 'preferred_language': 'msExchUserCulture',
+                     'phone_number': 'telephoneNumber', 'manager': 'manager', 'cn': 'cn', 'member_of': 'memberOf'}
+
+    # Failures of a single domain controller, another one can carry on with the work
+    failover_errors = (ldap.BUSY, ldap.CONNECT_ERROR, ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.UNAVAILABLE)
+
+    # Full searches against several domain controllers are split in cn ranges, a range read completely is never
+    # requested again when a domain controller fails during the search
+    search_partition_bounds = 'bcdefghijklmnopqrstuvwxyz'
+
+    def __init__(self, ad_settings: dict, cache_handler: CacheHandler, corporate_email_domains: list,
+                 ignore_keys_on_sync: list = None, sync_mode: str = 'full', full_sync_interval: int = 24,
+                 health_monitor: HealthMonitor = None):
         self.log = logging.getLogger('freeipa_manager')
         self.ad_credentials = ad_settings['credentials']
+        self.ad_servers = self.__get_ad_servers(ad_settings['credentials'])
+        self.ad_server = None
+        self.probe_timeout = ad_settings['credentials'].get('probe_timeout', 2)
+        self.health_monitor = health_monitor
         self.ad_base = ad_settings['base']
         self.cache_handler = cache_handler
         self.corporate_email_domains = corporate_email_domains
-        self.ad_connection = self.__connect_to_ad()
+        self.user_fields = self.__get_user_fields(ignore_keys_on_sync or [])
+        self.sync_mode = sync_mode
+        self.full_sync_interval = full_sync_interval
+
+        # The AD bind happens on first use, so cache-only work never connects to the server
+        self.__ad_connection = None
+        self.__ad_connection_attempted = False
 
-    def __connect_to_ad(self) -> ldap.ldapobject:
+    @property
+    def ad_connection(self) -> ldap.ldapobject:
+        if not self.__ad_connection_attempted:
+            self.__ad_connection_attempted = True
+            self.__ad_connection = self.__connect_to_ad()
+
+        return self.__ad_connection
+
+    def __connect_to_ad(self, excluded_servers: set = None) -> ldap.ldapobject:
         self.log.debug('Connecting to AD server')
 
-        ad_server = self.ad_credentials['proto'] + self.ad_credentials['host'] + ':' + str(self.ad_credentials['port'])
+        for ad_server in self.__get_ad_servers_by_latency(excluded_servers or set()):
+            try:
+                ad_client = ldap.initialize(self.ad_credentials['proto'] + ad_server)
+                ad_client.set_option(ldap.OPT_REFERRALS, 0)
+                ad_client.set_option(ldap.OPT_NETWORK_TIMEOUT, self.probe_timeout)
+                ad_client.simple_bind_s(self.ad_credentials['username'], self.ad_credentials['password'])
+
+                self.ad_server = ad_server
+                self.log.debug(f'Connection established to AD server {ad_server}')
+
+                if self.health_monitor and self.health_monitor.get_status(f'ad:{ad_server}') is not True:
+                    self.health_monitor.record(f'ad:{ad_server}', True)
+
+                return ad_client
+
+            except self.failover_errors as e:
+                self.log.warning(f'Could not connect to AD server {ad_server}: {e}')
+
+                if self.health_monitor:
+                    self.health_monitor.record(f'ad:{ad_server}', False)
+
+            except (ldap.INAPPROPRIATE_AUTH,
+                    ldap.INSUFFICIENT_ACCESS,
+                    ldap.INVALID_CREDENTIALS,
+                    ldap.PROTOCOL_ERROR) as e:
+
+                self.log.error(f'Could not connect to AD server {ad_server}: {e}')
+                return None
+
+        self.log.error(f"Could not connect to any AD server: {', '.join(self.ad_servers)}")
+        return None
+
+    def __fail_over(self, error: Exception) -> bool:
+        failed_server = self.ad_server
+
+        self.log.warning(f'AD server {failed_server} failed ({error}), switching to another domain controller')
+
+        if self.health_monitor:
+            self.health_monitor.record(f'ad:{failed_server}', False)
 
         try:
-            ad_client = ldap.initialize(ad_server)
-            ad_client.set_option(ldap.OPT_REFERRALS, 0)
-            ad_client.simple_bind_s(self.ad_credentials['username'], self.ad_credentials['password'])
+            self.__ad_connection.unbind_s()
+        except ldap.LDAPError:
+            pass
 
-            self.log.debug('Connection established')
-            return ad_client
+        self.__ad_connection = self.__connect_to_ad(excluded_servers={failed_server})
+        self.__ad_connection_attempted = True
 
-        except (ldap.BUSY,
-                ldap.CONNECT_ERROR,
-                ldap.INAPPROPRIATE_AUTH,
-                ldap.INSUFFICIENT_ACCESS,
-                ldap.INVALID_CREDENTIALS,
-                ldap.PROTOCOL_ERROR,
-                ldap.SERVER_DOWN,
-                ldap.TIMEOUT,
-                ldap.UNAVAILABLE) as e:
+        return self.__ad_connection is not None
+
+    @staticmethod
+    def __get_ad_servers(ad_credentials: dict) -> list:
+        ad_servers = [f"{ad_credentials['host']}:{ad_credentials['port']}"]
+
+        for domain_controller in ad_credentials.get('domain_controllers') or []:
+            if ':' not in str(domain_controller):
+                domain_controller = f"{domain_controller}:{ad_credentials['port']}"
+
+            if domain_controller not in ad_servers:
+                ad_servers.append(domain_controller)
+
+        return ad_servers
+
+    def __get_ad_servers_by_latency(self, excluded_servers: set) -> list:
+        ad_servers = [ad_server for ad_server in self.ad_servers if ad_server not in excluded_servers]
+
+        if len(ad_servers) < 2:
+            return ad_servers
+
+        # Domain controllers failing recently are only tried when no other one is left
+        if self.health_monitor:
+            available_servers = [ad_server for ad_server in ad_servers
+                                 if self.health_monitor.get_status(f'ad:{ad_server}') is not False]
+            ad_servers = available_servers + [ad_server for ad_server in ad_servers
+                                              if ad_server not in available_servers]
+
+        with ThreadPoolExecutor(max_workers=len(ad_servers)) as executor:
+            latencies = dict(zip(ad_servers, executor.map(self.__probe_ad_server, ad_servers)))
+
+        reachable_servers = sorted((ad_server for ad_server in ad_servers if latencies[ad_server] is not None),
+                                   key=lambda ad_server: latencies[ad_server])
+
+        self.log.debug('AD server latencies: ' + ', '.join(f'{ad_server} {latencies[ad_server] * 1000:.1f} ms'
+                                                          for ad_server in reachable_servers))
 
-            self.log.error(f'Could not connect to AD server {ad_server}: {e}')
+        # Unreachable servers stay last, the probe may have failed where a bind would not
+        return reachable_servers + [ad_server for ad_server in ad_servers if latencies[ad_server] is None]
+
+    def __probe_ad_server(self, ad_server: str) -> float:
+        host, port = ad_server.rsplit(':', 1)
+        start = time.monotonic()
+
+        try:
+            with socket.create_connection((host, int(port)), timeout=self.probe_timeout):
+                return time.monotonic() - start
+
+        except OSError:
             return None
 
+    def __get_search_partitions(self) -> list:
+        bounds = self.search_partition_bounds
+
+        return [f'(!(cn>={bounds[0]}))'] + \
+            [f'(cn>={bounds[i]})(!(cn>={bounds[i + 1]}))' for i in range(len(bounds) - 1)] + \
+            [f'(cn>={bounds[-1]})']
+
+    def __run_search(self, **search_args) -> tuple:
+        for _ in self.ad_servers:
+            try:
+                msgid = self.ad_connection.search_ext(**search_args)
+                return self.ad_connection.result3(msgid)
+
+            except self.failover_errors as e:
+                if len(self.ad_servers) < 2 or not self.__fail_over(e):
+                    raise
+
+        msgid = self.ad_connection.search_ext(**search_args)
+        return self.ad_connection.result3(msgid)
+
     def __get_uid_from_ad_user_base(self, user_base: str) -> str:
         self.log.debug(f"Translating AD user base {user_base} to FreeIPA's user_id format")
 
         search_flt = '(objectClass=person)'
 
         try:
-            msgid = self.ad_connection.search_ext(base=user_base,
-                                                  scope=ldap.SCOPE_SUBTREE,
-                                                  filterstr=search_flt,
-                                                  attrlist=['mail'])
-
-            query_data = self.ad_connection.result3(msgid)[1]
+            query_data = self.__run_search(base=user_base,
+                                           scope=ldap.SCOPE_SUBTREE,
+                                           filterstr=search_flt,
+                                           attrlist=['mail'])[1]
 
             if 'mail' in query_data[0][1]:
                 email = query_data[0][1]['mail'][0].decode('utf-8')
@@ -101,54 +233,260 @@ class ADHandler:
             return ''
 
     @staticmethod
-    def __get_user_data(user) -> dict:
-        email = user[1]['mail'][0].decode('utf-8').lower()
-        user_data = {'email': email, 'alias': '', 'full_name': '', 'name': '', 'lastname': '', 'job_title': '',
-                     'street_address': '', 'city': '', 'state': '', 'zip_code': '', 'org_unit': '',
-                     'employee_number': '', 'employee_type': '', 'preferred_language': '', 'phone_number': '',
-                     'manager': '', 'cn': '', 'member_of': ''}
-
-        if 'sAMAccountName' in user[1]:
-            user_data['alias'] = user[1]['sAMAccountName'][0].decode('utf-8').lower().strip()
-        if 'name' in user[1]:
-            user_data['full_name'] = user[1]['name'][0].decode('utf-8').strip()
-        if 'givenName' in user[1]:
-            user_data['name'] = user[1]['givenName'][0].decode('utf-8').strip()
-        if 'sn' in user[1]:
-            user_data['lastname'] = user[1]['sn'][0].decode('utf-8').strip()
-        if 'title' in user[1]:
-            user_data['job_title'] = user[1]['title'][0].decode('utf-8').strip()
-        if 'streetAddress' in user[1]:
-            user_data['street_address'] = user[1]['streetAddress'][0].decode('utf-8').strip()
-        if 'l' in user[1]:
-            user_data['city'] = user[1]['l'][0].decode('utf-8').strip()
-        if 'postalCode' in user[1]:
-            user_data['zip_code'] = user[1]['postalCode'][0].decode('utf-8').strip()
-        if 'st' in user[1]:
-            user_data['state'] = user[1]['st'][0].decode('utf-8').strip()
-        if 'telephoneNumber' in user[1]:
-            user_data['phone_number'] = user[1]['telephoneNumber'][0].decode('utf-8').strip()
-        if 'department' in user[1]:
-            user_data['org_unit'] = user[1]['department'][0].decode('utf-8').strip()
-        if 'employeeID' in user[1]:
-            user_data['employee_number'] = user[1]['employeeID'][0].decode('utf-8').strip()
-        if 'extensionAttribute6' in user[1]:
-            user_data['employee_type'] = user[1]['extensionAttribute6'][0].decode('utf-8').strip()
-        if 'msExchUserCulture' in user[1]:
-            user_data['preferred_language'] = user[1]['msExchUserCulture'][0].decode('utf-8').strip()
-        if 'manager' in user[1]:
-            manager = user[1]['manager'][0].decode('utf-8')
-            user_data['manager'] = manager[:manager.index(',')][3:].strip()
-        if 'cn' in user[1]:
-            user_data['cn'] = user[1]['cn'][0].decode('utf-8').strip()
-        if 'memberOf' in user[1]:
-            member_of = []
-            for group in user[1]['memberOf']:
-                member_of.append(group.decode('utf-8').strip())
-            user_data['member_of'] = member_of
+    def __get_cn_uid_pairs(ad_entries: dict) -> dict:
+        return {ad_entries[dn][1]: ad_entries[dn][0] for dn in ad_entries if ad_entries[dn][0] and ad_entries[dn][1]}
+
+    def __get_search_attributes(self, fields: list) -> list:
+        search_attributes = [self.attribute_map[field] for field in fields]
+
+        # Users are identified and filtered by their email, even when it is not one of the requested fields
+        if 'email' not in fields:
+            search_attributes.insert(0, 'mail')
+
+        # The cn of every user is needed to translate the manager DNs into user IDs
+        if 'manager' in fields and 'cn' not in fields:
+            search_attributes.append('cn')
+
+        self.log.debug(f"AD attributes to request: {', '.join(search_attributes)}")
+
+        return search_attributes
+
+    @staticmethod
+    def __get_user_data(user, fields: list) -> dict:
+        user_data = {}
+
+        for field in fields:
+            values = user[1].get(ADHandler.attribute_map[field])
+
+            if field == 'member_of':
+                user_data[field] = [group.decode('utf-8').strip() for group in values] if values else ''
+            elif not values:
+                user_data[field] = ''
+            elif field == 'email':
+                user_data[field] = values[0].decode('utf-8').lower()
+            elif field == 'alias':
+                user_data[field] = values[0].decode('utf-8').lower().strip()
+            elif field == 'manager':
+                manager = values[0].decode('utf-8')
+                user_data[field] = manager[:manager.index(',')][3:].strip()
+            else:
+                user_data[field] = values[0].decode('utf-8').strip()
 
         return user_data
 
+    def __get_user_fields(self, ignore_keys_on_sync: list) -> list:
+        user_fields = [field for field in self.attribute_map if field == 'email' or field not in ignore_keys_on_sync]
+
+        self.log.debug(f"AD user fields to retrieve: {', '.join(user_fields)}")
+
+        return user_fields
+
+    def __get_server_state(self) -> dict:
+        root_dse = self.__run_search(base='',
+                                     scope=ldap.SCOPE_BASE,
+                                     filterstr='(objectClass=*)',
+                                     attrlist=['dsServiceName', 'highestCommittedUSN'])[1][0][1]
+
+        server_state = {'server': root_dse['dsServiceName'][0].decode('utf-8'),
+                        'usn': int(root_dse['highestCommittedUSN'][0])}
+
+        self.log.debug(f"AD server {server_state['server']} at USN {server_state['usn']}")
+
+        return server_state
+
+    def __is_full_sync_required(self, sync_state: dict, server_state: dict, ad_users: dict) -> bool:
+        if not sync_state or not ad_users:
+            self.log.debug('No previous AD synchronization available')
+            return True
+
+        if sync_state['fields'] != self.user_fields:
+            self.log.debug('AD user fields changed since the last synchronization')
+            return True
+
+        # USNs are local to each domain controller and go backwards after a restore
+        if sync_state['server'] != server_state['server'] or sync_state['usn'] > server_state['usn']:
+            self.log.debug('AD synchronization state belongs to a different domain controller or was reset')
+            return True
+
+        last_full_sync = datetime.datetime.fromisoformat(sync_state['last_full_sync'])
+
+        if datetime.datetime.now() - last_full_sync > datetime.timedelta(hours=self.full_sync_interval):
+            self.log.debug(f'Last full AD synchronization is older than {self.full_sync_interval} hours')
+            return True
+
+        return False
+
+    def __search_ad_users(self, search_flt: str, fields: list, partitioned: bool = False) -> (dict, dict):
+        searchreq_attrlist = self.__get_search_attributes(fields)
+
+        ad_users = {}
+        ad_entries = {}
+        pages = 0
+
+        if partitioned and len(self.ad_servers) > 1:
+            search_filters = [f'(&{search_flt}{partition})' for partition in self.__get_search_partitions()]
+        else:
+            search_filters = [search_flt]
+
+        failovers = 0
+
+        for partition_flt in search_filters:
+            while True:
+                try:
+                    pages += self.__search_ad_users_pages(partition_flt, searchreq_attrlist, fields, ad_users,
+                                                          ad_entries)
+                    break
+
+                except self.failover_errors as e:
+                    # Paging cookies are only valid on the domain controller that issued them, the current
+                    # partition is read again from its start on the next one
+                    failovers += 1
+
+                    if len(self.ad_servers) < 2 or failovers > len(self.ad_servers) or not self.__fail_over(e):
+                        raise
+
+        self.log.debug(f'{len(ad_entries)} AD entries retrieved in {pages} page(s)')
+
+        return ad_users, ad_entries
+
+    def __search_ad_users_pages(self, search_flt: str, searchreq_attrlist: list, fields: list, ad_users: dict,
+                                ad_entries: dict) -> int:
+        page_size = 1000
+
+        req_ctrl = SimplePagedResultsControl(criticality=True, size=page_size, cookie='')
+
+        msgid = self.ad_connection.search_ext(base=self.ad_base,
+                                              scope=ldap.SCOPE_SUBTREE,
+                                              filterstr=search_flt,
+                                              attrlist=searchreq_attrlist,
+                                              serverctrls=[req_ctrl])
+
+        pages = 0
+
+        # Loop over all of the pages using the same cookie, otherwise
+        # the search will fail
+
+        while True:
+
+            pages += 1
+            rtype, rdata, rmsgid, serverctrls = self.ad_connection.result3(msgid)
+
+            for user in rdata:
+
+                # Entries that are no longer valid users are kept with an empty user_id so incremental
+                # synchronizations can drop them from the cache
+                ad_entries[user[0]] = ['', '']
+
+                if 'mail' in user[1]:
+
+                    email = user[1]['mail'][0].decode('utf-8').lower()
+                    user_id = email[:email.index('@')]
+                    email_domain = email[email.index('@') + 1:]
+
+                    if email_domain in self.corporate_email_domains:
+
+                        if 'cn' in user[1]:
+                            user_cn = user[1]['cn'][0].decode('utf-8').strip()
+                        else:
+                            user_cn = ''
+
+                        ad_entries[user[0]] = [user_id, user_cn]
+                        ad_users[user_id] = self.__get_user_data(user, fields)
+                        self.log.debug(f'User {user_id} information retrieved from AD')
+
+            pctrls = [c for c in serverctrls if c.controlType == SimplePagedResultsControl.controlType]
+
+            if pctrls:
+                if pctrls[0].cookie:
+                    req_ctrl.cookie = pctrls[0].cookie
+                    msgid = self.ad_connection.search_ext(base=self.ad_base,
+                                                          scope=ldap.SCOPE_SUBTREE,
+                                                          filterstr=search_flt,
+                                                          attrlist=searchreq_attrlist,
+                                                          serverctrls=[req_ctrl])
+                else:
+                    break
+            else:
+                break
+
+        return pages
+
+    def __sync_ad_users(self) -> dict:
+        sync_state = self.cache_handler.get_ad_sync_state()
+        ad_users = self.cache_handler.get_ad_cache(ignore_validity=True)
+
+        # The USN is read before searching so changes made during the search are picked up next time
+        server_state = self.__get_server_state()
+        sync_server = self.ad_server
+
+        if self.__is_full_sync_required(sync_state, server_state, ad_users):
+            self.log.info('Performing full AD synchronization')
+
+            ad_users, ad_entries = self.__search_ad_users('(objectClass=person)', self.user_fields, partitioned=True)
+
+            if 'manager' in self.user_fields:
+                ad_users = self.__update_manager_ids(ad_users, self.__get_cn_uid_pairs(ad_entries))
+
+            ad_entries = {dn: ad_entries[dn] for dn in ad_entries if ad_entries[dn][0]}
+            last_full_sync = datetime.datetime.now().isoformat()
+
+        else:
+            self.log.info(f"Performing incremental AD synchronization from USN {sync_state['usn']}")
+
+            search_flt = f"(&(objectClass=person)(uSNChanged>={sync_state['usn'] + 1}))"
+            changed_users, changed_entries = self.__search_ad_users(search_flt, self.user_fields)
+
+            ad_entries = sync_state['entries']
+            renamed_users = {}
+
+            for dn in changed_entries:
+                previous_user_id = ad_entries[dn][0] if dn in ad_entries else ''
+
+                if previous_user_id and previous_user_id != changed_entries[dn][0]:
+                    self.log.debug(f'User {previous_user_id} renamed or no longer valid, removing it from AD cache')
+                    ad_users.pop(previous_user_id, None)
+                    renamed_users[previous_user_id] = changed_entries[dn][0]
+
+                if changed_entries[dn][0]:
+                    ad_entries[dn] = changed_entries[dn]
+                else:
+                    ad_entries.pop(dn, None)
+
+            if 'manager' in self.user_fields:
+                if changed_users:
+                    changed_users = self.__update_manager_ids(changed_users, self.__get_cn_uid_pairs(ad_entries))
+
+                for user_id in ad_users:
+                    if ad_users[user_id]['manager'] in renamed_users:
+                        ad_users[user_id]['manager'] = renamed_users[ad_users[user_id]['manager']]
+
+            ad_users.update(changed_users)
+            last_full_sync = sync_state['last_full_sync']
+
+            self.log.debug(f'{len(changed_users)} changed AD user(s) merged into AD cache')
+
+        self.log.info('Users retrieved from AD server')
+
+        self.log.debug('Saving AD users to cache file')
+
+        if self.cache_handler.save_cache(ad_users=ad_users):
+            self.log.debug('AD user cache successfully saved')
+
+            if self.ad_server == sync_server:
+                self.cache_handler.save_ad_sync_state({'server': server_state['server'],
+                                                       'usn': server_state['usn'],
+                                                       'last_full_sync': last_full_sync,
+                                                       'fields': self.user_fields,
+                                                       'entries': ad_entries})
+            else:
+                # USNs of the first domain controller do not apply to the data read from the second one
+                self.log.info('AD server changed during synchronization, next synchronization will be a full one')
+                self.cache_handler.save_ad_sync_state({})
+        else:
+            self.log.debug('AD user cache could not be saved')
+
+        return ad_users
+
     def __update_manager_ids(self, ad_users: dict, cn_uid_pairs: dict) -> dict:
         self.log.debug("Converting AD manager fields to FreeIPA's user_id format")
 
@@ -171,79 +509,88 @@ class ADHandler:
 
         return ad_users
 
-    def get_ad_user(self, user_id: str) -> dict:
-        ad_users = self.cache_handler.get_ad_cache()
+    def get_ad_user(self, user_id: str, fields: list = None) -> dict:
+        if fields is None:
+            fields = self.user_fields
 
-        if ad_users:
+        if not self.cache_handler.is_cache_outdated('ad_cache'):
             self.log.info(f'Obtaining information of user {user_id} from AD cache')
-            if user_id in ad_users:
-                self.log.debug(f'User {user_id} retrieved from AD cache')
-                return ad_users[user_id]
-            else:
+            ad_user = self.cache_handler.get_ad_cache_user(user_id)
+
+            if not ad_user:
                 self.log.debug(f'User {user_id} does not exist in AD cache')
                 return None
-        else:
-            self.log.info(f'Obtaining information of user {user_id} from AD')
-            try:
-                if self.ad_connection:
-                    search_flt = f'(&(objectClass=person)(mail={user_id}*))'
+            elif all(field in ad_user for field in fields):
+                self.log.debug(f'User {user_id} retrieved from AD cache')
+                return ad_user
+            else:
+                self.log.debug(f'Requested fields for user {user_id} not kept in AD cache, querying AD')
 
-                    searchreq_attrlist = ['mail', 'sAMAccountName', 'name', 'givenName', 'sn', 'title', 'streetAddress',
-                                          'l', 'postalCode', 'st', 'telephoneNumber', 'department', 'employeeID',
-                                          'extensionAttribute6', 'msExchUserCulture', 'manager', 'memberOf']
+        self.log.info(f'Obtaining information of user {user_id} from AD')
+        try:
+            if self.ad_connection:
+                search_flt = f'(&(objectClass=person)(mail={user_id}*))'
 
-                    msgid = self.ad_connection.search_ext(base=self.ad_base,
-                                                          scope=ldap.SCOPE_SUBTREE,
-                                                          filterstr=search_flt,
-                                                          attrlist=searchreq_attrlist)
+                searchreq_attrlist = self.__get_search_attributes(fields)
 
-                    query_data = self.ad_connection.result3(msgid)[1]
+                query_data = self.__run_search(base=self.ad_base,
+                                               scope=ldap.SCOPE_SUBTREE,
+                                               filterstr=search_flt,
+                                               attrlist=searchreq_attrlist)[1]
 
-                    if query_data:
-                        user = query_data[0]
+                if query_data:
+                    user = query_data[0]
 
-                        email = user[1]['mail'][0].decode('utf-8').lower()
-                        email_domain = email[email.index('@') + 1:]
+                    email = user[1]['mail'][0].decode('utf-8').lower()
+                    email_domain = email[email.index('@') + 1:]
 
-                        if email_domain in self.corporate_email_domains:
-                            user_data = self.__get_user_data(user)
-                            self.log.info(f'User information for {user_id} retrieved from AD')
+                    if email_domain in self.corporate_email_domains:
+                        user_data = self.__get_user_data(user, fields)
+                        self.log.info(f'User information for {user_id} retrieved from AD')
 
-                            return user_data
+                        return user_data
 
-                        else:
-                            self.log.warning(f'User {user_id} skipped, email {email} not valid corporate domain')
-                            return None
                     else:
-                        self.log.warning(f'User {user_id} does not exist in AD')
+                        self.log.warning(f'User {user_id} skipped, email {email} not valid corporate domain')
                         return None
                 else:
-                    self.log.error('Could not obtain user data due to a problem with the AD connection object')
+                    self.log.warning(f'User {user_id} does not exist in AD')
                     return None
+            else:
+                self.log.error('Could not obtain user data due to a problem with the AD connection object')
+                return None
 
-            except (ldap.LDAPError,
-                    ldap.BUSY,
-                    ldap.CONNECT_ERROR,
-                    ldap.INAPPROPRIATE_AUTH,
-                    ldap.INSUFFICIENT_ACCESS,
-                    ldap.INVALID_CREDENTIALS,
-                    ldap.NO_RESULTS_RETURNED,
-                    ldap.NO_SUCH_ATTRIBUTE,
-                    ldap.NO_SUCH_OBJECT,
-                    ldap.PROTOCOL_ERROR,
-                    ldap.RESULTS_TOO_LARGE,
-                    ldap.SERVER_DOWN,
-                    ldap.SIZELIMIT_EXCEEDED,
-                    ldap.TIMELIMIT_EXCEEDED,
-                    ldap.TIMEOUT,
-                    ldap.UNAVAILABLE) as e:
+        except (ldap.LDAPError,
+                ldap.BUSY,
+                ldap.CONNECT_ERROR,
+                ldap.INAPPROPRIATE_AUTH,
+                ldap.INSUFFICIENT_ACCESS,
+                ldap.INVALID_CREDENTIALS,
+                ldap.NO_RESULTS_RETURNED,
+                ldap.NO_SUCH_ATTRIBUTE,
+                ldap.NO_SUCH_OBJECT,
+                ldap.PROTOCOL_ERROR,
+                ldap.RESULTS_TOO_LARGE,
+                ldap.SERVER_DOWN,
+                ldap.SIZELIMIT_EXCEEDED,
+                ldap.TIMELIMIT_EXCEEDED,
+                ldap.TIMEOUT,
+                ldap.UNAVAILABLE) as e:
 
-                self.log.error(f'Could not obtain user information due to a problem with the AD server: {e}')
-                return None
+            self.log.error(f'Could not obtain user information due to a problem with the AD server: {e}')
+            return None
 
-    def get_ad_users(self, force_update_cache: bool = False) -> dict:
+    def get_ad_users(self, force_update_cache: bool = False, fields: list = None) -> dict:
         self.log.info('Obtaining AD users')
-        ad_users = self.cache_handler.get_ad_cache()
+
+        if fields is None or set(fields) <= set(self.user_fields):
+            update_cache = True
+            fields = self.user_fields
+            ad_users = self.cache_handler.get_ad_cache()
+        else:
+            self.log.debug('Fields not kept in AD cache requested, querying AD without updating the cache')
+            update_cache = False
+            ad_users = None
 
         if ad_users and not force_update_cache:
 
@@ -254,76 +601,24 @@ class ADHandler:
             self.log.info('Obtaining users from AD')
             try:
                 if self.ad_connection:
-                    page_size = 1000
-                    search_flt = '(objectClass=person)'
+                    if update_cache and self.sync_mode == 'incremental':
+                        return self.__sync_ad_users()
 
-                    searchreq_attrlist = ['mail', 'sAMAccountName', 'name', 'givenName', 'sn', 'title', 'streetAddress',
-                                          'l', 'postalCode', 'st', 'telephoneNumber', 'department', 'employeeID',
-                                          'extensionAttribute6', 'msExchUserCulture', 'manager', 'cn', 'memberOf']
+                    ad_users, ad_entries = self.__search_ad_users('(objectClass=person)', fields, partitioned=True)
 
-                    req_ctrl = SimplePagedResultsControl(criticality=True, size=page_size, cookie='')
-
-                    msgid = self.ad_connection.search_ext(base=self.ad_base,
-                                                          scope=ldap.SCOPE_SUBTREE,
-                                                          filterstr=search_flt,
-                                                          attrlist=searchreq_attrlist,
-                                                          serverctrls=[req_ctrl])
-
-                    ad_users = {}
-                    cn_uid_pairs = {}
-                    pages = 0
-
-                    # Loop over all of the pages using the same cookie, otherwise
-                    # the search will fail
-
-                    while True:
-
-                        pages += 1
-                        rtype, rdata, rmsgid, serverctrls = self.ad_connection.result3(msgid)
-
-                        for user in rdata:
-
-                            if 'mail' in user[1]:
-
-                                email = user[1]['mail'][0].decode('utf-8').lower()
-                                user_id = email[:email.index('@')]
-                                email_domain = email[email.index('@') + 1:]
-
-                                if email_domain in self.corporate_email_domains:
-
-                                    if 'cn' in user[1]:
-                                        user_cn = user[1]['cn'][0].decode('utf-8').strip()
-                                        cn_uid_pairs[user_cn] = user_id
-
-                                    ad_users[user_id] = self.__get_user_data(user)
-                                    self.log.debug(f'User {user_id} information retrieved from AD')
-
-                        pctrls = [c for c in serverctrls if c.controlType == SimplePagedResultsControl.controlType]
-
-                        if pctrls:
-                            if pctrls[0].cookie:
-                                req_ctrl.cookie = pctrls[0].cookie
-                                msgid = self.ad_connection.search_ext(base=self.ad_base,
-                                                                      scope=ldap.SCOPE_SUBTREE,
-                                                                      filterstr=search_flt,
-                                                                      attrlist=searchreq_attrlist,
-                                                                      serverctrls=[req_ctrl])
-                            else:
-                                break
-                        else:
-                            break
-
-                    ad_users = self.__update_manager_ids(ad_users, cn_uid_pairs)
+                    if 'manager' in fields:
+                        ad_users = self.__update_manager_ids(ad_users, self.__get_cn_uid_pairs(ad_entries))
 
                     self.log.info('Users retrieved from AD server')
 
-                    self.log.debug('Saving AD users to cache file')
-                    save_status = self.cache_handler.save_cache(ad_users=ad_users)
+                    if update_cache:
+                        self.log.debug('Saving AD users to cache file')
+                        save_status = self.cache_handler.save_cache(ad_users=ad_users)
 
-                    if save_status:
-                        self.log.debug('AD user cache successfully saved')
-                    else:
-                        self.log.debug('AD user cache could not be saved')
+                        if save_status:
+                            self.log.debug('AD user cache successfully saved')
+                        else:
+                            self.log.debug('AD user cache could not be saved')
 
                     return ad_users
                 else:
@@ -349,3 +644,17 @@ class ADHandler:
                 self.log.error(f'Could not obtain user list due to a problem with the AD server: {e}')
 
                 return None
+
+    def reconnect(self) -> bool:
+        self.log.debug('Reopening AD connection')
+
+        if self.__ad_connection:
+            try:
+                self.__ad_connection.unbind_s()
+            except ldap.LDAPError:
+                pass
+
+        self.__ad_connection = self.__connect_to_ad()
+        self.__ad_connection_attempted = True
+
+        return self.__ad_connection is not None
@@ -13,99 +13,143 @@
 # Copyright (C) 2021  Unai Goikoetxeta
 
 import datetime
-import json
 import logging
 import os
 
+from utils.cache_store import CacheStore
+from utils.cache_store import JSONCacheStore
+from utils.cache_store import SQLiteCacheStore
+from utils.expiration_index import ExpirationIndex
+from utils.json_file import load_json_file
+from utils.json_file import save_json_file
+
 
 class CacheHandler:
 
-    def __init__(self, cache_files: dict,  cache_validity: int = 60):
+    cache_backends = ['json', 'sqlite']
+    user_caches = ['ad_cache', 'freeipa_cache']
+
+    def __init__(self, cache_files: dict,  cache_validity: int = 60, cache_backend: str = 'json'):
         self.log = logging.getLogger('freeipa_manager')
         self.cache_files = cache_files
         self.cache_validity = cache_validity
+        self.cache_backend = cache_backend
 
         self.ad_cache = None
         self.freeipa_cache = None
+        self.expiration_index = None
         self.notification_history_cache = None
         self.disabled_users_cache = None
 
-    def __check_file_validity(self, file: str) -> bool:
-        stat = os.stat(file)
-        file_time = datetime.datetime.fromtimestamp(stat.st_mtime)
+        self.cache_store = self.__get_cache_store(cache_backend)
+
+    def __check_cache_validity(self, cache_file: str) -> bool:
+        file_time = self.cache_store.get_update_time(cache_file)
         now = datetime.datetime.now()
 
         if now - datetime.timedelta(minutes=self.cache_validity) > file_time:
-            self.log.debug(f'Cache file {file} is older than {self.cache_validity} minutes')
+            self.log.debug(f'Cache {cache_file} is older than {self.cache_validity} minutes')
             return False
         else:
-            self.log.debug(f'Cache file {file} is newer than {self.cache_validity} minutes')
+            self.log.debug(f'Cache {cache_file} is newer than {self.cache_validity} minutes')
             return True
 
-    def __load_json_file(self, file_path: str) -> bool:
-        self.log.debug(f'Loading JSON file {file_path}')
-
-        try:
-            with open(file_path, 'r') as fp:
-                cache_data = json.load(fp)
-                self.log.debug(f'JSON file loaded successfully')
-                return cache_data
-
-        except json.decoder.JSONDecodeError:
-            self.log.error(f'JSON file {file_path} could not be loaded')
-            return None
-
-    def __save_json_file(self, file_path: str, data: {dict, list}) -> bool:
-        self.log.debug(f'Saving JSON file {file_path}')
-
-        try:
-            with open(file_path, 'w') as fp:
-                json.dump(data, fp)
-
-            self.log.debug(f'JSON saved successfully')
+    def __get_cache_store(self, cache_backend: str) -> CacheStore:
+        self.log.debug(f'Using {cache_backend} cache backend')
 
-            return True
-
-        except json.decoder.JSONDecodeError:
-            self.log.error(f'JSON file {file_path} could not be saved')
-            return False
+        if cache_backend == 'sqlite':
+            return SQLiteCacheStore(self.cache_files['sqlite_cache'])
+        elif cache_backend == 'json':
+            return JSONCacheStore(self.cache_files)
+        else:
+            raise ValueError(f'Unknown cache backend {cache_backend}, valid backends: {self.cache_backends}')
 
     def delete_cache(self) -> bool:
         self.log.debug('Deleting FreeIPA and AD cache files')
 
         return_value = False
 
-        if os.path.exists(self.cache_files['ad_cache']):
-            os.remove(self.cache_files['ad_cache'])
+        if self.cache_store.delete('ad_cache'):
             self.log.debug('AD cache file deleted')
             return_value = True
 
-        if os.path.exists(self.cache_files['freeipa_cache']):
-            os.remove(self.cache_files['freeipa_cache'])
+        if self.cache_store.delete('freeipa_cache'):
             self.log.debug('FreeIPA cache file deleted')
             return_value = True
 
+        # Both states are built on top of the AD cache, they must never outlive it
+        for state_file in ['ad_sync_state', 'terminated_users_state']:
+            if os.path.exists(self.cache_files[state_file]):
+                os.remove(self.cache_files[state_file])
+                self.log.debug(f'State file {state_file} deleted')
+
+        self.ad_cache = None
+        self.freeipa_cache = None
+        self.expiration_index = None
+
         if not return_value:
             self.log.warning('FreeIPA and AD cache files cannot be deleted because they do not exist')
 
         return return_value
 
-    def get_ad_cache(self) -> dict:
+    def delete_cache_users(self, cache_file: str, user_ids: list) -> bool:
+        self.log.debug(f'Removing {len(user_ids)} user(s) from cache {cache_file}')
+
+        cache_updated = self.cache_store.delete_users(cache_file, user_ids)
+
+        if cache_updated:
+            cache = self.ad_cache if cache_file == 'ad_cache' else self.freeipa_cache
+            if cache:
+                for user_id in user_ids:
+                    cache.pop(user_id, None)
+
+            if cache_file == 'freeipa_cache':
+                self.expiration_index = None
+
+        return cache_updated
+
+    def get_ad_cache(self, ignore_validity: bool = False) -> dict:
         self.log.debug('Retrieving AD cache')
 
-        if not self.is_cache_outdated('ad_cache'):
+        if ignore_validity or not self.is_cache_outdated('ad_cache'):
 
             if self.ad_cache:
                 self.log.debug('Retrieving cache from memory')
                 return self.ad_cache
             else:
-                self.log.debug('Retrieving cache from json file')
-                self.ad_cache = self.__load_json_file(self.cache_files['ad_cache'])
+                self.log.debug(f'Retrieving cache from {self.cache_backend} store')
+                self.ad_cache = self.cache_store.load('ad_cache')
                 return self.ad_cache
         else:
             self.log.debug('Cache outdated, cannot be retrieved')
             return None
 
+    def get_ad_cache_user(self, user_id: str) -> dict:
+        self.log.debug(f'Retrieving user {user_id} from AD cache')
+
+        if self.ad_cache:
+            return self.ad_cache.get(user_id)
+        else:
+            return self.cache_store.get_user('ad_cache', user_id)
+
+    def get_ad_sync_state(self) -> dict:
+        self.log.debug('Retrieving AD synchronization state')
+
+        if os.path.exists(self.cache_files['ad_sync_state']):
+            return load_json_file(self.cache_files['ad_sync_state'])
+        else:
+            self.log.debug('No AD synchronization state available')
+            return None
+
+    def get_terminated_users_state(self) -> dict:
+        self.log.debug('Retrieving terminated users state')
+
+        if os.path.exists(self.cache_files['terminated_users_state']):
+            return load_json_file(self.cache_files['terminated_users_state'])
+        else:
+            self.log.debug('No terminated users state available')
+            return None
+
     def get_disabled_expired_users_cache(self) -> list:
         self.log.debug('Retrieving disabled expired users cache')
 
@@ -116,28 +160,56 @@ class CacheHandler:
             if os.path.exists(self.cache_files['disabled_users_cache']):
                 self.log.debug('Retrieving cache from json file')
                 self.disabled_users_cache = \
-                    self.__load_json_file(self.cache_files['disabled_users_cache'])
+                    load_json_file(self.cache_files['disabled_users_cache'])
                 return self.disabled_users_cache
             else:
                 self.log.debug('No cache available, creating new one')
                 self.disabled_users_cache = []
                 return self.disabled_users_cache
 
-    def get_freeipa_cache(self) -> dict:
+    def get_cache_update_time(self, cache_file: str) -> datetime.datetime:
+        self.log.debug(f'Retrieving update time of cache {cache_file}')
+
+        return self.cache_store.get_update_time(cache_file)
+
+    def get_expiration_index(self, freeipa_users: dict) -> ExpirationIndex:
+        # Built once per version of the FreeIPA cache, any change to it drops the index
+        if self.expiration_index is None or self.expiration_index.freeipa_users is not freeipa_users:
+            self.expiration_index = ExpirationIndex(freeipa_users)
+
+        return self.expiration_index
+
+    def get_freeipa_cache(self, ignore_validity: bool = False) -> dict:
         self.log.debug('Retrieving FreeIPA cache')
 
-        if not self.is_cache_outdated('freeipa_cache'):
+        if ignore_validity or not self.is_cache_outdated('freeipa_cache'):
             if self.freeipa_cache:
                 self.log.debug('Retrieving cache from memory')
                 return self.freeipa_cache
             else:
-                self.log.debug('Retrieving cache from json file')
-                self.freeipa_cache = self.__load_json_file(self.cache_files['freeipa_cache'])
+                self.log.debug(f'Retrieving cache from {self.cache_backend} store')
+                self.freeipa_cache = self.cache_store.load('freeipa_cache')
                 return self.freeipa_cache
         else:
             self.log.debug('Cache outdated, cannot be retrieved')
             return None
 
+    def get_freeipa_cache_user(self, user_id: str) -> dict:
+        self.log.debug(f'Retrieving user {user_id} from FreeIPA cache')
+
+        if self.freeipa_cache:
+            return self.freeipa_cache.get(user_id)
+        else:
+            return self.cache_store.get_user('freeipa_cache', user_id)
+
+    def get_freeipa_cache_users(self, email: str = None, manager: str = None, group: str = None) -> dict:
+        self.log.debug('Searching users in FreeIPA cache')
+
+        if self.freeipa_cache:
+            return self.cache_store.filter_users(self.freeipa_cache, email=email, manager=manager, group=group)
+        else:
+            return self.cache_store.find_users('freeipa_cache', email=email, manager=manager, group=group)
+
     def get_notification_history_cache(self) -> dict:
         self.log.debug('Retrieving notification history cache')
 
@@ -148,7 +220,7 @@ class CacheHandler:
             if os.path.exists(self.cache_files['notification_history_cache']):
                 self.log.debug('Retrieving cache from json file')
                 self.notification_history_cache = \
-                    self.__load_json_file(self.cache_files['notification_history_cache'])
+                    load_json_file(self.cache_files['notification_history_cache'])
                 return self.notification_history_cache
             else:
                 self.log.debug('No cache available, creating new one')
@@ -159,44 +231,63 @@ class CacheHandler:
         self.log.debug(f'Verifying if cache is valid')
 
         if not cache_file:
-
-            for file in self.cache_files:
-                if file != 'notification_history_cache' and file!= 'disabled_users_cache':
-                    if os.path.exists(self.cache_files[file]):
-
-                        file_valid = self.__check_file_validity(self.cache_files[file])
-                        if not file_valid:
-                            return True
-
-                    else:
-                        self.log.warning(f'Cache file {self.cache_files[file]} does not exist')
-                        return True
-
+            cache_files = self.user_caches
         else:
             self.log.debug(f'Performing validation for cache file {cache_file}')
+            cache_files = [cache_file] if cache_file in self.user_caches else []
 
-            if cache_file != 'notification_history_cache' and cache_file != 'disabled_users_cache':
-                if os.path.exists(self.cache_files[cache_file]):
+        for file in cache_files:
+            if self.cache_store.exists(file):
 
-                    file_valid = self.__check_file_validity(self.cache_files[cache_file])
-                    if not file_valid:
-                        return True
-                else:
-                    self.log.warning(f'Cache file {self.cache_files[cache_file]} does not exist')
+                file_valid = self.__check_cache_validity(file)
+                if not file_valid:
                     return True
 
+            else:
+                self.log.warning(f'Cache {file} does not exist in the {self.cache_backend} store')
+                return True
+
         return False
 
+    def migrate_cache(self, cache_backend: str) -> bool:
+        self.log.info(f'Migrating AD and FreeIPA caches from {self.cache_backend} to {cache_backend} backend')
+
+        if cache_backend == self.cache_backend:
+            self.log.warning(f'Cache is already using the {cache_backend} backend, nothing to migrate')
+            return False
+
+        target_store = self.__get_cache_store(cache_backend)
+        return_value = []
+
+        for cache_file in self.user_caches:
+            users = self.cache_store.load(cache_file)
+
+            if users is not None:
+                # Keep the original update time so migration does not extend the cache validity
+                cache_migrated = target_store.save(cache_file, users, self.cache_store.get_update_time(cache_file))
+                self.log.debug(f'Cache {cache_file} migrated: {cache_migrated}')
+                return_value.append(cache_migrated)
+            else:
+                self.log.debug(f'Cache {cache_file} does not exist, skipping migration')
+
+        if return_value and False not in return_value:
+            self.log.info(f'Cache migrated, set cache_settings.backend to {cache_backend} to start using it')
+            return True
+        else:
+            self.log.warning('Cache could not be migrated')
+            return False
+
     def save_cache(self, ad_users: dict = None,
                    freeipa_users: dict = None,
                    notification_history: dict = None,
-                   disabled_expired_users: list = None) -> bool:
+                   disabled_expired_users: list = None,
+                   update_time: datetime.datetime = None) -> bool:
         return_value = []
 
         if ad_users:
             self.log.info('Saving AD cache')
 
-            cache_updated = self.__save_json_file(self.cache_files['ad_cache'], ad_users)
+            cache_updated = self.cache_store.save('ad_cache', ad_users, update_time)
             if cache_updated:
                 self.ad_cache = ad_users
 
@@ -205,17 +296,18 @@ class CacheHandler:
         if freeipa_users:
             self.log.info('Saving FreeIPA cache')
 
-            cache_updated = self.__save_json_file(self.cache_files['freeipa_cache'], freeipa_users)
+            cache_updated = self.cache_store.save('freeipa_cache', freeipa_users, update_time)
 
             if cache_updated:
                 self.freeipa_cache = freeipa_users
+                self.expiration_index = None
 
             return_value.append(cache_updated)
 
         if notification_history:
             self.log.info('Saving notification history cache')
 
-            cache_updated = self.__save_json_file(self.cache_files['notification_history_cache'], notification_history)
+            cache_updated = save_json_file(self.cache_files['notification_history_cache'], notification_history)
 
             if cache_updated:
                 self.notification_history_cache = notification_history
@@ -225,7 +317,7 @@ class CacheHandler:
         if disabled_expired_users:
             self.log.info('Saving expired users cache')
 
-            cache_updated = self.__save_json_file(self.cache_files['disabled_users_cache'], disabled_expired_users)
+            cache_updated = save_json_file(self.cache_files['disabled_users_cache'], disabled_expired_users)
 
             if cache_updated:
                 self.disabled_users_cache = disabled_expired_users
@@ -238,3 +330,28 @@ class CacheHandler:
             return False
         else:
             return True
+
+    def save_ad_sync_state(self, sync_state: dict) -> bool:
+        self.log.debug('Saving AD synchronization state')
+
+        return save_json_file(self.cache_files['ad_sync_state'], sync_state)
+
+    def save_terminated_users_state(self, terminated_state: dict) -> bool:
+        self.log.debug('Saving terminated users state')
+
+        return save_json_file(self.cache_files['terminated_users_state'], terminated_state)
+
+    def save_cache_users(self, cache_file: str, users: dict) -> bool:
+        self.log.debug(f'Saving {len(users)} user(s) to cache {cache_file}')
+
+        cache_updated = self.cache_store.upsert_users(cache_file, users)
+
+        if cache_updated:
+            cache = self.ad_cache if cache_file == 'ad_cache' else self.freeipa_cache
+            if cache:
+                cache.update(users)
+
+            if cache_file == 'freeipa_cache':
+                self.expiration_index = None
+
+        return cache_updated
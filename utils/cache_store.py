@@ -0,0 +1,356 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import abc
+import copy
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from utils.json_file import load_json_file
+from utils.json_file import save_json_file
+
+
+class CacheStore(abc.ABC):
+
+    backend = None
+
+    def __init__(self):
+        self.log = logging.getLogger('freeipa_manager')
+
+    @abc.abstractmethod
+    def delete(self, cache_name: str) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def delete_users(self, cache_name: str, user_ids: list) -> bool:
+        pass
+
+    def exists(self, cache_name: str) -> bool:
+        return self.get_update_time(cache_name) is not None
+
+    @staticmethod
+    def filter_users(users: dict, email: str = None, manager: str = None, group: str = None) -> dict:
+        found_users = {}
+
+        for user_id in users:
+            if email is not None and users[user_id]['email'] != email:
+                continue
+            if manager is not None and users[user_id]['manager'] != manager:
+                continue
+            if group is not None and group not in users[user_id]['member_of']:
+                continue
+            found_users[user_id] = users[user_id]
+
+        return found_users
+
+    @abc.abstractmethod
+    def find_users(self, cache_name: str, email: str = None, manager: str = None, group: str = None) -> dict:
+        pass
+
+    @abc.abstractmethod
+    def get_update_time(self, cache_name: str) -> datetime.datetime:
+        pass
+
+    @abc.abstractmethod
+    def get_user(self, cache_name: str, user_id: str) -> dict:
+        pass
+
+    @abc.abstractmethod
+    def load(self, cache_name: str) -> dict:
+        pass
+
+    @abc.abstractmethod
+    def save(self, cache_name: str, users: dict, update_time: datetime.datetime = None) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def upsert_users(self, cache_name: str, users: dict) -> bool:
+        pass
+
+
+class JSONCacheStore(CacheStore):
+
+    backend = 'json'
+
+    def __init__(self, cache_files: dict):
+        super().__init__()
+        self.cache_files = cache_files
+        self.documents = {}
+
+    def __get_file_signature(self, cache_name: str) -> tuple:
+        try:
+            file_stat = os.stat(self.cache_files[cache_name])
+
+        except FileNotFoundError:
+            return None
+
+        # Files are always replaced when saved, so a new inode also covers updates keeping the size and update time
+        return file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size
+
+    def __load_document(self, cache_name: str) -> dict:
+        file_signature = self.__get_file_signature(cache_name)
+
+        if file_signature is None:
+            return None
+
+        if cache_name in self.documents and self.documents[cache_name][0] == file_signature:
+            return self.documents[cache_name][1]
+
+        users = load_json_file(self.cache_files[cache_name])
+
+        if users is not None:
+            self.documents[cache_name] = (file_signature, users)
+
+        return users
+
+    def __save_document(self, cache_name: str, users: dict, update_time: datetime.datetime) -> bool:
+        self.documents.pop(cache_name, None)
+
+        if not save_json_file(self.cache_files[cache_name], users, update_time):
+            return False
+
+        file_signature = self.__get_file_signature(cache_name)
+
+        if file_signature is not None:
+            self.documents[cache_name] = (file_signature, users)
+
+        return True
+
+    def delete(self, cache_name: str) -> bool:
+        self.documents.pop(cache_name, None)
+
+        if os.path.exists(self.cache_files[cache_name]):
+            os.remove(self.cache_files[cache_name])
+            return True
+        else:
+            return False
+
+    def delete_users(self, cache_name: str, user_ids: list) -> bool:
+        users = self.load(cache_name)
+
+        if users is None:
+            return False
+
+        for user_id in user_ids:
+            users.pop(user_id, None)
+
+        # Patching entries must not extend the validity of the whole cache
+        return self.__save_document(cache_name, users, self.get_update_time(cache_name))
+
+    def find_users(self, cache_name: str, email: str = None, manager: str = None, group: str = None) -> dict:
+        users = self.__load_document(cache_name)
+
+        if users:
+            # The loaded document is kept for later lookups, callers get their own copy of the users
+            return copy.deepcopy(self.filter_users(users, email=email, manager=manager, group=group))
+        else:
+            return {}
+
+    def get_update_time(self, cache_name: str) -> datetime.datetime:
+        if os.path.exists(self.cache_files[cache_name]):
+            return datetime.datetime.fromtimestamp(os.stat(self.cache_files[cache_name]).st_mtime)
+        else:
+            return None
+
+    def get_user(self, cache_name: str, user_id: str) -> dict:
+        users = self.__load_document(cache_name)
+
+        if users and user_id in users:
+            return copy.deepcopy(users[user_id])
+        else:
+            return None
+
+    def load(self, cache_name: str) -> dict:
+        if os.path.exists(self.cache_files[cache_name]):
+            return load_json_file(self.cache_files[cache_name])
+        else:
+            return None
+
+    def save(self, cache_name: str, users: dict, update_time: datetime.datetime = None) -> bool:
+        # Callers keep using the saved users, the document is loaded again when needed
+        self.documents.pop(cache_name, None)
+
+        return save_json_file(self.cache_files[cache_name], users, update_time)
+
+    def upsert_users(self, cache_name: str, users: dict) -> bool:
+        cached_users = self.load(cache_name)
+
+        if cached_users is None:
+            return False
+
+        cached_users.update(copy.deepcopy(users))
+
+        return self.__save_document(cache_name, cached_users, self.get_update_time(cache_name))
+
+
+class SQLiteCacheStore(CacheStore):
+
+    backend = 'sqlite'
+
+    def __init__(self, database_file: str):
+        super().__init__()
+        self.database_file = database_file
+        self.lock = threading.Lock()
+        self.connection = self.__connect_to_database()
+
+    def __connect_to_database(self) -> sqlite3.Connection:
+        self.log.debug(f'Opening SQLite cache database {self.database_file}')
+
+        connection = sqlite3.connect(self.database_file, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS caches (cache TEXT PRIMARY KEY, updated_at REAL NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS users (cache TEXT NOT NULL, user_id TEXT NOT NULL, '
+                               'email TEXT, manager TEXT, data TEXT NOT NULL, PRIMARY KEY (cache, user_id))')
+            connection.execute('CREATE TABLE IF NOT EXISTS user_groups (cache TEXT NOT NULL, user_id TEXT NOT NULL, '
+                               'group_name TEXT NOT NULL, PRIMARY KEY (cache, user_id, group_name))')
+            connection.execute('CREATE INDEX IF NOT EXISTS users_email ON users (cache, email)')
+            connection.execute('CREATE INDEX IF NOT EXISTS users_manager ON users (cache, manager)')
+            connection.execute('CREATE INDEX IF NOT EXISTS user_groups_group ON user_groups (cache, group_name)')
+
+        return connection
+
+    @staticmethod
+    def __get_user_groups(user_data: dict) -> list:
+        if isinstance(user_data.get('member_of'), list):
+            return list(set(user_data['member_of']))
+        else:
+            return []
+
+    def __has_cache(self, cache_name: str) -> bool:
+        return self.connection.execute('SELECT 1 FROM caches WHERE cache = ?', (cache_name,)).fetchone() is not None
+
+    def __insert_user(self, cache_name: str, user_id: str, user_data: dict) -> None:
+        self.connection.execute('INSERT OR REPLACE INTO users (cache, user_id, email, manager, data) '
+                                'VALUES (?, ?, ?, ?, ?)',
+                                (cache_name, user_id, user_data.get('email', ''), user_data.get('manager', ''),
+                                 json.dumps(user_data)))
+        self.connection.execute('DELETE FROM user_groups WHERE cache = ? AND user_id = ?', (cache_name, user_id))
+        self.connection.executemany('INSERT INTO user_groups (cache, user_id, group_name) VALUES (?, ?, ?)',
+                                    [(cache_name, user_id, group) for group in self.__get_user_groups(user_data)])
+
+    def delete(self, cache_name: str) -> bool:
+        with self.lock, self.connection:
+            status = self.connection.execute('DELETE FROM caches WHERE cache = ?', (cache_name,))
+            self.connection.execute('DELETE FROM users WHERE cache = ?', (cache_name,))
+            self.connection.execute('DELETE FROM user_groups WHERE cache = ?', (cache_name,))
+
+        return status.rowcount > 0
+
+    def delete_users(self, cache_name: str, user_ids: list) -> bool:
+        try:
+            with self.lock, self.connection:
+                # Same as the JSON backend, a cache that was never saved cannot be patched
+                if not self.__has_cache(cache_name):
+                    return False
+
+                self.connection.executemany('DELETE FROM users WHERE cache = ? AND user_id = ?',
+                                            [(cache_name, user_id) for user_id in user_ids])
+                self.connection.executemany('DELETE FROM user_groups WHERE cache = ? AND user_id = ?',
+                                            [(cache_name, user_id) for user_id in user_ids])
+            return True
+
+        except sqlite3.Error as e:
+            self.log.error(f'Could not delete users from {cache_name} SQLite cache: {e}')
+            return False
+
+    def find_users(self, cache_name: str, email: str = None, manager: str = None, group: str = None) -> dict:
+        query = 'SELECT users.user_id, users.data FROM users'
+        conditions = ['users.cache = ?']
+        parameters = [cache_name]
+
+        if group is not None:
+            query += ' JOIN user_groups ON user_groups.cache = users.cache AND user_groups.user_id = users.user_id'
+            conditions.append('user_groups.group_name = ?')
+            parameters.append(group)
+        if email is not None:
+            conditions.append('users.email = ?')
+            parameters.append(email)
+        if manager is not None:
+            conditions.append('users.manager = ?')
+            parameters.append(manager)
+
+        with self.lock:
+            rows = self.connection.execute(query + ' WHERE ' + ' AND '.join(conditions), parameters).fetchall()
+
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    def get_update_time(self, cache_name: str) -> datetime.datetime:
+        with self.lock:
+            row = self.connection.execute('SELECT updated_at FROM caches WHERE cache = ?', (cache_name,)).fetchone()
+
+        if row:
+            return datetime.datetime.fromtimestamp(row[0])
+        else:
+            return None
+
+    def get_user(self, cache_name: str, user_id: str) -> dict:
+        with self.lock:
+            row = self.connection.execute('SELECT data FROM users WHERE cache = ? AND user_id = ?',
+                                          (cache_name, user_id)).fetchone()
+
+        if row:
+            return json.loads(row[0])
+        else:
+            return None
+
+    def load(self, cache_name: str) -> dict:
+        if not self.exists(cache_name):
+            return None
+
+        with self.lock:
+            rows = self.connection.execute('SELECT user_id, data FROM users WHERE cache = ?', (cache_name,)).fetchall()
+
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    def save(self, cache_name: str, users: dict, update_time: datetime.datetime = None) -> bool:
+        if not update_time:
+            update_time = datetime.datetime.now()
+
+        try:
+            with self.lock, self.connection:
+                self.connection.execute('DELETE FROM users WHERE cache = ?', (cache_name,))
+                self.connection.execute('DELETE FROM user_groups WHERE cache = ?', (cache_name,))
+
+                for user_id in users:
+                    self.__insert_user(cache_name, user_id, users[user_id])
+
+                self.connection.execute('INSERT OR REPLACE INTO caches (cache, updated_at) VALUES (?, ?)',
+                                        (cache_name, update_time.timestamp()))
+            return True
+
+        except sqlite3.Error as e:
+            self.log.error(f'Could not save {cache_name} to SQLite cache {self.database_file}: {e}')
+            return False
+
+    def upsert_users(self, cache_name: str, users: dict) -> bool:
+        try:
+            with self.lock, self.connection:
+                # Same as the JSON backend, a cache that was never saved cannot be patched
+                if not self.__has_cache(cache_name):
+                    return False
+
+                for user_id in users:
+                    self.__insert_user(cache_name, user_id, users[user_id])
+            return True
+
+        except sqlite3.Error as e:
+            self.log.error(f'Could not save users to {cache_name} SQLite cache: {e}')
+            return False
@@ -0,0 +1,224 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import datetime
+import io
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import socketserver
+import threading
+
+from utils.utils import Utils
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self) -> None:
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            output = self.server.manager_daemon.submit_command(request['args'], request['cwd'])
+
+        except (ValueError, KeyError) as e:
+            output = f'Invalid request received by the daemon: {e}\n'
+
+        self.wfile.write(json.dumps({'output': output}).encode('utf-8') + b'\n')
+
+
+class Daemon:
+
+    def __init__(self, app_utils: Utils, socket_file: str, command_runner, job_intervals: dict,
+                 connection_lifetime: int):
+        self.log = logging.getLogger('freeipa_manager')
+        self.app_utils = app_utils
+        self.socket_file = socket_file
+        self.command_runner = command_runner
+        self.job_intervals = job_intervals
+        self.connection_lifetime = connection_lifetime
+
+        # Forwarded commands are run by the main thread between scheduled jobs, so they never run at the same time
+        # and share the connections the daemon keeps open
+        self.commands = queue.Queue()
+        self.stop_event = threading.Event()
+        self.connected = True
+        self.connected_at = datetime.datetime.now()
+
+        self.jobs = {'update_cache': self.__update_cache,
+                     'update_from_ad': self.app_utils.update_user_data_from_ad,
+                     'process_terminated_users': self.app_utils.delete_terminated_users,
+                     'process_password_expirations': self.app_utils.process_password_expirations,
+                     'dispatch_mail': self.__dispatch_mail}
+
+    def __dispatch_mail(self) -> None:
+        self.app_utils.get_notifier().dispatch_mail()
+
+    def __refresh_connections(self) -> None:
+        connection_age = datetime.datetime.now() - self.connected_at
+
+        if not self.connected or connection_age > datetime.timedelta(minutes=self.connection_lifetime):
+            self.log.debug('Refreshing AD and FreeIPA connections')
+
+            self.connected = self.app_utils.reconnect()
+            self.connected_at = datetime.datetime.now()
+
+            if not self.connected:
+                self.log.warning('Could not reconnect to AD and FreeIPA servers, retrying on the next request')
+
+    def __run_command(self, command: dict) -> None:
+        self.log.info(f"Running forwarded command: {' '.join(command['args'])}")
+
+        output = io.StringIO()
+
+        self.__refresh_connections()
+
+        try:
+            parser, cli_args = self.app_utils.get_menu().generate_menu(command['args'], output)
+
+            if cli_args.daemon:
+                print('The daemon is already running', file=output)
+            else:
+                # Relative file paths given to the client are resolved from its own directory
+                self.command_runner(self.app_utils, parser, cli_args, output, command['cwd'])
+
+        except SystemExit:
+            # argparse exits after printing the help or usage errors
+            pass
+
+        except Exception as e:
+            self.log.error(f'Forwarded command failed: {e}')
+            print(f'The command failed inside the daemon: {e}', file=output)
+            self.connected = False
+
+        command['output'] = output.getvalue()
+        command['done'].set()
+
+    def __run_job(self, job: str) -> None:
+        self.log.info(f'Running scheduled job {job}')
+
+        self.__refresh_connections()
+
+        try:
+            self.jobs[job]()
+            self.log.info(f'Scheduled job {job} completed')
+            self.app_utils.log_request_metrics()
+
+        except Exception as e:
+            # A failed job must not bring the daemon down, it is retried on its next run
+            self.log.error(f'Scheduled job {job} failed: {e}')
+            self.connected = False
+
+    def __start_server(self) -> socketserver.ThreadingUnixStreamServer:
+        if os.path.exists(self.socket_file):
+            self.log.debug(f'Removing stale daemon socket {self.socket_file}')
+            os.remove(self.socket_file)
+
+        # Forwarded commands can modify FreeIPA users, only the daemon owner can send them. The socket is created
+        # with these permissions, changing them after the bind leaves a window where anybody can connect
+        previous_umask = os.umask(0o177)
+
+        try:
+            server = socketserver.ThreadingUnixStreamServer(self.socket_file, DaemonRequestHandler)
+
+        finally:
+            os.umask(previous_umask)
+
+        server.daemon_threads = True
+        server.manager_daemon = self
+
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        self.log.info(f'Daemon listening on {self.socket_file}')
+
+        return server
+
+    def __stop(self, signum, frame) -> None:
+        self.log.info(f'Signal {signum} received, stopping daemon')
+        self.stop_event.set()
+
+    def __update_cache(self) -> None:
+        self.app_utils.get_ad_handler().get_ad_users(force_update_cache=True)
+        self.app_utils.get_freeipa_handler().get_freeipa_users(force_update_cache=True)
+
+    @staticmethod
+    def send_command(socket_file: str, args: list) -> str:
+        if not os.path.exists(socket_file):
+            return None
+
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                s.connect(socket_file)
+                s.sendall(json.dumps({'args': args, 'cwd': os.getcwd()}).encode('utf-8') + b'\n')
+
+                with s.makefile('rb') as response:
+                    return json.loads(response.readline().decode('utf-8'))['output']
+
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def run(self) -> None:
+        server = self.__start_server()
+
+        signal.signal(signal.SIGTERM, self.__stop)
+        signal.signal(signal.SIGINT, self.__stop)
+
+        # Jobs first run one interval after startup, restarting the daemon must not run every job, deletions
+        # included, right away
+        next_runs = {job: datetime.datetime.now() + datetime.timedelta(minutes=self.job_intervals[job])
+                     for job in self.jobs if self.job_intervals.get(job)}
+
+        self.log.info(f"Daemon started with jobs: {', '.join(next_runs) if next_runs else 'none'}")
+
+        for job in next_runs:
+            self.log.debug(f'Scheduled job {job} first run at {next_runs[job]}')
+
+        while not self.stop_event.is_set():
+            for job in next_runs:
+                if self.stop_event.is_set():
+                    break
+
+                if next_runs[job] <= datetime.datetime.now():
+                    self.__run_job(job)
+                    next_runs[job] = datetime.datetime.now() + datetime.timedelta(minutes=self.job_intervals[job])
+
+            try:
+                command = self.commands.get(timeout=1)
+
+            except queue.Empty:
+                continue
+
+            self.__run_command(command)
+
+        server.shutdown()
+        server.server_close()
+
+        while not self.commands.empty():
+            command = self.commands.get()
+            command['output'] = 'The daemon stopped before running the command\n'
+            command['done'].set()
+
+        if os.path.exists(self.socket_file):
+            os.remove(self.socket_file)
+
+        self.log.info('Daemon stopped')
+
+    def submit_command(self, args: list, cwd: str) -> str:
+        command = {'args': args, 'cwd': cwd, 'output': None, 'done': threading.Event()}
+
+        self.commands.put(command)
+        command['done'].wait()
+
+        return command['output']
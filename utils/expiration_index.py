@@ -0,0 +1,67 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import bisect
+import datetime
+import logging
+
+
+class ExpirationIndex:
+
+    def __init__(self, freeipa_users: dict):
+        self.log = logging.getLogger('freeipa_manager')
+        self.freeipa_users = freeipa_users
+        self.expirations = {}
+
+        # Expirations cluster on the same days, each day is only parsed once
+        days = {}
+
+        for user_id in freeipa_users:
+            krbpasswordexpiration = freeipa_users[user_id].get('krbpasswordexpiration')
+
+            if not krbpasswordexpiration:
+                continue
+
+            day = krbpasswordexpiration[0]['__datetime__'][:8]
+
+            if day not in days:
+                days[day] = self.__parse_day(day)
+
+            self.expirations[user_id] = days[day]
+
+        # Users sorted by expiration day, a range of days is found with two binary searches
+        self.user_ids = sorted(self.expirations, key=self.expirations.get)
+        self.days = [self.expirations[user_id] for user_id in self.user_ids]
+
+        self.log.debug(f'Password expiration index built with {len(self.user_ids)} user(s)')
+
+    @staticmethod
+    def __parse_day(day: str) -> int:
+        # Slicing the generalized time is much cheaper than strptime, only the day matters
+        return datetime.date(int(day[:4]), int(day[4:6]), int(day[6:8])).toordinal()
+
+    def get_expiration(self, user_id: str) -> (int, datetime.date):
+        if user_id not in self.expirations:
+            return None
+
+        return self.expirations[user_id] - datetime.date.today().toordinal(), \
+            datetime.date.fromordinal(self.expirations[user_id])
+
+    def get_users_expiring(self, min_days: int = None, max_days: int = None) -> dict:
+        today = datetime.date.today().toordinal()
+
+        start = 0 if min_days is None else bisect.bisect_left(self.days, today + min_days)
+        end = len(self.days) if max_days is None else bisect.bisect_right(self.days, today + max_days)
+
+        return {self.user_ids[i]: self.days[i] - today for i in range(start, end)}
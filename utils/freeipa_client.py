@@ -0,0 +1,246 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+import python_freeipa
+from python_freeipa import exceptions as freeipa_exceptions
+import requests
+from requests.exceptions import ConnectionError
+from requests.exceptions import RequestException
+from urllib3.exceptions import ConnectTimeoutError
+
+from utils.replica_router import ReplicaRouter
+from utils.request_throttle import RequestThrottle
+
+
+class FreeIPAClient(python_freeipa.ClientMeta):
+
+    session_cookie = 'ipa_session'
+
+    # Used when the server does not send an expiration date with the session cookie
+    session_lifetime = 20
+
+    read_methods = ('_find', '_show', 'ping')
+
+    def __init__(self, hosts: list, session_file: str, login_method: str = 'password', username: str = None,
+                 password: str = None, keytab: str = None, request_throttle: RequestThrottle = None,
+                 replica_router: ReplicaRouter = None):
+        super().__init__(hosts[0])
+        # The client log property belongs to python_freeipa, which logs request parameters including passwords
+        self.app_log = logging.getLogger('freeipa_manager')
+        self.hosts = hosts
+        self.session_file = session_file
+        self.login_method = login_method
+        self.username = username
+        self.password = password
+        self.keytab = keytab
+        self.request_throttle = request_throttle
+        self.replica_router = replica_router or ReplicaRouter(hosts)
+        self.login_lock = threading.Lock()
+
+        # FreeIPA sessions are only valid on the server that opened them, each server gets its own
+        self.host_sessions = {}
+
+    @staticmethod
+    def __is_failover_error(error: Exception, read_only: bool) -> bool:
+        if read_only:
+            return isinstance(error, RequestException) or \
+                (type(error) is freeipa_exceptions.FreeIPAError and 500 <= (error.code or 0) < 600)
+        else:
+            # Changes are only sent again when no connection could be opened. A connection lost once the request
+            # was sent, such as a RemoteDisconnected error, may come from a server that already applied the change
+            return isinstance(error, ConnectionError) and bool(error.args) and \
+                isinstance(getattr(error.args[0], 'reason', error.args[0]), ConnectTimeoutError)
+
+    def __is_read_request(self, method: str, args: list) -> bool:
+        if method == 'batch':
+            return bool(args) and all(command['method'].endswith(self.read_methods) for command in args)
+        else:
+            return method.endswith(self.read_methods)
+
+    def __get_session_owner(self) -> str:
+        if self.login_method == 'kerberos':
+            return f'kerberos:{self.keytab or ""}@{self._host}'
+        else:
+            return f'password:{self.username}@{self._host}'
+
+    def __load_session(self) -> bool:
+        session = self.__load_sessions().get(self.__get_session_owner())
+
+        if not session:
+            self.app_log.debug(f'No stored FreeIPA session available for server {self._host}')
+            return False
+
+        if session.get('expires', 0) <= datetime.datetime.now().timestamp():
+            self.app_log.debug(f'Stored FreeIPA session for server {self._host} expired')
+            return False
+
+        self._session.cookies.set(self.session_cookie, session['cookie'], domain=session['domain'],
+                                  path=session['path'], secure=True)
+
+        self.app_log.debug(f'Reusing stored FreeIPA session for server {self._host}')
+        return True
+
+    def __load_sessions(self) -> dict:
+        try:
+            with open(self.session_file, 'r') as fp:
+                sessions = json.load(fp)
+
+        except (OSError, json.decoder.JSONDecodeError):
+            return {}
+
+        now = datetime.datetime.now().timestamp()
+
+        return {owner: sessions[owner] for owner in sessions
+                if isinstance(sessions[owner], dict) and sessions[owner].get('expires', 0) > now}
+
+    def __login(self) -> None:
+        if self.login_method == 'kerberos':
+            if self.keytab:
+                # GSSAPI acquires the initial ticket from the client keytab, no password is sent to the server
+                os.environ['KRB5_CLIENT_KTNAME'] = self.keytab
+
+            self.login_kerberos()
+        else:
+            self.login(self.username, self.password)
+
+        self.__save_session()
+
+    def __save_session(self) -> None:
+        cookie = next((c for c in self._session.cookies if c.name == self.session_cookie), None)
+
+        if cookie is None:
+            self.app_log.debug('FreeIPA server did not return a session cookie, it will not be stored')
+            return
+
+        expires = cookie.expires or \
+            (datetime.datetime.now() + datetime.timedelta(minutes=self.session_lifetime)).timestamp()
+
+        sessions = self.__load_sessions()
+        sessions[self.__get_session_owner()] = {'cookie': cookie.value,
+                                                'domain': cookie.domain,
+                                                'path': cookie.path,
+                                                'expires': expires}
+
+        temp_file = f'{self.session_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+        try:
+            # The session cookie grants admin access to FreeIPA, only the app owner can read it
+            with os.fdopen(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as fp:
+                json.dump(sessions, fp)
+
+            os.replace(temp_file, self.session_file)
+            self.app_log.debug(f'FreeIPA session for server {self._host} stored until '
+                               f'{datetime.datetime.fromtimestamp(expires)}')
+
+        except OSError as e:
+            self.app_log.warning(f'FreeIPA session could not be stored: {e}')
+
+    def __send_request(self, method, args, params):
+        read_only = self.__is_read_request(method, args)
+        failed_hosts = set()
+
+        while True:
+            host = self.replica_router.select_host(read_only, failed_hosts)
+
+            failed = False
+            start = time.monotonic()
+
+            try:
+                self.__use_host(host)
+                return self.__send_throttled_request(method, args, params)
+
+            except (RequestException, freeipa_exceptions.FreeIPAError) as e:
+                failed = self.__is_failover_error(e, True)
+
+                if not self.__is_failover_error(e, read_only):
+                    raise
+
+                self.replica_router.mark_host_down(host)
+                failed_hosts.add(host)
+
+                if len(failed_hosts) >= len(self.hosts):
+                    raise
+
+            finally:
+                self.replica_router.finish_request(host, time.monotonic() - start, failed)
+
+    def __send_throttled_request(self, method, args, params):
+        if not self.request_throttle:
+            return super()._request(method, args, params)
+
+        self.request_throttle.acquire()
+
+        failed = False
+        start = time.monotonic()
+
+        try:
+            return super()._request(method, args, params)
+
+        except (RequestException, freeipa_exceptions.FreeIPAError) as e:
+            # API errors such as NotFound are answers, only server errors signal an overloaded server
+            failed = self.__is_failover_error(e, True)
+            raise
+
+        finally:
+            self.request_throttle.release(method, time.monotonic() - start, failed)
+
+    def __use_host(self, host: str) -> None:
+        new_host = host not in self.host_sessions
+
+        if new_host:
+            self.host_sessions[host] = requests.Session()
+
+        self._host = host
+        self._current_host = host
+        self._session = self.host_sessions[host]
+
+        if new_host and not self.__load_session():
+            try:
+                self.__login()
+
+            except (RequestException, freeipa_exceptions.FreeIPAError):
+                self.host_sessions.pop(host)
+                raise
+
+    def _request(self, method, args=None, params=None):
+        try:
+            return self.__send_request(method, args, params)
+
+        except freeipa_exceptions.Unauthorized:
+            self.app_log.debug(f'FreeIPA session rejected by server {self._host} on {method} request, logging in again')
+
+        with self.login_lock:
+            self._session.cookies.clear()
+            self.__login()
+
+        return self.__send_request(method, args, params)
+
+    def open_session(self) -> None:
+        for host in self.hosts:
+            try:
+                self.__use_host(host)
+                return
+
+            except RequestException:
+                self.replica_router.mark_host_down(host)
+
+                if host == self.hosts[-1]:
+                    raise
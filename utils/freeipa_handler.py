@@ -18,35 +18,94 @@ import logging
 import os
 import secrets
 import string
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import python_freeipa
+import ldap
+import ldap.sasl
+from ldap.controls import SimplePagedResultsControl
 from python_freeipa import exceptions as freeipa_exceptions
 from requests.exceptions import ConnectionError
 from urllib3.exceptions import NewConnectionError
 from urllib3.exceptions import TimeoutError
 
 from utils.cache_handler import CacheHandler
+from utils.expiration_index import ExpirationIndex
+from utils.freeipa_client import FreeIPAClient
+from utils.health_monitor import HealthMonitor
+from utils.replica_router import ReplicaRouter
+from utils.request_throttle import RequestThrottle
+from utils.sync_plan import SyncPlan
 
 
 class FreeIPAHandler:
 
+    ldap_user_attributes = ['uid', 'mail', 'krbPrincipalName', 'krbCanonicalName', 'cn', 'givenName', 'sn', 'title',
+                            'street', 'l', 'st', 'postalCode', 'ou', 'employeeNumber', 'employeeType',
+                            'preferredLanguage', 'telephoneNumber', 'manager', 'krbPasswordExpiration',
+                            'krbLastPwdChange']
+
+    user_fields = ['email', 'alias', 'full_name', 'name', 'lastname', 'job_title', 'street_address', 'city', 'state',
+                   'zip_code', 'org_unit', 'employee_number', 'employee_type', 'preferred_language', 'phone_number',
+                   'manager', 'member_of', 'krbpasswordexpiration', 'krblastpwdchange']
+
     def __init__(self, freeipa_credentials: dict, freeipa_gids: dict, cache_handler: CacheHandler, csv_files: dict,
-                 password_gracious_period: int):
+                 password_gracious_period: int, batch_size: int = 100, fetch_mode: str = 'parallel',
+                 fetch_workers: int = 4, update_workers: int = 4, search_size_limit: int = 0,
+                 refresh_mode: str = 'full', ldap_settings: dict = None, read_engine: str = 'jsonrpc',
+                 session_file: str = None, throttle_settings: dict = None, health_monitor: HealthMonitor = None,
+                 sync_plan: SyncPlan = None):
         self.log = logging.getLogger('freeipa_manager')
         self.freeipa_credentials = freeipa_credentials
+        self.session_file = session_file
         self.cache_handler = cache_handler
         self.freeipa_gids = freeipa_gids
         self.csv_files = csv_files
         self.password_gracious_period = password_gracious_period
-        self.freeipa_connection = self.__connect_to_freeipa()
-
-    def __connect_to_freeipa(self) -> python_freeipa.ClientMeta:
+        self.batch_size = batch_size
+        self.fetch_mode = fetch_mode
+        self.fetch_workers = fetch_workers
+        self.update_workers = update_workers
+        self.search_size_limit = search_size_limit
+        self.refresh_mode = refresh_mode
+        self.ldap_settings = ldap_settings
+        self.read_engine = read_engine
+        self.sync_plan = sync_plan
+        self.health_monitor = health_monitor
+        self.thread_data = threading.local()
+        self.freeipa_ldap_connection = None
+
+        # Shared by every FreeIPA session of the process, including the ones opened by worker threads
+        self.request_throttle = RequestThrottle(**throttle_settings) if throttle_settings else None
+        self.freeipa_hosts = [freeipa_credentials['host']] + (freeipa_credentials.get('replicas') or [])
+        self.replica_router = ReplicaRouter(self.freeipa_hosts, health_monitor)
+
+        # The FreeIPA session is opened on first use, so cache-only work never logs into the server
+        self.__freeipa_connection = None
+        self.__freeipa_connection_attempted = False
+
+    @property
+    def freeipa_connection(self) -> FreeIPAClient:
+        if not self.__freeipa_connection_attempted:
+            self.__freeipa_connection_attempted = True
+            self.__freeipa_connection = self.__connect_to_freeipa()
+
+        return self.__freeipa_connection
+
+    def __connect_to_freeipa(self) -> FreeIPAClient:
         self.log.debug('Connecting to FreeIPA server')
 
         try:
-            freeipa_client = python_freeipa.ClientMeta(self.freeipa_credentials['host'])
+            freeipa_client = FreeIPAClient(self.freeipa_hosts,
+                                           session_file=self.session_file,
+                                           login_method=self.freeipa_credentials.get('login_method', 'password'),
+                                           username=self.freeipa_credentials['username'],
+                                           password=self.freeipa_credentials['password'],
+                                           keytab=self.freeipa_credentials.get('keytab'),
+                                           request_throttle=self.request_throttle,
+                                           replica_router=self.replica_router)
 
-            freeipa_client.login(self.freeipa_credentials['username'], self.freeipa_credentials['password'])
+            freeipa_client.open_session()
 
             self.log.debug('Connection established')
 
@@ -60,11 +119,66 @@ class FreeIPAHandler:
                 freeipa_exceptions.FreeIPAError,
                 freeipa_exceptions.NotFound,
                 freeipa_exceptions.Unauthorized,
-                freeipa_exceptions.UserLocked) as e:
+                freeipa_exceptions.UserLocked,
+                ImportError) as e:
 
-            self.log.error(f"Could not connect to FreeIPA server {self.freeipa_credentials['host']}: {e}")
+            self.log.error(f"Could not connect to FreeIPA servers {', '.join(self.freeipa_hosts)}: {e}")
             return None
 
+    def __connect_to_freeipa_ldap(self) -> ldap.ldapobject:
+        self.log.debug('Connecting to FreeIPA LDAP server')
+
+        # libldap tries the servers of the list in order until one answers
+        ldap_server = ' '.join(f"{self.ldap_settings['proto']}{host}:{self.ldap_settings['port']}"
+                               for host in self.freeipa_hosts)
+        bind_dn = f"uid={self.freeipa_credentials['username']},cn=users,cn=accounts,{self.ldap_settings['base']}"
+
+        try:
+            ldap_client = ldap.initialize(ldap_server)
+            ldap_client.set_option(ldap.OPT_REFERRALS, 0)
+
+            if self.ldap_settings['bind'] == 'gssapi':
+                ldap_client.sasl_interactive_bind_s('', ldap.sasl.gssapi())
+            else:
+                ldap_client.simple_bind_s(bind_dn, self.freeipa_credentials['password'])
+
+            self.log.debug('Connection established')
+
+            if self.health_monitor:
+                self.health_monitor.record('freeipa_ldap', True)
+
+            return ldap_client
+
+        except (ldap.BUSY,
+                ldap.CONNECT_ERROR,
+                ldap.INAPPROPRIATE_AUTH,
+                ldap.INSUFFICIENT_ACCESS,
+                ldap.INVALID_CREDENTIALS,
+                ldap.PROTOCOL_ERROR,
+                ldap.SERVER_DOWN,
+                ldap.TIMEOUT,
+                ldap.UNAVAILABLE) as e:
+
+            self.log.error(f'Could not connect to FreeIPA LDAP server {ldap_server}: {e}')
+
+            # Refreshes skip the LDAP server while it is marked as down instead of failing on every one
+            if self.health_monitor:
+                self.health_monitor.record('freeipa_ldap', False)
+
+            return None
+
+    def __is_freeipa_ldap_available(self) -> bool:
+        if not self.ldap_settings or not self.ldap_settings.get('base'):
+            self.log.debug('FreeIPA LDAP server not configured')
+            return False
+
+        if self.freeipa_ldap_connection is None and self.health_monitor and \
+                self.health_monitor.get_status('freeipa_ldap') is False:
+            self.log.debug('FreeIPA LDAP server marked as down')
+            return False
+
+        return True
+
     def __is_user_preserved(self, user_id: str) -> bool:
         self.log.debug(f'Checking if user {user_id} account is preserved')
 
@@ -88,27 +202,44 @@ class FreeIPAHandler:
             self.log.error(f'Could not check if user is preserved due to a problem with the FreeIPA server: {e}')
             return None
 
-    def __generate_alias(self, name: str, lastname: str) -> str:
-        self.log.debug(f'Generating user alias for {name} {lastname}')
+    def __generate_aliases(self, user_names: dict) -> dict:
+        self.log.debug(f'Generating user aliases for {len(user_names)} user(s)')
 
-        alias = name[:1].lower() + lastname.lower()
+        candidates = {}
+        counters = {}
+        aliases = {}
 
-        valid_alias = False
-        counter = 1
+        for user_id in user_names:
+            name, lastname = user_names[user_id]
+            candidates[user_id] = name[:1].lower() + lastname.lower()
+            counters[user_id] = 1
 
-        while valid_alias is False:
+        # Probe all the pending candidates in a single batch per round, the same alias cannot be
+        # handed out twice within an import
+        while candidates:
+            pending_users = list(candidates)
+            commands = [self.__get_batch_command('user_find', [], {'krbprincipalname': candidates[user_id],
+                                                                    'pkey_only': True})
+                        for user_id in pending_users]
 
-            query_data = self.freeipa_connection.user_find(o_krbprincipalname=alias)
+            for user_id, result in zip(pending_users, self.__run_batch(commands)):
+                alias = candidates[user_id]
 
-            if query_data['count'] == 0:
-                valid_alias = True
-            else:
-                alias = alias + str(counter)
-                counter += 1
+                if result.get('error'):
+                    self.log.warning(f"Could not generate alias for user {user_id}: {result['error']}")
+                    aliases[user_id] = None
+                    candidates.pop(user_id)
+
+                elif result['count'] == 0 and alias not in aliases.values():
+                    self.log.debug(f'Alias for user {user_id} will be {alias}')
+                    aliases[user_id] = alias
+                    candidates.pop(user_id)
 
-        self.log.debug(f'Alias for user will be {alias}')
+                else:
+                    candidates[user_id] = alias + str(counters[user_id])
+                    counters[user_id] += 1
 
-        return alias
+        return aliases
 
     def __generate_password(self, length=15) -> str:
         self.log.debug(f'Generating random password')
@@ -118,12 +249,323 @@ class FreeIPAHandler:
 
         return new_password
 
+    @staticmethod
+    def __get_batch_command(method: str, args: list, options: dict = None) -> dict:
+        return {'method': method, 'params': [args, options or {}]}
+
+    def __get_create_commands(self, user_id: str, email: str, name: str, lastname: str, user_group: str,
+                              full_name: str, alias: str, password: str, job_title: str = '',
+                              street_address: str = '', city: str = '', state: str = '', zip_code: str = '',
+                              org_unit: str = '', phone_number: str = '', employee_number: str = '',
+                              employee_type: str = '', preferred_language: str = '', manager: str = '') -> list:
+
+        user_add_options = {'givenname': name,
+                            'sn': lastname,
+                            'cn': full_name,
+                            'mail': email,
+                            'displayname': full_name,
+                            'gecos': full_name,
+                            'title': job_title,
+                            'street': street_address,
+                            'l': city,
+                            'st': state,
+                            'postalcode': zip_code,
+                            'ou': org_unit,
+                            'employeenumber': employee_number,
+                            'employeetype': employee_type,
+                            'preferredlanguage': preferred_language,
+                            'telephonenumber': phone_number,
+                            'manager': manager,
+                            'gidnumber': str(self.freeipa_gids[user_group]),
+                            'homedirectory': f'/home/{alias}',
+                            'userpassword': password,
+                            'noprivate': True}
+
+        return [self.__get_batch_command('user_add', [user_id], user_add_options),
+                self.__get_batch_command('user_add_principal', [user_id, alias]),
+                self.__get_batch_command('group_add_member', [user_group], {'user': [user_id]})]
+
+    def __get_changed_user_ids(self, since: datetime.datetime) -> set:
+        # modifyTimestamp is compared by the FreeIPA server, allow for clock skew between both hosts
+        timestamp = (since - datetime.timedelta(minutes=5)).astimezone(datetime.timezone.utc).strftime('%Y%m%d%H%M%SZ')
+
+        self.log.debug(f'Obtaining FreeIPA users modified since {timestamp}')
+
+        query_data = self.__search_ldap(f"cn=users,cn=accounts,{self.ldap_settings['base']}",
+                                        f'(&(objectClass=posixAccount)(modifyTimestamp>={timestamp}))', ['uid'])
+
+        if query_data is None:
+            return None
+
+        return {user[1]['uid'][0].decode('utf-8') for user in query_data if 'uid' in user[1]}
+
+    def __get_delta_users(self) -> dict:
+        cached_users = self.cache_handler.get_freeipa_cache(ignore_validity=True)
+        last_update = self.cache_handler.get_cache_update_time('freeipa_cache')
+
+        if not cached_users or not last_update:
+            self.log.debug('No previous FreeIPA cache available, a full refresh is required')
+            return None
+
+        try:
+            changed_user_ids = self.__get_changed_user_ids(last_update)
+
+            if changed_user_ids is None:
+                self.log.warning('Could not obtain modified FreeIPA users, falling back to a full refresh')
+                return None
+
+            managed_user_ids = self.__get_managed_user_ids()
+
+            if managed_user_ids is None:
+                self.log.warning('Could not obtain the full FreeIPA user list, falling back to a full refresh')
+                return None
+
+            refresh_user_ids = [user_id for user_id in managed_user_ids
+                                if user_id not in cached_users or user_id in changed_user_ids]
+
+            updated_users, removed_user_ids = self.__show_users(refresh_user_ids)
+
+        except (ldap.LDAPError,
+                freeipa_exceptions.FreeIPAError) as e:
+
+            self.log.warning(f'FreeIPA delta refresh failed, falling back to a full refresh: {e}')
+            return None
+
+        freeipa_users = {user_id: cached_users[user_id] for user_id in cached_users
+                         if user_id in managed_user_ids and user_id not in removed_user_ids}
+        freeipa_users.update(updated_users)
+
+        removed_users = [user_id for user_id in cached_users if user_id not in freeipa_users]
+
+        self.log.info(f'FreeIPA delta refresh: {len(updated_users)} user(s) updated, '
+                      f'{len(removed_users)} user(s) removed')
+
+        return freeipa_users
+
+    def __get_full_users(self) -> dict:
+        freeipa_users = {}
+        users = None
+
+        if self.read_engine == 'ldap' and self.__is_freeipa_ldap_available():
+            try:
+                users = self.__get_ldap_users()
+
+                if users is None:
+                    self.log.warning('Could not read users from the FreeIPA LDAP server, falling back to JSON-RPC')
+
+            except ldap.LDAPError as e:
+                self.log.warning(f'Could not read users from the FreeIPA LDAP server, falling back to JSON-RPC: {e}')
+
+        if users is None and self.fetch_mode == 'combined':
+            users = self.__get_managed_users()
+
+        if users is None:
+            workers = max(1, min(self.fetch_workers, len(self.freeipa_gids)))
+            self.log.debug(f'Obtaining users of {len(self.freeipa_gids)} groups with {workers} workers')
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                group_users = list(executor.map(self.__get_group_users, self.freeipa_gids))
+
+            users = [user for group in group_users for user in group]
+
+        for user in users:
+
+            user_id = user['uid'][0]
+
+            # Users belonging to several managed groups are returned once per group
+            if user_id not in freeipa_users:
+                freeipa_users[user_id] = self.__get_user_data(user)
+                self.log.debug(f'Information for user {user_id} retrieved from FreeIPA')
+
+        return freeipa_users
+
+    def __get_group_user_ids(self, group: str) -> list:
+        self.log.debug(f'Obtaining user IDs of group {group} from FreeIPA')
+
+        group_data = self.__get_thread_connection().user_find(o_in_group=group, o_preserved=False, o_pkey_only=True,
+                                                               o_sizelimit=self.search_size_limit)
+
+        # A truncated listing would make the delta refresh drop existing users from cache
+        if group_data.get('truncated'):
+            self.log.warning(f'FreeIPA truncated the user ID list of group {group}')
+            return None
+
+        return [user['uid'][0] for user in group_data['result']]
+
+    def __get_group_users(self, group: str) -> list:
+        self.log.debug(f'Obtaining users of group {group} from FreeIPA')
+
+        group_data = self.__get_thread_connection().user_find(o_in_group=group, o_preserved=False,
+                                                               o_sizelimit=self.search_size_limit)
+
+        if group_data.get('truncated'):
+            self.log.warning(f'FreeIPA truncated the user list of group {group}, review the server search size limit')
+
+        return group_data['result']
+
+    def __get_managed_users(self) -> list:
+        self.log.debug('Obtaining users of all managed groups from FreeIPA in a single search')
+
+        query_data = self.freeipa_connection.user_find(o_preserved=False, o_sizelimit=self.search_size_limit)
+
+        if query_data.get('truncated'):
+            self.log.warning('FreeIPA truncated the combined user search, falling back to per group searches')
+            return None
+
+        return [user for user in query_data['result']
+                if any(group in self.freeipa_gids for group in user.get('memberof_group', []))]
+
+    def __get_ldap_users(self) -> list:
+        self.log.debug('Obtaining users of all managed groups from the FreeIPA LDAP server')
+
+        base = self.ldap_settings['base']
+
+        group_data = self.__search_ldap(f'cn=groups,cn=accounts,{base}', '(objectClass=groupOfNames)',
+                                        ['cn', 'member'])
+        user_data = self.__search_ldap(f'cn=users,cn=accounts,{base}', '(objectClass=posixAccount)',
+                                       self.ldap_user_attributes)
+
+        if group_data is None or user_data is None:
+            return None
+
+        # memberof_group only holds direct memberships, which are only available from the group entries
+        user_groups = {}
+
+        for group in group_data:
+            for member in group[1].get('member', []):
+                user_groups.setdefault(member.decode('utf-8').lower(), []).append(group[1]['cn'][0].decode('utf-8'))
+
+        users = []
+
+        for user in user_data:
+            groups = user_groups.get(user[0].lower(), [])
+
+            if any(group in self.freeipa_gids for group in groups):
+                users.append(self.__get_ldap_user(user, groups))
+
+        self.log.debug(f'{len(users)} users of managed groups read from {len(user_data)} FreeIPA LDAP entries')
+
+        return users
+
+    @staticmethod
+    def __get_ldap_user(user, groups: list) -> dict:
+        # Translate the LDAP entry into the JSON-RPC representation understood by __get_user_data
+        ldap_user = {}
+
+        for attribute in user[1]:
+            ldap_user[attribute.lower()] = [value.decode('utf-8') for value in user[1][attribute]]
+
+        for attribute in ['krbpasswordexpiration', 'krblastpwdchange']:
+            if attribute in ldap_user:
+                ldap_user[attribute] = [{'__datetime__': value} for value in ldap_user[attribute]]
+
+        if 'krbprincipalname' in ldap_user and 'krbcanonicalname' in ldap_user:
+            canonical_name = ldap_user['krbcanonicalname'][0]
+            ldap_user['krbprincipalname'] = [canonical_name] + [principal for principal in ldap_user['krbprincipalname']
+                                                                if principal != canonical_name]
+
+        if 'manager' in ldap_user:
+            ldap_user['manager'] = [manager[4:manager.index(',')] for manager in ldap_user['manager']]
+
+        ldap_user['memberof_group'] = groups
+
+        return ldap_user
+
+    def __get_managed_user_ids(self) -> set:
+        workers = max(1, min(self.fetch_workers, len(self.freeipa_gids)))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            group_user_ids = list(executor.map(self.__get_group_user_ids, self.freeipa_gids))
+
+        if None in group_user_ids:
+            return None
+
+        return {user_id for group in group_user_ids for user_id in group}
+
+    def __get_preserved_user_ids(self) -> set:
+        self.log.debug('Obtaining preserved FreeIPA accounts')
+
+        query_data = self.freeipa_connection.user_find(o_preserved=True, o_pkey_only=True, o_sizelimit=0)
+
+        return {user['uid'][0] for user in query_data['result']}
+
+    def __get_update_commands(self, user_id: str, user: dict, email: str = None, name: str = None,
+                              lastname: str = None, full_name: str = None, initials: str = None,
+                              user_group: str = None, job_title: str = None, street_address: str = None,
+                              city: str = None, state: str = None, zip_code: str = None, org_unit: str = None,
+                              phone_number: str = None, employee_number: str = None, employee_type: str = None,
+                              preferred_language: str = None, manager: str = None,
+                              home_directory: str = None) -> list:
+
+        if name and lastname:
+            if not full_name:
+                full_name = f'{name} {lastname}'
+            if not initials:
+                initials = name[:1] + lastname[:1]
+
+        elif name:
+            if not full_name:
+                full_name = f"{name} {user['lastname']}"
+            if not initials:
+                initials = name[:1] + user['lastname'][:1]
+
+        elif lastname:
+            if not full_name:
+                full_name = f"{user['name']} {lastname}"
+            if not initials:
+                initials = user['name'][:1] + lastname[:1]
+
+        user_mod_options = {'mail': email,
+                            'givenname': name,
+                            'sn': lastname,
+                            'title': job_title,
+                            'street': street_address,
+                            'l': city,
+                            'st': state,
+                            'postalcode': zip_code,
+                            'ou': org_unit,
+                            'telephonenumber': phone_number,
+                            'employeenumber': employee_number,
+                            'employeetype': employee_type,
+                            'preferredlanguage': preferred_language,
+                            'displayname': full_name,
+                            'cn': full_name,
+                            'gecos': full_name,
+                            'initials': initials,
+                            'manager': manager,
+                            'homedirectory': home_directory}
+        user_mod_options = {key: value for key, value in user_mod_options.items() if value is not None}
+
+        commands = []
+
+        if user_mod_options:
+            commands.append(self.__get_batch_command('user_mod', [user_id], user_mod_options))
+
+        if user_group is not None and user_group not in user['member_of']:
+            for group in user['member_of']:
+                if group in self.freeipa_gids:
+                    commands.append(self.__get_batch_command('group_remove_member', [group], {'user': [user_id]}))
+
+            commands.append(self.__get_batch_command('group_add_member', [user_group], {'user': [user_id]}))
+
+        return commands
+
+    def __get_thread_connection(self) -> FreeIPAClient:
+        if threading.current_thread() is threading.main_thread():
+            return self.freeipa_connection
+
+        # Worker threads cannot share the HTTP session of the main connection, each one opens its own
+        if getattr(self.thread_data, 'freeipa_connection', None) is None:
+            self.thread_data.freeipa_connection = self.__connect_to_freeipa()
+
+            if self.thread_data.freeipa_connection is None:
+                raise freeipa_exceptions.FreeIPAError(message='Could not open a FreeIPA session for worker thread')
+
+        return self.thread_data.freeipa_connection
+
     @staticmethod
     def __get_user_data(user) -> dict:
-        user_data = {'email': '', 'alias': '', 'full_name': '', 'name': '', 'lastname': '', 'job_title': '',
-                     'street_address': '', 'city': '', 'state': '', 'zip_code': '', 'org_unit': '',
-                     'employee_number': '', 'employee_type': '', 'preferred_language': '', 'phone_number': '',
-                     'manager': '', 'member_of': '', 'krbpasswordexpiration': '', 'krblastpwdchange': ''}
+        user_data = dict.fromkeys(FreeIPAHandler.user_fields, '')
 
         if 'mail' in user:
             user_data['email'] = user['mail'][0]
@@ -169,6 +611,285 @@ class FreeIPAHandler:
 
         return user_data
 
+    @staticmethod
+    def __get_import_file_state(import_path: str) -> dict:
+        file_stat = os.stat(import_path)
+
+        return {'path': os.path.abspath(import_path), 'mtime': file_stat.st_mtime, 'size': file_stat.st_size}
+
+    def __load_import_plan(self, import_path: str) -> dict:
+        if not self.sync_plan:
+            return None
+
+        plan = self.sync_plan.load('import_users')
+
+        if plan and plan['metadata'].get('import_file') != self.__get_import_file_state(import_path):
+            self.log.info('Pending import plan belongs to a different or modified CSV file, discarding it')
+            self.sync_plan.discard('import_users')
+            return None
+
+        return plan
+
+    def __patch_freeipa_cache(self, user_ids: list, deleted: bool = False) -> bool:
+        self.log.debug(f'Updating FreeIPA cache entries for {len(user_ids)} user(s)')
+
+        if self.cache_handler.is_cache_outdated('freeipa_cache'):
+            self.log.debug('FreeIPA cache outdated, it will be fully rebuilt on the next read')
+            return False
+
+        if deleted:
+            return self.cache_handler.delete_cache_users('freeipa_cache', user_ids)
+
+        if not self.freeipa_connection:
+            self.log.error('Could not update cache entries due to a problem with the FreeIPA connection object')
+            return False
+
+        try:
+            updated_users, removed_users = self.__show_users(user_ids)
+
+        except freeipa_exceptions.FreeIPAError as e:
+            self.log.warning(f'Could not refresh cache entries, rebuilding FreeIPA cache: {e}')
+            return self.get_freeipa_users(force_update_cache=True) is not None
+
+        return_value = True
+
+        if updated_users:
+            return_value = self.cache_handler.save_cache_users('freeipa_cache', updated_users) and return_value
+        if removed_users:
+            return_value = self.cache_handler.delete_cache_users('freeipa_cache', removed_users) and return_value
+
+        return return_value
+
+    def __search_ldap(self, base: str, search_flt: str, attributes: list) -> list:
+        if not self.freeipa_ldap_connection:
+            self.freeipa_ldap_connection = self.__connect_to_freeipa_ldap()
+
+            if not self.freeipa_ldap_connection:
+                return None
+
+        req_ctrl = SimplePagedResultsControl(criticality=True, size=self.ldap_settings['page_size'], cookie='')
+        entries = []
+
+        while True:
+            msgid = self.freeipa_ldap_connection.search_ext(base=base,
+                                                            scope=ldap.SCOPE_ONELEVEL,
+                                                            filterstr=search_flt,
+                                                            attrlist=attributes,
+                                                            serverctrls=[req_ctrl])
+
+            rtype, rdata, rmsgid, serverctrls = self.freeipa_ldap_connection.result3(msgid)
+            entries.extend(rdata)
+
+            pctrls = [c for c in serverctrls if c.controlType == SimplePagedResultsControl.controlType]
+
+            if pctrls and pctrls[0].cookie:
+                req_ctrl.cookie = pctrls[0].cookie
+            else:
+                break
+
+        self.log.debug(f'{len(entries)} entries read from FreeIPA LDAP base {base}')
+
+        return entries
+
+    def __show_users(self, user_ids: list) -> (dict, list):
+        commands = [self.__get_batch_command('user_show', [user_id], {'all': True}) for user_id in user_ids]
+
+        users = {}
+        removed_users = []
+
+        for user_id, result in zip(user_ids, self.__run_batch(commands)):
+
+            if result.get('error_name') == 'NotFound':
+                removed_users.append(user_id)
+
+            elif result.get('error'):
+                raise freeipa_exceptions.FreeIPAError(message=f"Could not obtain user {user_id}: {result['error']}",
+                                                      code=None)
+
+            elif not result['result'].get('preserved', False) and \
+                    any(group in self.freeipa_gids for group in result['result'].get('memberof_group', [])):
+                users[user_id] = self.__get_user_data(result['result'])
+
+            else:
+                self.log.debug(f'User {user_id} no longer belongs to a managed group')
+                removed_users.append(user_id)
+
+        return users, removed_users
+
+    def __plan_import(self, import_path: str) -> dict:
+        try:
+            with open(import_path, newline='') as csvfile:
+                rows = list(csv.DictReader(csvfile))
+
+        except csv.Error:
+            self.log.error(f'Could not import users from CSV file {import_path} due to a  problem while accessing '
+                           'the file.')
+            return None
+
+        if not self.freeipa_connection:
+            self.log.error('Could not import users due to a problem with the FreeIPA connection object')
+            return None
+
+        # Prefetch everything needed to validate the rows so that FreeIPA is only queried in bulk
+        freeipa_users = self.get_freeipa_users() or {}
+
+        try:
+            preserved_users = self.__get_preserved_user_ids()
+
+        except (freeipa_exceptions.BadRequest,
+                freeipa_exceptions.Denied,
+                freeipa_exceptions.FreeIPAError,
+                freeipa_exceptions.NotFound,
+                freeipa_exceptions.Unauthorized,
+                freeipa_exceptions.UserLocked) as e:
+
+            self.log.error(f'Could not check preserved users due to a problem with the FreeIPA server: {e}')
+            return None
+
+        skipped_users = []
+        not_imported_users = []
+        skipped_users_data = {}
+        new_users_data = {}
+
+        for row in rows:
+            user_id = row['user_id'].strip()
+
+            if user_id not in freeipa_users:
+                import_data = {}
+                for key in row:
+                    import_data[key] = row[key].strip()
+
+                if '.' in user_id and import_data['user_group'] in self.freeipa_gids \
+                        and user_id not in preserved_users and import_data['email'] != '' \
+                        and import_data['name'] != '' and import_data['lastname'] != '':
+                    new_users_data[row['user_id']] = import_data
+                else:
+                    self.log.warning(f"User format invalid for {user_id} or {import_data['user_group']} group "
+                                     'not valid')
+                    not_imported_users.append(row['user_id'])
+
+            else:
+                skipped_users.append(row['user_id'])
+                skipped_users_data[row['user_id']] = row
+
+        aliases = self.__generate_aliases({user: (new_users_data[user]['name'], new_users_data[user]['lastname'])
+                                           for user in new_users_data if not new_users_data[user].get('alias')})
+
+        operations = {}
+
+        for user in new_users_data:
+            import_data = new_users_data[user]
+
+            if not import_data.get('full_name'):
+                import_data['full_name'] = f"{import_data['name']} {import_data['lastname']}"
+            if not import_data.get('alias'):
+                import_data['alias'] = aliases[user]
+
+            if import_data['alias']:
+                import_data['password'] = self.__generate_password()
+                operations[user] = {'type': 'create',
+                                    'commands': self.__get_create_commands(**import_data),
+                                    'password': import_data['password']}
+            else:
+                self.log.warning(f'User {user} not imported to FreeIPA, no alias could be generated')
+                not_imported_users.append(user)
+
+        for user in skipped_users:
+            import_data = {}
+
+            for key in skipped_users_data[user]:
+                if skipped_users_data[user][key] != '' and key != 'alias':
+                    import_data[key] = skipped_users_data[user][key].strip()
+
+            freeipa_user = freeipa_users[user.strip()]
+
+            new_import_data = {}
+
+            for key in import_data:
+                if key in freeipa_user and import_data[key] != freeipa_user[key]:
+                    new_import_data[key] = import_data[key]
+
+                if key == 'user_group' and import_data[key] not in freeipa_user['member_of']:
+                    new_import_data[key] = import_data[key]
+
+            if ('user_group' in new_import_data and new_import_data['user_group'] not in self.freeipa_gids) \
+                    or ('manager' in new_import_data and new_import_data['manager'] not in freeipa_users):
+                self.log.warning(f'Invalid group or manager provided for user {user}, user not updated')
+                continue
+
+            commands = self.__get_update_commands(user.strip(), freeipa_user, **new_import_data)
+
+            if commands:
+                operations[user] = {'type': 'update', 'commands': commands}
+            else:
+                self.log.warning(f'User {user} is up-to-date in FreeIPA, nothing to update')
+
+        metadata = {'import_file': self.__get_import_file_state(import_path),
+                    'skipped_users': skipped_users,
+                    'not_imported_users': not_imported_users}
+
+        if self.sync_plan:
+            return self.sync_plan.create('import_users', operations, metadata)
+        else:
+            return {'operations': operations, 'metadata': metadata}
+
+    def __run_batch(self, commands: list) -> list:
+        self.log.debug(f'Running {len(commands)} FreeIPA command(s) in batches of {self.batch_size}')
+
+        results = []
+
+        for i in range(0, len(commands), self.batch_size):
+            chunk = commands[i:i + self.batch_size]
+
+            try:
+                query_data = self.__get_thread_connection().batch(a_methods=chunk)
+                results.extend(query_data['results'])
+
+            except (TimeoutError,
+                    ConnectionError,
+                    freeipa_exceptions.BadRequest,
+                    freeipa_exceptions.Denied,
+                    freeipa_exceptions.FreeIPAError,
+                    freeipa_exceptions.NotFound,
+                    freeipa_exceptions.Unauthorized,
+                    freeipa_exceptions.UserLocked) as e:
+
+                self.log.error(f'Batch of {len(chunk)} FreeIPA command(s) failed: {e}')
+                results.extend({'error': str(e), 'error_name': type(e).__name__} for _ in chunk)
+
+        return results
+
+    def __run_import_operations(self, operations: dict) -> dict:
+        successful_users = self.__run_user_commands({user: operations[user]['commands'] for user in operations})
+
+        return {user: True for user in successful_users}
+
+    def __run_user_commands(self, user_commands: dict) -> list:
+        users = [user for user in user_commands if user_commands[user]]
+        errors = {}
+
+        # The first command of each user, such as user_add, runs before the rest, which are only sent when it succeeded
+        for user, result in zip(users, self.__run_batch([user_commands[user][0] for user in users])):
+            if result.get('error'):
+                errors[user] = result['error']
+
+        follow_up_users = [user for user in users if user not in errors and len(user_commands[user]) > 1]
+        commands = [command for user in follow_up_users for command in user_commands[user][1:]]
+
+        results = iter(self.__run_batch(commands))
+
+        for user in follow_up_users:
+            user_errors = [result['error'] for result in [next(results) for _ in user_commands[user][1:]]
+                           if result.get('error')]
+
+            if user_errors:
+                errors[user] = user_errors[0]
+
+        for user in errors:
+            self.log.error(f'FreeIPA request for user {user.strip()} failed: {errors[user]}')
+
+        return [user for user in user_commands if user not in errors]
+
     def create_freeipa_user(self, user_id: str, email: str, name: str, lastname: str, user_group: str,
                             full_name: str = '', alias: str = '', job_title: str = '', street_address: str = '',
                             city: str = '', state: str = '', zip_code: str = '', org_unit: str = '',
@@ -183,67 +904,44 @@ class FreeIPAHandler:
                 full_name = f'{name} {lastname}'
 
             if alias is None or alias == '':
-                alias = self.__generate_alias(name, lastname)
+                alias = self.__generate_aliases({user_id: (name, lastname)})[user_id]
+
+            if not alias:
+                self.log.error(f'Could not create user {user_id}, no alias could be generated')
+                return None
 
             password = self.__generate_password()
 
-            try:
-                # Create the user:
-                user = self.freeipa_connection.user_add(
-                    a_uid=user_id,
-                    o_givenname=name,
-                    o_sn=lastname,
-                    o_cn=full_name,
-                    o_mail=email,
-                    o_displayname=full_name,
-                    o_gecos=full_name,
-                    o_title=job_title,
-                    o_street=street_address,
-                    o_l=city,
-                    o_st=state,
-                    o_postalcode=zip_code,
-                    o_ou=org_unit,
-                    o_employeenumber=employee_number,
-                    o_employeetype=employee_type,
-                    o_preferredlanguage=preferred_language,
-                    o_telephonenumber=phone_number,
-                    o_manager=manager,
-                    o_gidnumber=str(self.freeipa_gids[user_group]),
-                    o_homedirectory=f'/home/{alias}',
-                    o_userpassword=password,
-                    o_noprivate=True)
-
-                self.log.debug('User account created in FreeIPA')
-                self.log.debug(f"User {user_id} created in FreeIPA using temporary password '{password}'")
+            commands = self.__get_create_commands(user_id, email, name, lastname, user_group, full_name, alias,
+                                                  password, job_title=job_title, street_address=street_address,
+                                                  city=city, state=state, zip_code=zip_code, org_unit=org_unit,
+                                                  phone_number=phone_number, employee_number=employee_number,
+                                                  employee_type=employee_type,
+                                                  preferred_language=preferred_language, manager=manager)
 
-                # Add user alias:
-                self.freeipa_connection.user_add_principal(user_id, alias)
-                self.log.debug(f'User alias {alias} added to {user_id} account')
+            # Create the user first, the alias and the team group are only added to the user once it was created
+            results = self.__run_batch(commands[:1])
+
+            if not results[0].get('error'):
+                results += self.__run_batch(commands[1:])
 
-                # Add user to team group:
-                self.freeipa_connection.group_add_member(user_group, o_user=user_id)
+            errors = [result['error'] for result in results if result.get('error')]
+
+            if not errors:
+                self.log.debug(f"User {user_id} created in FreeIPA using temporary password '{password}'")
+                self.log.debug(f'User alias {alias} added to {user_id} account')
                 self.log.debug(f'User {user_id} added to {user_group} group')
 
                 self.log.info(f'User properly {user_id} created in FreeIPA')
 
                 if update_cache:
                     self.log.debug('Updating FreeIPA cache')
-                    self.get_freeipa_users(force_update_cache=True)
+                    self.__patch_freeipa_cache([user_id])
 
-                return user, password
-
-            except (freeipa_exceptions.BadRequest,
-                    freeipa_exceptions.Denied,
-                    freeipa_exceptions.DuplicateEntry,
-                    freeipa_exceptions.FreeIPAError,
-                    freeipa_exceptions.NotFound,
-                    freeipa_exceptions.parse_error,
-                    freeipa_exceptions.Unauthorized,
-                    freeipa_exceptions.UserLocked,
-                    freeipa_exceptions.ValidationError) as e:
+                return results[0]['result'], password
 
-                self.log.error(
-                    f'Could not create user {user_id} due to a problem with the FreeIPA server: {e}')
+            else:
+                self.log.error(f'Could not create user {user_id} due to a problem with the FreeIPA server: {errors[0]}')
                 return None
 
         else:
@@ -288,7 +986,7 @@ class FreeIPAHandler:
                 self.log.info(f'User {user_id} deleted from FreeIPA')
 
                 self.log.debug('Updating FreeIPA cache')
-                self.get_freeipa_users(force_update_cache=True)
+                self.__patch_freeipa_cache([user_id], deleted=True)
                 return True
             else:
                 self.log.warning(f'User {user_id} deletion failed in FreeIPA')
@@ -308,6 +1006,33 @@ class FreeIPAHandler:
             self.log.error(f'Could not delete user {user_id} due to a problem with the FreeIPA server: {e}')
             return False
 
+    def delete_freeipa_users(self, user_ids: list, preserve: bool = True) -> (list, list):
+        self.log.info(f'Deleting {len(user_ids)} FreeIPA user(s) in batches of {self.batch_size}')
+
+        deleted_users = []
+        not_deleted_users = []
+
+        if not self.freeipa_connection:
+            self.log.error('Could not delete users due to a problem with the FreeIPA connection object')
+            return deleted_users, list(user_ids)
+
+        commands = [self.__get_batch_command('user_del', [user_id], {'preserve': preserve}) for user_id in user_ids]
+
+        for user_id, result in zip(user_ids, self.__run_batch(commands)):
+
+            if not result.get('error') and not result['result']['failed']:
+                self.log.info(f'User {user_id} deleted from FreeIPA')
+                deleted_users.append(user_id)
+            else:
+                self.log.warning(f"User {user_id} deletion failed in FreeIPA: {result.get('error')}")
+                not_deleted_users.append(user_id)
+
+        if deleted_users:
+            self.log.debug('Updating FreeIPA cache')
+            self.__patch_freeipa_cache(deleted_users, deleted=True)
+
+        return deleted_users, not_deleted_users
+
     def delete_freeipa_user_otp_tokens(self, user_id: str) -> bool:
         user = self.get_freeipa_user(user_id)
 
@@ -365,7 +1090,7 @@ class FreeIPAHandler:
 
             if return_value:
                 self.log.debug('Updating FreeIPA cache')
-                self.get_freeipa_users(force_update_cache=True)
+                self.__patch_freeipa_cache([user_id])
 
             return return_value
 
@@ -397,7 +1122,7 @@ class FreeIPAHandler:
 
             if return_value:
                 self.log.debug('Updating FreeIPA cache')
-                self.get_freeipa_users(force_update_cache=True)
+                self.__patch_freeipa_cache([user_id])
 
             return return_value
 
@@ -476,31 +1201,46 @@ class FreeIPAHandler:
     def get_expired_users(self) -> (dict, dict):
         self.log.info('Obtaining expired users from FreeIPA')
 
-        freeipa_users = self.get_freeipa_users()
+        expiration_index = self.get_expiration_index()
 
         expired_users = {}
         expired_users_disabled = {}
 
-        for user_id in freeipa_users:
+        if not expiration_index:
+            return expired_users, expired_users_disabled
 
-            if freeipa_users[user_id]['krblastpwdchange'] != freeipa_users[user_id]['krbpasswordexpiration']:
-                delta, exp_date = self.get_user_passwd_expiration(user_id)
+        freeipa_users = expiration_index.freeipa_users
 
-                if delta < 0:
-                    self.log.info(f'  - {user_id}: expired {abs(delta)} days ago')
+        for user_id, delta in expiration_index.get_users_expiring(max_days=-1).items():
 
-                if -self.password_gracious_period <= delta < 0:
-                    expired_users[user_id] = delta
+            # Users that never changed the password after a reset are listed as pending password change
+            if freeipa_users[user_id]['krblastpwdchange'] == freeipa_users[user_id]['krbpasswordexpiration']:
+                continue
+
+            self.log.info(f'  - {user_id}: expired {abs(delta)} days ago')
 
-                elif delta < -self.password_gracious_period:
-                    expired_users_disabled[user_id] = delta
+            if delta >= -self.password_gracious_period:
+                expired_users[user_id] = delta
+            else:
+                expired_users_disabled[user_id] = delta
 
         return expired_users, expired_users_disabled
 
+    def get_expiration_index(self) -> ExpirationIndex:
+        freeipa_users = self.get_freeipa_users()
+
+        if not freeipa_users:
+            return None
+
+        return self.cache_handler.get_expiration_index(freeipa_users)
+
     def get_freeipa_admin_emails(self) -> str:
         self.log.info('Obtaining emails of FreeIPA admins')
 
-        freeipa_users = self.get_freeipa_users()
+        if self.get_freeipa_users():
+            freeipa_users = self.cache_handler.get_freeipa_cache_users(group='admins')
+        else:
+            freeipa_users = {}
 
         admin_emails = ''
 
@@ -517,14 +1257,20 @@ class FreeIPAHandler:
 
         return admin_emails
 
-    def get_freeipa_user(self, user_id: str) -> dict:
-        freeipa_users = self.cache_handler.get_freeipa_cache()
+    def get_request_metrics(self) -> dict:
+        if not self.request_throttle:
+            return {}
+
+        return self.request_throttle.get_metrics()
 
-        if freeipa_users:
+    def get_freeipa_user(self, user_id: str) -> dict:
+        if not self.cache_handler.is_cache_outdated('freeipa_cache'):
             self.log.info(f'Obtaining information of user {user_id} from FreeIPA cache')
-            if user_id in freeipa_users:
+            freeipa_user = self.cache_handler.get_freeipa_cache_user(user_id)
+
+            if freeipa_user:
                 self.log.debug(f'User {user_id} retrieved from FreeIPA cache')
-                return freeipa_users[user_id]
+                return freeipa_user
             else:
                 self.log.debug(f'User {user_id} does not exist in FreeIPA cache')
                 return None
@@ -573,22 +1319,21 @@ class FreeIPAHandler:
             self.log.info('Obtaining users from FreeIPA')
             try:
                 if self.freeipa_connection:
-                    freeipa_users = {}
-
-                    for group in self.freeipa_gids:
-
-                        group_data = self.freeipa_connection.user_find(o_in_group=group, o_preserved=False)
+                    # Changes made while users are being downloaded must be picked up by the next delta refresh
+                    update_time = datetime.datetime.now()
+                    freeipa_users = None
 
-                        for user in group_data['result']:
+                    # Modified users are found through LDAP, without it every refresh is a full one
+                    if self.refresh_mode == 'delta' and self.__is_freeipa_ldap_available():
+                        freeipa_users = self.__get_delta_users()
 
-                            user_id = user['uid'][0]
-                            freeipa_users[user_id] = self.__get_user_data(user)
-                            self.log.debug(f'Information for user {user_id} retrieved from FreeIPA')
+                    if freeipa_users is None:
+                        freeipa_users = self.__get_full_users()
 
                     self.log.info('Users retrieved from FreeIPA server')
 
                     self.log.debug('Saving FreeIPA users to cache file')
-                    save_status = self.cache_handler.save_cache(freeipa_users=freeipa_users)
+                    save_status = self.cache_handler.save_cache(freeipa_users=freeipa_users, update_time=update_time)
 
                     if save_status:
                         self.log.debug('FreeIPA user cache successfully saved')
@@ -600,7 +1345,9 @@ class FreeIPAHandler:
                 else:
                     return None
 
-            except (freeipa_exceptions.BadRequest,
+            except (TimeoutError,
+                    ConnectionError,
+                    freeipa_exceptions.BadRequest,
                     freeipa_exceptions.Denied,
                     freeipa_exceptions.FreeIPAError,
                     freeipa_exceptions.NotFound,
@@ -611,25 +1358,24 @@ class FreeIPAHandler:
 
                 return None
 
-    def get_user_passwd_expiration(self, user_id: str) -> (int, datetime.date):
-        self.log.debug(f'Obtaining user {user_id} password expiration info')
-
-        user = self.get_freeipa_user(user_id)
-
-        if 'krbpasswordexpiration' in user and user['krbpasswordexpiration'] != '':
-
-            timestamp = user['krbpasswordexpiration'][0]['__datetime__']
-
-            today = datetime.date.today()
-            exp_date = datetime.datetime.strptime(timestamp, '%Y%m%d%H%M%SZ').date()
-            delta = exp_date - today
-            self.log.debug(f'Password for {user_id} to expire in {delta.days} days')
+    def get_preserved_users(self) -> set:
+        try:
+            if self.freeipa_connection:
+                return self.__get_preserved_user_ids()
+            else:
+                return None
 
-            return delta.days, exp_date
+        except (TimeoutError,
+                ConnectionError,
+                freeipa_exceptions.BadRequest,
+                freeipa_exceptions.Denied,
+                freeipa_exceptions.FreeIPAError,
+                freeipa_exceptions.NotFound,
+                freeipa_exceptions.Unauthorized,
+                freeipa_exceptions.UserLocked) as e:
 
-        else:
-            self.log.warning(f'Password for {user_id} not set yet')
-            return 365, (datetime.datetime.now() + datetime.timedelta(days=365)).date()
+            self.log.error(f'Could not obtain preserved users due to a problem with the FreeIPA server: {e}')
+            return None
 
     def get_users_no_password(self) -> list:
         self.log.info('Obtaining users pending password change from FreeIPA')
@@ -656,85 +1402,69 @@ class FreeIPAHandler:
 
         self.log.info(f'Importing user data to FreeIPA from {import_path}')
 
-        imported_users = {}
-        updated_users = []
-        skipped_users = []
-        not_imported_users = []
-        skipped_users_data = {}
-
-        if os.path.exists(import_path):
-            try:
-                with open(import_path, newline='') as csvfile:
-                    reader = csv.DictReader(csvfile)
-
-                    for row in reader:
-
-                        user_id = row['user_id'].strip()
-                        if not self.get_freeipa_user(user_id):
-                            import_data = {}
-                            for key in row:
-                                import_data[key] = row[key].strip()
-
-                            user, password = self.create_freeipa_user(**import_data, update_cache=False)
-
-                            if password:
-                                imported_users[row['user_id']] = password
-                                self.log.debug(f"User {user_id} imported to FreeIPA")
-
-                            else:
-                                not_imported_users.append(row['user_id'])
-                                self.log.warning(f"User {row['user_id']} not imported to FreeIPA")
+        if not os.path.exists(import_path):
+            self.log.error(f'Import file {import_path} does not exist')
+            return None, None, None, None
 
-                        else:
-                            skipped_users.append(row['user_id'])
-                            skipped_users_data[row['user_id']] = row
+        # An import interrupted halfway is resumed from its plan, so users already created keep their passwords
+        plan = self.__load_import_plan(import_path) or self.__plan_import(import_path)
 
-                for user in skipped_users:
-                    import_data = {}
+        if plan is None:
+            return None, None, None, None
 
-                    for key in skipped_users_data[user]:
-                        if skipped_users_data[user][key] != '' and key != 'alias':
-                            import_data[key] = skipped_users_data[user][key].strip()
+        operations = plan['operations']
 
-                    freeipa_user = self.get_freeipa_user(user)
+        if self.sync_plan:
+            # The plan holds the passwords of the new users, it is kept until their notifications are sent
+            results = self.sync_plan.apply(plan, self.__run_import_operations, chunk_size=self.batch_size, keep=True)
+        else:
+            results = self.__run_import_operations(operations)
 
-                    new_import_data = {'user_id': user}
+        imported_users = {}
+        updated_users = []
+        skipped_users = list(plan['metadata']['skipped_users'])
+        not_imported_users = list(plan['metadata']['not_imported_users'])
+
+        for user in operations:
+            if operations[user]['type'] == 'create':
+                if results.get(user):
+                    imported_users[user] = operations[user]['password']
+                    self.log.debug(f'User {user} imported to FreeIPA')
+                else:
+                    not_imported_users.append(user)
+                    self.log.warning(f'User {user} not imported to FreeIPA')
 
-                    for key in import_data:
-                        if key in freeipa_user and import_data[key] != freeipa_user[key]:
-                            new_import_data[key] = import_data[key]
+            elif results.get(user):
+                updated_users.append(user)
+                skipped_users.pop(skipped_users.index(user))
+                self.log.debug(f'User {user} updated in FreeIPA')
 
-                        if key == 'user_group' and import_data[key] not in freeipa_user['member_of']:
-                            new_import_data[key] = import_data[key]
+        if imported_users != {} or updated_users != []:
+            self.log.info('Users imported and/or updated from CSV file')
+            self.log.debug('Updating FreeIPA cache')
+            self.__patch_freeipa_cache([user.strip() for user in list(imported_users) + updated_users])
 
-                    if new_import_data:
+        elif imported_users == {} and updated_users == []:
+            self.log.info('No user was modified from data in CSV file')
 
-                        import_status = self.update_freeipa_user(**new_import_data, update_cache=False)
+        return imported_users, updated_users, skipped_users, not_imported_users
 
-                        if import_status:
-                            updated_users.append(user)
-                            skipped_users.pop(skipped_users.index(user))
-                            self.log.debug(f'User {user} updated in FreeIPA')
-                    else:
-                        self.log.warning(f'User {user} is up-to-date in FreeIPA, nothing to update')
+    def reconnect(self) -> bool:
+        self.log.debug('Reopening FreeIPA connections')
 
-                if imported_users != {} or updated_users != []:
-                    self.log.info('Users imported and/or updated from CSV file')
-                    self.log.debug('Updating FreeIPA cache')
-                    self.get_freeipa_users(force_update_cache=True)
+        self.__freeipa_connection = self.__connect_to_freeipa()
+        self.__freeipa_connection_attempted = True
+        self.thread_data = threading.local()
 
-                elif imported_users == {} and updated_users == []:
-                    self.log.info('No user was modified from data in CSV file')
+        if self.freeipa_ldap_connection:
+            try:
+                self.freeipa_ldap_connection.unbind_s()
+            except ldap.LDAPError:
+                pass
 
-                return imported_users, updated_users, skipped_users, not_imported_users
+            self.freeipa_ldap_connection = None
 
-            except csv.Error:
-                self.log.error(f'Could not import users from CSV file {import_path} due to a  problem while accessing '
-                               'the file.')
-                return None, None, None, None
-        else:
-            self.log.error(f'Import file {import_path} does not exist')
-            return None, None, None, None
+        return self.freeipa_connection is not None
 
     def reset_user_password(self, user_id: str) -> str:
         self.log.debug(f'Resetting password for user {user_id}')
@@ -783,82 +1513,114 @@ class FreeIPAHandler:
                 and (user_group is None or (user_group is not None and user_group in self.freeipa_gids)) \
                 and (manager is None or (manager is not None and self.get_freeipa_user(manager) is not None)):
 
-            if name and lastname:
-                if not full_name:
-                    full_name = f'{name} {lastname}'
-                if not initials:
-                    initials = name[:1] + lastname[:1]
+            commands = self.__get_update_commands(user_id, user, email=email, name=name, lastname=lastname,
+                                                  full_name=full_name, initials=initials, user_group=user_group,
+                                                  job_title=job_title, street_address=street_address, city=city,
+                                                  state=state, zip_code=zip_code, org_unit=org_unit,
+                                                  phone_number=phone_number, employee_number=employee_number,
+                                                  employee_type=employee_type,
+                                                  preferred_language=preferred_language, manager=manager,
+                                                  home_directory=home_directory)
 
-            elif name:
-                if not full_name:
-                    full_name = f"{name} {user['lastname']}"
-                if not initials:
-                    initials = name[:1] + user['lastname'][:1]
+            if commands:
+                errors = [result['error'] for result in self.__run_batch(commands) if result.get('error')]
 
-            elif lastname:
-                if not full_name:
-                    full_name = f"{user['name']} {lastname}"
-                if not initials:
-                    initials = user['name'][:1] + lastname[:1]
+                if not errors:
+                    self.log.debug('User account updated in FreeIPA')
+                    self.log.info('User fully updated in FreeIPA')
+                    return_value = True
+                else:
+                    self.log.error(f'Could not update user {user_id} due to a problem with the FreeIPA server: '
+                                   f'{errors[0]}')
+                    return_value = False
 
-            try:
+        else:
+            self.log.warning(f'User does not exist or invalid user_id format used for {user_id}')
 
-                if email is not None or name is not None or lastname is not None or job_title is not None \
-                        or street_address is not None or city is not None or state is not None \
-                        or zip_code is not None or org_unit is not None or phone_number is not None \
-                        or employee_number is not None or employee_type is not None or preferred_language is not None \
-                        or manager is not None or home_directory is not None or full_name is not None \
-                        or initials is not None:
-                    self.freeipa_connection.user_mod(a_uid=user_id, o_mail=email,
-                                                     o_givenname=name, o_sn=lastname,
-                                                     o_title=job_title,
-                                                     o_street=street_address, o_l=city,
-                                                     o_st=state, o_postalcode=zip_code,
-                                                     o_ou=org_unit,
-                                                     o_telephonenumber=phone_number,
-                                                     o_employeenumber=employee_number,
-                                                     o_employeetype=employee_type,
-                                                     o_preferredlanguage=preferred_language,
-                                                     o_displayname=full_name,
-                                                     o_cn=full_name, o_gecos=full_name,
-                                                     o_initials=initials,
-                                                     o_manager=manager,
-                                                     o_homedirectory=home_directory)
+        if return_value and update_cache:
+            self.log.debug('Updating FreeIPA cache')
+            self.__patch_freeipa_cache([user_id])
 
-                    self.log.debug('User account updated in FreeIPA')
-                    return_value = True
+        return return_value
 
-                if user_group is not None:
-                    if user_group not in user['member_of']:
-                        for group in user['member_of']:
-                            if group in self.freeipa_gids:
-                                self.freeipa_connection.group_remove_member(
-                                    group, o_user=user_id)
-                                self.log.debug(f'User {user_id} removed from group {group}')
+    def update_freeipa_users(self, user_updates: dict, update_cache: bool = True) -> (list, list):
+        self.log.info(f'Updating {len(user_updates)} FreeIPA user(s)')
 
-                        self.freeipa_connection.group_add_member(user_group, o_user=user_id)
-                        self.log.debug(f'User {user_id} added to group {user_group}')
-                        return_value = True
+        if not self.freeipa_connection:
+            self.log.error('Could not update users due to a problem with the FreeIPA connection object')
+            return [], list(user_updates)
 
-                self.log.info('User fully updated in FreeIPA')
+        # Users and managers are validated against a single user list instead of one lookup per user
+        freeipa_users = self.get_freeipa_users() or {}
 
-            except (freeipa_exceptions.BadRequest,
-                    freeipa_exceptions.Denied,
-                    freeipa_exceptions.DuplicateEntry,
-                    freeipa_exceptions.FreeIPAError,
-                    freeipa_exceptions.NotFound,
-                    freeipa_exceptions.parse_error,
-                    freeipa_exceptions.Unauthorized,
-                    freeipa_exceptions.UserLocked,
-                    freeipa_exceptions.ValidationError) as e:
+        failed_users = set()
+        user_commands = {}
+        group_members = {}
+
+        for user_id in user_updates:
+            user = freeipa_users.get(user_id)
+            fields = {key: value for key, value in user_updates[user_id].items() if key != 'user_group'}
+            user_group = user_updates[user_id].get('user_group')
+            manager = fields.get('manager')
+
+            if '.' not in user_id or user is None \
+                    or (user_group is not None and user_group not in self.freeipa_gids) \
+                    or (manager is not None and manager not in freeipa_users):
+                self.log.warning(f'User does not exist or invalid user_id format, group or manager used for {user_id}')
+                failed_users.add(user_id)
+                continue
+
+            commands = self.__get_update_commands(user_id, user, **fields)
+
+            if commands:
+                user_commands[user_id] = commands
+
+            # Membership changes are sent once per group for all of its users
+            if user_group is not None and user_group not in user['member_of']:
+                for group in user['member_of']:
+                    if group in self.freeipa_gids:
+                        group_members.setdefault(('group_remove_member', group), []).append(user_id)
+
+                group_members.setdefault(('group_add_member', user_group), []).append(user_id)
 
-                self.log.error(f'Could not update user {user_id} due to a problem with the FreeIPA server: {e}')
-                return_value = False
+        users = list(user_commands)
+        workers = max(1, min(self.update_workers, len(users)))
+        worker_commands = [{user: user_commands[user] for user in users[i::workers]} for i in range(workers)]
+
+        self.log.debug(f'Sending changes of {len(users)} user(s) with {workers} worker(s)')
+
+        if workers > 1:
+            # Each worker thread sends its requests through its own FreeIPA session
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                successful_users = [user for worker_users in executor.map(self.__run_user_commands, worker_commands)
+                                    for user in worker_users]
         else:
-            self.log.warning(f'User does not exist or invalid user_id format used for {user_id}')
+            successful_users = self.__run_user_commands(worker_commands[0])
 
-        if return_value and update_cache:
+        failed_users.update(set(users) - set(successful_users))
+
+        # Users leave their previous groups before joining the new ones
+        group_changes = sorted(group_members, key=lambda group_change: group_change[0] != 'group_remove_member')
+        commands = [self.__get_batch_command(method, [group], {'user': group_members[(method, group)]})
+                    for method, group in group_changes]
+
+        for (method, group), result in zip(group_changes, self.__run_batch(commands)):
+            if result.get('error'):
+                self.log.error(f"FreeIPA {method} request for group {group} failed: {result['error']}")
+                failed_users.update(group_members[(method, group)])
+            else:
+                # A successful request can still reject some of its members
+                members = {user_id.lower(): user_id for user_id in group_members[(method, group)]}
+
+                for user_id, error in result.get('failed', {}).get('member', {}).get('user', []):
+                    self.log.warning(f'FreeIPA {method} request for user {user_id} in group {group} failed: {error}')
+                    failed_users.add(members.get(user_id.lower(), user_id))
+
+        updated_users = [user_id for user_id in user_updates if user_id not in failed_users]
+        not_updated_users = [user_id for user_id in user_updates if user_id in failed_users]
+
+        if updated_users and update_cache:
             self.log.debug('Updating FreeIPA cache')
-            self.get_freeipa_users(force_update_cache=True)
+            self.__patch_freeipa_cache(updated_users)
 
-        return return_value
+        return updated_users, not_updated_users
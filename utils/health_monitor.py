@@ -0,0 +1,70 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import datetime
+import logging
+import threading
+
+from utils.json_file import load_json_file
+from utils.json_file import save_json_file
+
+
+class HealthMonitor:
+
+    def __init__(self, state_file: str, validity: int = 60, backoff: int = 30, max_backoff: int = 900):
+        self.log = logging.getLogger('freeipa_manager')
+        self.state_file = state_file
+        self.validity = validity
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.state = load_json_file(state_file) or {}
+
+    def get_status(self, server: str) -> bool:
+        now = datetime.datetime.now().timestamp()
+
+        with self.lock:
+            server_state = self.state.get(server)
+
+        if not server_state:
+            return None
+
+        if server_state['failures'] and now < server_state['retry_after']:
+            self.log.debug(f"Server {server} marked as down after {server_state['failures']} failure(s), next check in "
+                           f"{int(server_state['retry_after'] - now)} seconds")
+            return False
+
+        if server_state['reachable'] and now - server_state['checked_at'] < self.validity:
+            self.log.debug(f'Reusing connectivity result for server {server}')
+            return True
+
+        return None
+
+    def record(self, server: str, reachable: bool) -> None:
+        now = datetime.datetime.now().timestamp()
+
+        with self.lock:
+            failures = 0 if reachable else self.state.get(server, {}).get('failures', 0) + 1
+            retry_after = now + min(self.backoff * 2 ** (failures - 1), self.max_backoff) if failures else now
+
+            if failures:
+                self.log.debug(f'Server {server} failed {failures} time(s) in a row, marked as down for '
+                               f'{int(retry_after - now)} seconds')
+
+            self.state[server] = {'reachable': reachable,
+                                  'checked_at': now,
+                                  'failures': failures,
+                                  'retry_after': retry_after}
+
+            save_json_file(self.state_file, self.state)
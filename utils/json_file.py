@@ -0,0 +1,66 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import datetime
+import json
+import logging
+import os
+import threading
+
+log = logging.getLogger('freeipa_manager')
+
+
+def load_json_file(file_path: str) -> {dict, list}:
+    log.debug(f'Loading JSON file {file_path}')
+
+    try:
+        with open(file_path, 'r') as fp:
+            data = json.load(fp)
+            log.debug('JSON file loaded successfully')
+            return data
+
+    except FileNotFoundError:
+        log.debug(f'JSON file {file_path} does not exist')
+        return None
+
+    except (OSError, json.decoder.JSONDecodeError) as e:
+        log.error(f'JSON file {file_path} could not be loaded: {e}')
+        return None
+
+
+def save_json_file(file_path: str, data: {dict, list}, update_time: datetime.datetime = None) -> bool:
+    log.debug(f'Saving JSON file {file_path}')
+
+    temp_file = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+    try:
+        with open(temp_file, 'w') as fp:
+            json.dump(data, fp)
+
+        if update_time:
+            os.utime(temp_file, (update_time.timestamp(), update_time.timestamp()))
+
+        # Concurrent executions must never read a half written file
+        os.replace(temp_file, file_path)
+
+        log.debug('JSON saved successfully')
+        return True
+
+    except (OSError, TypeError, ValueError) as e:
+        log.error(f'JSON file {file_path} could not be saved: {e}')
+
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+        return False
@@ -0,0 +1,224 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import email
+import email.policy
+import fcntl
+import logging
+import os
+import smtplib
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+
+from utils.health_monitor import HealthMonitor
+from utils.smtp_pool import SMTPPool
+
+
+class MailSpool:
+
+    def __init__(self, spool_path: str, smtp_pool: SMTPPool, health_monitor: HealthMonitor = None, workers: int = 4,
+                 max_attempts: int = 8, backoff: int = 60, max_backoff: int = 3600):
+        self.log = logging.getLogger('freeipa_manager')
+        self.spool_path = spool_path
+        self.outbox_path = spool_path + '/outbox'
+        self.dead_letter_path = spool_path + '/dead_letter'
+        self.smtp_pool = smtp_pool
+        self.health_monitor = health_monitor
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        # Worker threads are joined when the program exits, so queued emails are delivered before it ends
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.queued_files = set()
+        self.lock = threading.Lock()
+        self.spool_dispatched = False
+
+    @staticmethod
+    def __get_file_name(attempts: int, not_before: float, message_id: str) -> str:
+        return f'{int(not_before)}-{attempts}-{message_id}.eml'
+
+    @staticmethod
+    def __is_permanent_failure(error: Exception) -> bool:
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return all(code >= 500 for code, _ in error.recipients.values())
+        elif isinstance(error, smtplib.SMTPResponseException):
+            return error.smtp_code >= 500
+        else:
+            return False
+
+    @staticmethod
+    def __parse_file_name(file_name: str) -> (float, int, str):
+        not_before, attempts, message_id = file_name[:-len('.eml')].split('-', 2)
+
+        return float(not_before), int(attempts), message_id
+
+    def __create_directories(self) -> None:
+        for path in (self.spool_path, self.outbox_path, self.dead_letter_path):
+            if not os.path.isdir(path):
+                # Spooled emails may contain passwords, only the app owner can read them
+                os.mkdir(path, mode=0o700)
+
+    def __defer(self, spool_file: str, attempts: int, message_id: str, error: Exception) -> None:
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        retry_file = self.outbox_path + '/' + self.__get_file_name(attempts, time.time() + delay, message_id)
+
+        os.replace(spool_file, retry_file)
+
+        self.log.warning(f'Email {message_id} could not be sent ({error}), attempt {attempts} of '
+                         f'{self.max_attempts}, retrying in {delay} seconds')
+
+    def __deliver(self, spool_file: str) -> bool:
+        try:
+            with open(spool_file, 'rb') as fp:
+                try:
+                    # Another process delivering the same email holds the lock until it is done
+                    fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+                except BlockingIOError:
+                    return False
+
+                # While waiting for the lock, another process may have sent, deferred or dead lettered the email,
+                # renaming or removing the file. Only the file still found at this path is sent, otherwise the
+                # renamed copy is sent again
+                if os.stat(spool_file).st_ino != os.fstat(fp.fileno()).st_ino:
+                    return False
+
+                return self.__deliver_locked(spool_file, fp.read())
+
+        except FileNotFoundError:
+            # Already delivered or deferred by another worker since the spool was listed
+            return False
+
+        except OSError as e:
+            self.log.error(f'Spooled email {spool_file} could not be processed: {e}')
+            return False
+
+        finally:
+            with self.lock:
+                self.queued_files.discard(spool_file)
+
+    def __deliver_locked(self, spool_file: str, message_data: bytes) -> bool:
+        _, attempts, message_id = self.__parse_file_name(os.path.basename(spool_file))
+
+        if self.health_monitor and self.health_monitor.get_status('smtp') is False:
+            self.log.debug(f'Email {message_id} kept in the spool: SMTP server marked as down after previous failures')
+            return False
+
+        msg = email.message_from_bytes(message_data, policy=email.policy.default)
+
+        try:
+            self.smtp_pool.send_message(msg)
+
+        except (OSError, smtplib.SMTPException) as e:
+            attempts += 1
+
+            if self.__is_permanent_failure(e) or attempts >= self.max_attempts:
+                self.__move_to_dead_letter(spool_file, message_id, e)
+                return False
+
+            if self.health_monitor and not isinstance(e, smtplib.SMTPResponseException):
+                self.health_monitor.record('smtp', False)
+
+            self.__defer(spool_file, attempts, message_id, e)
+            return False
+
+        os.remove(spool_file)
+
+        if self.health_monitor and self.health_monitor.get_status('smtp') is not True:
+            self.health_monitor.record('smtp', True)
+
+        self.log.debug(f"Email {message_id} sent to {msg['To']}")
+        return True
+
+    def __move_to_dead_letter(self, spool_file: str, message_id: str, error: Exception) -> None:
+        dead_letter_file = self.dead_letter_path + '/' + os.path.basename(spool_file)
+
+        with open(dead_letter_file[:-len('.eml')] + '.error', 'w') as fp:
+            fp.write(f'{error}\n')
+
+        os.replace(spool_file, dead_letter_file)
+
+        self.log.error(f'Email {message_id} could not be sent ({error}), moved to {dead_letter_file}')
+
+    def __submit(self, spool_file: str) -> None:
+        with self.lock:
+            if spool_file in self.queued_files:
+                return
+
+            self.queued_files.add(spool_file)
+
+        self.executor.submit(self.__deliver, spool_file)
+
+    def dispatch(self) -> int:
+        self.spool_dispatched = True
+
+        if not os.path.isdir(self.outbox_path):
+            return 0
+
+        now = time.time()
+        due_files = []
+
+        for file_name in sorted(os.listdir(self.outbox_path)):
+            if not file_name.endswith('.eml'):
+                continue
+
+            try:
+                not_before, _, _ = self.__parse_file_name(file_name)
+
+            except ValueError:
+                self.log.warning(f'Ignoring unexpected file {file_name} in the mail spool')
+                continue
+
+            if not_before <= now:
+                due_files.append(self.outbox_path + '/' + file_name)
+
+        if due_files:
+            self.log.debug(f'Dispatching {len(due_files)} spooled email(s)')
+
+        for spool_file in due_files:
+            self.__submit(spool_file)
+
+        return len(due_files)
+
+    def enqueue(self, msg: EmailMessage) -> bool:
+        message_id = uuid.uuid4().hex
+        spool_file = self.outbox_path + '/' + self.__get_file_name(0, time.time(), message_id)
+        temp_file = self.outbox_path + f'/.{message_id}.tmp'
+
+        try:
+            self.__create_directories()
+
+            with os.fdopen(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as fp:
+                fp.write(msg.as_bytes())
+
+            # The dispatcher never sees a half written email
+            os.replace(temp_file, spool_file)
+
+        except OSError as e:
+            self.log.error(f'Email could not be spooled: {e}')
+            return False
+
+        self.log.debug(f"Email {message_id} to {msg['To']} spooled")
+
+        self.__submit(spool_file)
+
+        # Emails deferred by previous runs are retried along with the first new one
+        if not self.spool_dispatched:
+            self.dispatch()
+
+        return True
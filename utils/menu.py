@@ -13,13 +13,25 @@
 # Copyright (C) 2021  Unai Goikoetxeta
 
 import argparse
+from typing import TextIO
+
+
+class MenuArgumentParser(argparse.ArgumentParser):
+
+    def __init__(self, output: TextIO = None, **kwargs):
+        super().__init__(**kwargs)
+        self.output = output
+
+    def _print_message(self, message: str, file: TextIO = None) -> None:
+        # Help and usage errors of commands forwarded to the daemon are sent back to the client
+        super()._print_message(message, self.output or file)
 
 
 class Menu:
 
     def __init__(self, log_file: str, cache_files: dict, csv_files: dict, freeipa_gids: dict,
-                 valid_sync_email_domains: list, cache_path: str, cache_validity: int, password_gracious_period: int,
-                 notification_days: list):
+                 valid_sync_email_domains: list, cache_path: str, cache_validity: int, cache_backends: list,
+                 password_gracious_period: int, notification_days: list):
 
         self.log_file = log_file
         self.cache_files = cache_files
@@ -28,6 +40,7 @@ class Menu:
         self.valid_sync_email_domains = self.__get_string_from_list(list(valid_sync_email_domains))
         self.cache_path = cache_path
         self.cache_validity = cache_validity
+        self.cache_backends = cache_backends
         self.password_gracious_period = password_gracious_period
         self.notification_days = notification_days
 
@@ -51,11 +64,11 @@ class Menu:
         else:
             return ''
 
-    def generate_menu(self) -> (argparse.ArgumentParser, argparse.Namespace):
+    def generate_menu(self, args: list = None, output: TextIO = None) -> (argparse.ArgumentParser, argparse.Namespace):
         valid_user_groups = self.__get_string_from_list(list(self.freeipa_gids))
 
-        argparser = argparse.ArgumentParser(
-
+        argparser = MenuArgumentParser(
+            output=output,
             description='FreeIPA Manager is a program conceived to facilitate user management in FreeIPA, offering '
                         'batch user imports and updates, user synchronization with Active Directory or password '
                         'expiration email notifications among other things. '
@@ -66,8 +79,9 @@ class Menu:
         main_functions.add_argument('-s', '--check-servers',
                                     help='checks the reachability of the SMTP, FreeIPA and AD servers performing a '
                                          'simple TCP port analysis for SMTP, HTTPS and LDAPS. '
-                                         'The program will always check the availability of the servers upon '
-                                         'execution, but this option is useful for quick health checks',
+                                         'The program always checks the availability of the servers needed by the '
+                                         'requested option before running it, but this option is useful for quick '
+                                         'health checks',
                                     action='store_true')
 
         main_functions.add_argument('-b', '--check-cache',
@@ -117,6 +131,19 @@ class Menu:
                                          'cache',
                                     action='store_true')
 
+        main_functions.add_argument('-j', '--migrate-cache',
+                                    help='copies the local AD and FreeIPA user caches from the cache backend '
+                                         'configured in cache_settings.backend into the backend given in the argument, '
+                                         'keeping the original cache age. '
+                                         'Valid backends are '
+                                         f'{self.__get_string_from_list(self.cache_backends)}. '
+                                         "The 'json' backend stores each cache in a single file, while the 'sqlite' "
+                                         'backend stores one indexed row per user, making single user lookups and '
+                                         'updates much faster on large directories. '
+                                         'Update cache_settings.backend after migrating to start using the new backend',
+                                    choices=self.cache_backends,
+                                    metavar='BACKEND')
+
         main_functions.add_argument('-d', '--disable-user',
                                     help='disables the user provided in the argument. '
                                          'The given user name must use the dotted user_id format, following '
@@ -220,6 +247,9 @@ class Menu:
                                          'Keep in mind that most of the data imported through this option will be '
                                          "overwritten for users built in the AD server upon server synchronization "
                                          'via the -u (--update-from-ad) option. '
+                                         'An interrupted import is resumed from a plan saved in the cache directory, '
+                                         'which holds the temporary passwords of the new users until their account '
+                                         'notifications are sent. '
                                          'If no file path is provided as an argument, the script will attempt to '
                                          f"load import data from ./{self.csv_files['import_file']}",
                                     dest='import_file',
@@ -254,6 +284,16 @@ class Menu:
                                          'language, phone number and manager -if exists in FreeIPA',
                                     action='store_true')
 
+        main_functions.add_argument('-P', '--plan-from-ad',
+                                    help='calculates the changes the -u (--update-from-ad) and -l '
+                                         '(--process-terminated-users) options would apply and saves them as plans in '
+                                         'the cache directory without modifying FreeIPA, so they can be reviewed. '
+                                         'Those options apply a saved plan instead of comparing users again, as long '
+                                         'as the AD and FreeIPA caches were not refreshed since and the plan is not '
+                                         'older than plan_max_age, and resume it from the last completed user when a '
+                                         'previous run was interrupted',
+                                    action='store_true')
+
         main_functions.add_argument('-k', '--process-password-expirations',
                                     help='reviews the password expiration dates for all the existing FreeIPA users, '
                                          'notifies users close to expiration and disables those whose password has '
@@ -285,7 +325,10 @@ class Menu:
                                          "Users with emails of other domains are out of AD's server scope "
                                          'and their information cannot be retrieved through AD LDAP lookups. '
                                          'Any FreeIPA user not found in AD will automatically be considered terminated '
-                                         "and will be deleted and moved to the 'preserved users' group. "
+                                         "and will be deleted and moved to the 'preserved users' group, once missing "
+                                         'from the number of consecutive AD refreshes set in the terminated_users sync '
+                                         'settings. No user is deleted when more terminated users than the '
+                                         'max_deletions setting are found at once. '
                                          "Admins can re-enable preserved users from FreeIPA's Web GUI, but will need "
                                          'to reconfigure their aliases, groups and password. '
                                          'Terminated users not tracked in AD are not evaluated by this function and '
@@ -310,6 +353,24 @@ class Menu:
                                          'same value',
                                     action='store_true')
 
+        main_functions.add_argument('-S', '--dispatch-mail',
+                                    help='sends the emails waiting in the spool directory whose delivery failed '
+                                         "earlier, when using the 'spool' delivery mode. Emails are only retried when "
+                                         'another email is sent or by the daemon, so this option is designed to be run '
+                                         'on a cronjob every few minutes when the daemon is not used',
+                                    action='store_true')
+
+        main_functions.add_argument('-D', '--daemon',
+                                    help='runs the program as a long-running daemon keeping the FreeIPA and AD '
+                                         'connections and the user caches in memory. '
+                                         'The daemon runs the cache refresh, AD synchronization, terminated users and '
+                                         'password expiration jobs at the intervals configured in '
+                                         'daemon_settings.jobs and listens on a local UNIX socket. '
+                                         'While the daemon is running, any other option is forwarded to it and '
+                                         'answered without logging into the servers again. '
+                                         'The -v, -y and -z options only apply to the daemon process itself',
+                                    action='store_true')
+
         output_level = argparser.add_mutually_exclusive_group()
 
         output_level.add_argument('-q', '--quiet',
@@ -343,4 +404,4 @@ class Menu:
                                      'execution using the -v (--verbose) option',
                                 action='store_true')
 
-        return argparser, argparser.parse_args()
+        return argparser, argparser.parse_args(args)
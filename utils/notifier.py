@@ -16,21 +16,42 @@ import datetime
 import logging
 import smtplib
 from email.message import EmailMessage
-from email.utils import make_msgid as create_msgid
+from typing import Callable
 
-import html2text
+from utils.health_monitor import HealthMonitor
+from utils.mail_spool import MailSpool
+from utils.smtp_pool import SMTPPool
+from utils.template_registry import TemplateRegistry
 
 
 class Notifier:
 
-    def __init__(self, smtp_relay_server: str, from_email: str, admin_emails: str, template_files: dict,
-                 password_gracious_period: int):
+    def __init__(self, smtp_relay_server: str, from_email: str, get_admin_emails: Callable[[], str],
+                 template_files: dict, password_gracious_period: int, health_monitor: HealthMonitor = None,
+                 smtp_connections: int = 1, smtp_messages_per_connection: int = 100, delivery_mode: str = 'direct',
+                 spool_path: str = None, spool_settings: dict = None):
         self.log = logging.getLogger('freeipa_manager')
         self.smtp_relay_server = smtp_relay_server
+        self.smtp_pool = SMTPPool(smtp_relay_server,
+                                  max_connections=smtp_connections,
+                                  messages_per_connection=smtp_messages_per_connection)
+        self.mail_spool = None
+
+        if delivery_mode == 'spool':
+            self.mail_spool = MailSpool(spool_path,
+                                        smtp_pool=self.smtp_pool,
+                                        health_monitor=health_monitor,
+                                        workers=spool_settings['workers'],
+                                        max_attempts=spool_settings['max_attempts'],
+                                        backoff=spool_settings['backoff'],
+                                        max_backoff=spool_settings['max_backoff'])
         self.from_email = from_email
-        self.admin_emails = admin_emails
+        # Admins come and go while the daemon runs, they are looked up for every report
+        self.get_admin_emails = get_admin_emails
         self.template_files = template_files
+        self.template_registry = TemplateRegistry(template_files)
         self.password_gracious_period = password_gracious_period
+        self.health_monitor = health_monitor
 
     @staticmethod
     def __get_alias_p(user_id: str, alias: str) -> str:
@@ -81,39 +102,56 @@ class Notifier:
         msg['Subject'] = subject
 
         try:
-            with open(self.template_files[template_name], 'r') as template:
-                html_body = template.read().replace('\n', '')
+            plain_body, html_body = self.template_registry.render(template_name, template_fields)
 
-            h = html2text.HTML2Text()
-            h.ignore_links = True
-            h.ignore_images = True
-            h.ignore_emphasis = True
-            h.ignore_anchors = True
-            h.ignore_tables = True
+            msg.set_content(plain_body)
+            msg.add_alternative(html_body, subtype='html')
 
-            company_logo_cid = create_msgid()
+            html_part = msg.get_payload()[1]
+            html_part.make_related()
+            html_part.attach(self.template_registry.get_logo_part())
 
-            plain_body = h.handle(html_body.format(company_logo_cid=company_logo_cid[1:-1], **template_fields))
+        except (OSError, KeyError) as e:
+            self.log.error(f'Email could not be created: {e}')
+            return False
 
-            msg.set_content(plain_body)
+        # Spooled emails are sent in the background, with retries, while the caller carries on
+        if self.mail_spool:
+            return self.mail_spool.enqueue(msg)
 
-            msg.add_alternative(html_body.format(company_logo_cid=company_logo_cid[1:-1],
-                                                 **template_fields), subtype='html')
+        if self.health_monitor and self.health_monitor.get_status('smtp') is False:
+            self.log.error('Email could not be sent: SMTP server marked as down after previous failures')
+            return False
 
-            with open(self.template_files['company_logo'], 'rb') as img:
-                msg.get_payload()[1].add_related(img.read(), 'image', 'png', cid=company_logo_cid)
+        try:
+            self.smtp_pool.send_message(msg)
+            self.log.debug('Email sent successfully')
 
-            with smtplib.SMTP(self.smtp_relay_server) as s:
-                s.send_message(msg)
-                self.log.debug('Email sent successfully')
-                s.quit()
+            if self.health_monitor and self.health_monitor.get_status('smtp') is not True:
+                self.health_monitor.record('smtp', True)
 
             return True
 
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+            self.log.error(f'Email could not be sent: {e}')
+            return False
+
         except (OSError, smtplib.SMTPException) as e:
             self.log.error(f'Email could not be sent: {e}')
+
+            # Stop later emails of the same run from waiting on a relay that is not answering
+            if self.health_monitor:
+                self.health_monitor.record('smtp', False)
+
             return False
 
+    def dispatch_mail(self) -> int:
+
+        if not self.mail_spool:
+            return 0
+
+        return self.mail_spool.dispatch()
+
     def notify_expiration(self, user_id: str, email: str, name: str, days_to_expiration: int,
                           expiration_date: datetime.date) -> bool:
 
@@ -163,7 +201,7 @@ class Notifier:
     def report_ad_updates(self, updated_users_list: list) -> bool:
 
         template = 'report_ad_updates'
-        recipients = self.admin_emails
+        recipients = self.get_admin_emails()
         subject = f"FreeIPA AD Synchronization Update Report for {datetime.datetime.now().date().strftime('%m/%d/%Y')}"
 
         updated_users = ''
@@ -179,7 +217,7 @@ class Notifier:
         self.log.debug('Sending password expiration report to admins')
 
         template = 'report_expirations'
-        recipients = self.admin_emails
+        recipients = self.get_admin_emails()
         subject = f"Password expiration report for {datetime.datetime.now().date().strftime('%m/%d/%Y')}"
 
         expired_users_li = ''
@@ -221,7 +259,7 @@ class Notifier:
     def report_terminated(self, deleted_users_list: list, not_deleted_users_list: list) -> bool:
 
         template = 'report_terminated'
-        recipients = self.admin_emails
+        recipients = self.get_admin_emails()
         subject = f"User Termination Report for {datetime.datetime.now().date().strftime('%m/%d/%Y')}"
 
         deleted_users = ''
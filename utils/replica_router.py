@@ -0,0 +1,93 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import logging
+import threading
+
+from utils.health_monitor import HealthMonitor
+
+
+class ReplicaRouter:
+
+    # Weight of the latest request in the average latency of a replica
+    latency_weight = 0.3
+
+    def __init__(self, hosts: list, health_monitor: HealthMonitor = None):
+        self.log = logging.getLogger('freeipa_manager')
+        self.hosts = hosts
+        self.health_monitor = health_monitor
+        self.write_host = hosts[0]
+        self.latencies = {host: None for host in hosts}
+        self.requests_in_flight = {host: 0 for host in hosts}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def __get_health_key(host: str) -> str:
+        return f'freeipa:{host}'
+
+    def __is_host_available(self, host: str) -> bool:
+        return not self.health_monitor or self.health_monitor.get_status(self.__get_health_key(host)) is not False
+
+    def __get_read_score(self, host: str) -> float:
+        # Replicas without samples are tried first, busy replicas look slower than idle ones
+        return (self.latencies[host] or 0) * (self.requests_in_flight[host] + 1)
+
+    def finish_request(self, host: str, latency: float, failed: bool) -> None:
+        with self.lock:
+            self.requests_in_flight[host] -= 1
+
+            if failed:
+                return
+
+            if self.latencies[host] is None:
+                self.latencies[host] = latency
+            else:
+                self.latencies[host] += self.latency_weight * (latency - self.latencies[host])
+
+        if self.health_monitor and self.health_monitor.get_status(self.__get_health_key(host)) is not True:
+            self.health_monitor.record(self.__get_health_key(host), True)
+
+    def mark_host_down(self, host: str) -> None:
+        self.log.warning(f'FreeIPA server {host} failed, routing requests to other servers')
+
+        if self.health_monitor:
+            self.health_monitor.record(self.__get_health_key(host), False)
+
+    def select_host(self, read_only: bool, excluded_hosts: set) -> str:
+        candidates = [host for host in self.hosts if host not in excluded_hosts]
+        available_hosts = [host for host in candidates if self.__is_host_available(host)]
+
+        # With every server marked as down, one is still tried instead of failing without a request
+        if not available_hosts:
+            available_hosts = candidates[:1]
+
+        if not available_hosts:
+            return None
+
+        with self.lock:
+            if read_only:
+                host = min(available_hosts, key=self.__get_read_score)
+
+            else:
+                # Writes stay on a single server, so changes are read back consistently within a run
+                if self.write_host not in available_hosts:
+                    self.log.warning(f'FreeIPA server {self.write_host} unavailable, sending changes to '
+                                     f'{available_hosts[0]}')
+                    self.write_host = available_hosts[0]
+
+                host = self.write_host
+
+            self.requests_in_flight[host] += 1
+
+        return host
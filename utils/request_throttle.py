@@ -0,0 +1,108 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import logging
+import threading
+import time
+
+
+class RequestThrottle:
+
+    def __init__(self, rate_limit: float = 0, burst: int = 10, min_concurrency: int = 1, max_concurrency: int = 8,
+                 latency_threshold: float = 2.0, decrease_factor: float = 0.5):
+        self.log = logging.getLogger('freeipa_manager')
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.latency_threshold = latency_threshold
+        self.decrease_factor = decrease_factor
+
+        self.condition = threading.Condition()
+        self.tokens = float(burst)
+        self.tokens_updated_at = time.monotonic()
+        self.concurrency_limit = float(min_concurrency)
+        self.last_decrease_at = 0.0
+        self.requests_in_flight = 0
+        self.metrics = {}
+
+    def __adjust_concurrency(self, latency: float, failed: bool) -> None:
+        now = time.monotonic()
+
+        if failed or latency > self.latency_threshold:
+            # Requests started before the last decrease still carry the old load, they must not shrink it again
+            if now - self.last_decrease_at > self.latency_threshold:
+                self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit * self.decrease_factor)
+                self.last_decrease_at = now
+                self.log.debug(f'FreeIPA server slow or failing, concurrency limit lowered to '
+                               f'{int(self.concurrency_limit)}')
+        else:
+            # Additive increase, about one extra request in flight per round of successful requests
+            self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1 / self.concurrency_limit)
+
+    def __get_token_wait(self) -> float:
+        if not self.rate_limit:
+            return 0
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.tokens_updated_at) * self.rate_limit)
+        self.tokens_updated_at = now
+
+        if self.tokens >= 1:
+            return 0
+
+        return (1 - self.tokens) / self.rate_limit
+
+    def __record_metrics(self, method: str, latency: float, failed: bool) -> None:
+        if method not in self.metrics:
+            self.metrics[method] = {'requests': 0, 'errors': 0, 'total_latency': 0.0, 'max_latency': 0.0}
+
+        method_metrics = self.metrics[method]
+        method_metrics['requests'] += 1
+        method_metrics['errors'] += int(failed)
+        method_metrics['total_latency'] += latency
+        method_metrics['max_latency'] = max(method_metrics['max_latency'], latency)
+
+    def acquire(self) -> None:
+        with self.condition:
+            while True:
+                if self.requests_in_flight < int(self.concurrency_limit):
+                    token_wait = self.__get_token_wait()
+
+                    if not token_wait:
+                        break
+                else:
+                    token_wait = None
+
+                self.condition.wait(timeout=token_wait)
+
+            if self.rate_limit:
+                self.tokens -= 1
+
+            self.requests_in_flight += 1
+
+    def get_metrics(self) -> dict:
+        with self.condition:
+            return {method: {'requests': self.metrics[method]['requests'],
+                             'errors': self.metrics[method]['errors'],
+                             'avg_latency': self.metrics[method]['total_latency'] / self.metrics[method]['requests'],
+                             'max_latency': self.metrics[method]['max_latency']}
+                    for method in self.metrics}
+
+    def release(self, method: str, latency: float, failed: bool) -> None:
+        with self.condition:
+            self.requests_in_flight -= 1
+            self.__adjust_concurrency(latency, failed)
+            self.__record_metrics(method, latency, failed)
+            self.condition.notify_all()
@@ -0,0 +1,123 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import atexit
+import logging
+import queue
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+
+
+class SMTPConnection:
+
+    def __init__(self, smtp_relay_server: str, timeout: int):
+        self.smtp = smtplib.SMTP(smtp_relay_server, timeout=timeout)
+        self.sent_messages = 0
+        self.last_used = time.monotonic()
+
+
+class SMTPPool:
+
+    def __init__(self, smtp_relay_server: str, max_connections: int = 1, messages_per_connection: int = 100,
+                 idle_timeout: int = 60, timeout: int = 30):
+        self.log = logging.getLogger('freeipa_manager')
+        self.smtp_relay_server = smtp_relay_server
+        self.max_connections = max_connections
+        self.messages_per_connection = messages_per_connection
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self.idle_connections = queue.LifoQueue()
+        self.connection_slots = threading.BoundedSemaphore(max_connections)
+
+        # Sessions left open at the end of a run are closed politely instead of being dropped
+        atexit.register(self.close)
+
+    def __close_connection(self, connection: SMTPConnection) -> None:
+        try:
+            connection.smtp.quit()
+
+        except (OSError, smtplib.SMTPException):
+            connection.smtp.close()
+
+    def __get_connection(self) -> SMTPConnection:
+        while True:
+            try:
+                connection = self.idle_connections.get_nowait()
+
+            except queue.Empty:
+                self.log.debug(f'Opening SMTP connection to {self.smtp_relay_server}')
+                return SMTPConnection(self.smtp_relay_server, self.timeout)
+
+            # Relays drop idle sessions on their own, reusing one would cost a failed command before reconnecting
+            if time.monotonic() - connection.last_used < self.idle_timeout:
+                return connection
+
+            self.__close_connection(connection)
+
+    def __release_connection(self, connection: SMTPConnection) -> None:
+        connection.last_used = time.monotonic()
+
+        if connection.sent_messages >= self.messages_per_connection:
+            self.log.debug(f'SMTP connection reached {self.messages_per_connection} messages, closing it')
+            self.__close_connection(connection)
+        else:
+            self.idle_connections.put(connection)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self.__close_connection(self.idle_connections.get_nowait())
+
+            except queue.Empty:
+                return
+
+    def send_message(self, msg: EmailMessage) -> None:
+        with self.connection_slots:
+            connection = self.__get_connection()
+
+            try:
+                connection.smtp.send_message(msg)
+
+            except smtplib.SMTPRecipientsRefused:
+                self.__release_connection(connection)
+                raise
+
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException) as e:
+                # Only a dropped session or a 421 (service closing) is retried, the message was not accepted in
+                # either case. Other refusals leave the session reset and usable
+                if isinstance(e, smtplib.SMTPResponseException) and e.smtp_code != 421:
+                    self.__release_connection(connection)
+                    raise
+
+                self.log.debug(f'SMTP connection lost ({e}), sending email on a new connection')
+                connection.smtp.close()
+
+                connection = SMTPConnection(self.smtp_relay_server, self.timeout)
+
+                try:
+                    connection.smtp.send_message(msg)
+
+                except (OSError, smtplib.SMTPException):
+                    connection.smtp.close()
+                    raise
+
+            except (OSError, smtplib.SMTPException):
+                connection.smtp.close()
+                raise
+
+            connection.sent_messages += 1
+            self.__release_connection(connection)
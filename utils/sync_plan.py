@@ -0,0 +1,167 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import datetime
+import json
+import logging
+import os
+import uuid
+from typing import Callable
+
+
+class SyncPlan:
+
+    def __init__(self, plan_path: str, max_age: int = 0):
+        self.log = logging.getLogger('freeipa_manager')
+        self.plan_path = plan_path
+        self.max_age = max_age
+
+    def __get_journal_file(self, action: str) -> str:
+        return f'{self.plan_path}/{action}_plan.journal'
+
+    @staticmethod
+    def __record(fp, plan: dict, results: dict) -> None:
+        # Failed operations are not recorded, a resumed plan tries them again
+        for key in results:
+            if results[key]:
+                fp.write(json.dumps({'plan_id': plan['plan_id'], 'key': key, 'done': True}) + '\n')
+
+        # Operations are only considered applied once their journal entries reach the disk
+        fp.flush()
+        os.fsync(fp.fileno())
+
+    def apply(self, plan: dict, run_operations: Callable[[dict], dict], chunk_size: int = 1,
+              keep: bool = False) -> dict:
+        operations = plan['operations']
+        results = self.get_completed(plan)
+        pending = [key for key in operations if key not in results]
+
+        if results:
+            self.log.info(f"Resuming {plan['action']} plan {plan['plan_id']}: {len(results)} of {len(operations)} "
+                          'operation(s) already applied')
+
+        if pending:
+            journal_file = self.__get_journal_file(plan['action'])
+
+            with os.fdopen(os.open(journal_file, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600), 'a+') as fp:
+                journal_size = fp.tell()
+
+                # An entry cut short by a crash must not swallow the first entry of this run
+                if journal_size:
+                    fp.seek(journal_size - 1)
+
+                    if fp.read(1) != '\n':
+                        fp.write('\n')
+
+                for i in range(0, len(pending), chunk_size):
+                    chunk = {key: operations[key] for key in pending[i:i + chunk_size]}
+                    chunk_results = run_operations(chunk)
+
+                    chunk_results = {key: bool(chunk_results.get(key)) for key in chunk}
+                    self.__record(fp, plan, chunk_results)
+                    results.update(chunk_results)
+
+        self.log.debug(f"{plan['action']} plan {plan['plan_id']} applied")
+
+        # Kept plans are discarded by the caller once it is done with the results
+        if not keep:
+            self.discard(plan['action'])
+
+        return results
+
+    def create(self, action: str, operations: dict, metadata: dict = None) -> dict:
+        plan = {'plan_id': uuid.uuid4().hex,
+                'action': action,
+                'created': datetime.datetime.now().isoformat(),
+                'metadata': metadata or {},
+                'operations': operations}
+
+        plan_file = self.get_plan_file(action)
+        temp_file = f'{plan_file}.{os.getpid()}.tmp'
+
+        # Nothing to resume from an empty plan
+        if not operations:
+            return plan
+
+        try:
+            # Import plans carry the temporary passwords of new users
+            with os.fdopen(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as fp:
+                json.dump(plan, fp, indent=2)
+
+            # A journal left by a previous plan does not apply to this one
+            if os.path.exists(self.__get_journal_file(action)):
+                os.remove(self.__get_journal_file(action))
+
+            os.replace(temp_file, plan_file)
+            self.log.debug(f'{action} plan {plan["plan_id"]} with {len(operations)} operation(s) saved to {plan_file}')
+
+        except (OSError, TypeError) as e:
+            self.log.warning(f'{action} plan could not be saved, it will not be resumable: {e}')
+
+        return plan
+
+    def discard(self, action: str) -> None:
+        for file in (self.get_plan_file(action), self.__get_journal_file(action)):
+            if os.path.exists(file):
+                os.remove(file)
+
+    def get_completed(self, plan: dict) -> dict:
+        completed = {}
+
+        try:
+            with open(self.__get_journal_file(plan['action']), 'r') as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+
+                    except json.decoder.JSONDecodeError:
+                        # Last entry cut short by a crash, its operation is applied again
+                        continue
+
+                    if entry.get('plan_id') == plan['plan_id'] and entry.get('key') in plan['operations'] and \
+                            entry.get('done'):
+                        completed[entry['key']] = True
+
+        except FileNotFoundError:
+            pass
+
+        return completed
+
+    def get_plan_file(self, action: str) -> str:
+        return f'{self.plan_path}/{action}_plan.json'
+
+    def load(self, action: str) -> dict:
+        try:
+            with open(self.get_plan_file(action), 'r') as fp:
+                plan = json.load(fp)
+
+        except FileNotFoundError:
+            return None
+
+        except (OSError, json.decoder.JSONDecodeError) as e:
+            self.log.warning(f'{action} plan could not be loaded, it will be calculated again: {e}')
+            return None
+
+        self.log.info(f"Pending {action} plan {plan['plan_id']} created on {plan['created']} found")
+
+        # Directories keep changing after a plan is calculated, old plans are calculated again instead of applied
+        if self.max_age and \
+                datetime.datetime.fromisoformat(plan['created']) + datetime.timedelta(minutes=self.max_age) < \
+                datetime.datetime.now():
+            self.log.warning(f"{action} plan {plan['plan_id']} is older than {self.max_age} minutes, it will be "
+                             'calculated again')
+            self.discard(action)
+            return None
+
+        return plan
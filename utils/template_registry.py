@@ -0,0 +1,117 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import functools
+import logging
+import re
+import string
+from email.message import MIMEPart
+from email.utils import make_msgid as create_msgid
+
+import html2text
+
+
+class TemplateRegistry:
+
+    logo_template = 'company_logo'
+
+    def __init__(self, template_files: dict):
+        self.log = logging.getLogger('freeipa_manager')
+        self.template_files = template_files
+
+        # A single content ID per process is enough, it only has to be unique within each email
+        self.logo_cid = create_msgid()
+        self.logo_part = None
+        self.templates = {}
+
+        self.__load_templates()
+
+    @staticmethod
+    def __get_html2text() -> html2text.HTML2Text:
+        h = html2text.HTML2Text()
+        h.ignore_links = True
+        h.ignore_images = True
+        h.ignore_emphasis = True
+        h.ignore_anchors = True
+        h.ignore_tables = True
+
+        # Lines are not wrapped, otherwise the field values substituted later would break the wrapping
+        h.body_width = 0
+
+        return h
+
+    @functools.lru_cache(maxsize=1024)
+    def __get_plain_field(self, value: str) -> str:
+        return self.__get_html2text().handle(value).strip()
+
+    def __get_plain_skeleton(self, html_body: str, fields: list) -> str:
+        # Placeholders are swapped with plain words that html2text leaves untouched, and restored afterwards
+        markers = {field: f'TEMPLATEFIELD{position}MARKER' for position, field in enumerate(fields)}
+
+        plain_body = self.__get_html2text().handle(html_body.format(**markers))
+        plain_body = plain_body.replace('{', '{{').replace('}', '}}')
+
+        for field in markers:
+            plain_body = plain_body.replace(markers[field], '{' + field + '}')
+
+        return plain_body
+
+    def __load_logo(self, logo_file: str) -> None:
+        with open(logo_file, 'rb') as img:
+            self.logo_part = MIMEPart()
+            self.logo_part.set_content(img.read(), 'image', 'png', cid=self.logo_cid, disposition='inline')
+
+    def __load_template(self, template_file: str) -> dict:
+        with open(template_file, 'r') as template:
+            html_body = template.read().replace('\n', '')
+
+        fields = list(dict.fromkeys(field for _, field, _, _ in string.Formatter().parse(html_body) if field))
+
+        return {'html': html_body, 'plain': self.__get_plain_skeleton(html_body, fields)}
+
+    def __load_templates(self) -> None:
+        self.log.debug('Loading email templates')
+
+        for template_name in self.template_files:
+            try:
+                if template_name == self.logo_template:
+                    self.__load_logo(self.template_files[template_name])
+                else:
+                    self.templates[template_name] = self.__load_template(self.template_files[template_name])
+
+            except (OSError, ValueError) as e:
+                self.log.error(f'Email template {template_name} could not be loaded: {e}')
+
+    def get_logo_part(self) -> MIMEPart:
+        if self.logo_part is None:
+            raise OSError(f'Email template {self.logo_template} is not available')
+
+        return self.logo_part
+
+    def render(self, template_name: str, template_fields: dict) -> (str, str):
+        if template_name not in self.templates:
+            raise OSError(f'Email template {template_name} is not available')
+
+        template = self.templates[template_name]
+        company_logo_cid = self.logo_cid[1:-1]
+
+        html_body = template['html'].format(company_logo_cid=company_logo_cid, **template_fields)
+
+        # Only fields carrying markup need html2text, the static text was converted when loading the template
+        plain_fields = {field: self.__get_plain_field(str(template_fields[field]))
+                        if '<' in str(template_fields[field]) else template_fields[field]
+                        for field in template_fields}
+        plain_body = template['plain'].format(company_logo_cid=company_logo_cid, **plain_fields)
+
+        return re.sub(r'\n{3,}', '\n\n', plain_body), html_body
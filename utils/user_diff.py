@@ -0,0 +1,84 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2021  Unai Goikoetxeta
+
+import logging
+import operator
+from typing import Callable
+
+
+class UserDiff:
+
+    def __init__(self, is_email_valid: Callable[[str], bool], ignore_keys_on_sync: list = None):
+        self.log = logging.getLogger('freeipa_manager')
+        self.is_email_valid = is_email_valid
+        self.ignore_keys_on_sync = set(ignore_keys_on_sync or [])
+
+    @staticmethod
+    def __compare_user(freeipa_user: dict, ad_user: dict, fields: list, freeipa_users: dict) -> dict:
+        user_updates = {}
+
+        for field in fields:
+            if field not in ad_user or field not in freeipa_user or ad_user[field] == freeipa_user[field]:
+                continue
+
+            # Managers not present in FreeIPA cannot be referenced by the user entry
+            if field == 'manager' and ad_user[field] not in freeipa_users:
+                continue
+
+            user_updates[field] = ad_user[field]
+
+        return user_updates
+
+    def compare(self, freeipa_users: dict, ad_users: dict, sync_fields: list) -> dict:
+        self.log.debug('Calculating differences between FreeIPA and AD users')
+
+        synchronizable_users = [user_id for user_id in freeipa_users
+                                if self.is_email_valid(freeipa_users[user_id].get('email') or '')]
+
+        common_users = [user_id for user_id in synchronizable_users if user_id in ad_users]
+
+        updates = {}
+        fields = sorted(set(sync_fields) - self.ignore_keys_on_sync)
+
+        if fields:
+            # Users are projected on the compared fields in a single C level call, only the few that differ are
+            # compared field by field
+            get_row = operator.itemgetter(*fields)
+
+            for user_id in common_users:
+                freeipa_user = freeipa_users[user_id]
+                ad_user = ad_users[user_id]
+
+                try:
+                    if get_row(freeipa_user) == get_row(ad_user):
+                        continue
+
+                except KeyError:
+                    pass
+
+                user_updates = self.__compare_user(freeipa_user, ad_user, fields, freeipa_users)
+
+                if user_updates:
+                    updates[user_id] = user_updates
+
+        change_set = {'update': updates,
+                      'create': sorted(user_id for user_id in ad_users
+                                       if user_id not in freeipa_users
+                                       and self.is_email_valid(ad_users[user_id].get('email') or '')),
+                      'terminate': sorted(set(synchronizable_users) - ad_users.keys())}
+
+        self.log.debug(f"Differences calculated: {len(change_set['update'])} user(s) to update, "
+                       f"{len(change_set['create'])} to create, {len(change_set['terminate'])} to terminate")
+
+        return change_set
@@ -12,45 +12,67 @@
 #
 # Copyright (C) 2021  Unai Goikoetxeta
 
+from __future__ import annotations
+
+import datetime
+import json
 import logging
 import os
 import socket
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
 
-import yaml
-
-from utils.ad_handler import ADHandler
 from utils.cache_handler import CacheHandler
-from utils.freeipa_handler import FreeIPAHandler
+from utils.health_monitor import HealthMonitor
 from utils.logger import Logger
 from utils.menu import Menu
-from utils.notifier import Notifier
+from utils.sync_plan import SyncPlan
+from utils.user_diff import UserDiff
+
+# The handlers pull python_freeipa, requests, ldap and html2text, they are only imported by the commands using them
+if TYPE_CHECKING:
+    from utils.ad_handler import ADHandler
+    from utils.freeipa_handler import FreeIPAHandler
+    from utils.notifier import Notifier
 
 
 class Utils:
 
+    servers = ['ad', 'freeipa', 'smtp']
+    settings_snapshot_file = 'settings_snapshot.json'
+    # Increase it whenever the settings loaded by __load_settings change, outdated snapshots are then ignored
+    settings_snapshot_version = 1
+
     def __init__(self, config_file: str):
 
         self.log = logging.getLogger('freeipa_manager')
 
         self.config_file = config_file
 
-        self.__load_settings(self.__load_config_file())
+        if not self.__load_settings_snapshot():
+            self.__load_settings(self.__load_config_file())
+            self.__save_settings_snapshot()
 
         self.logger = Logger(log_file=self.log_file,
                              log_level=self.log_level)
 
         self.cache_handler = CacheHandler(cache_files=self.cache_files,
-                                          cache_validity=self.cache_validity)
+                                          cache_validity=self.cache_validity,
+                                          cache_backend=self.cache_backend)
 
-        self.freeipa_handler = FreeIPAHandler(freeipa_credentials=self.freeipa_credentials,
-                                              freeipa_gids=self.freeipa_gids,
-                                              cache_handler=self.cache_handler,
-                                              csv_files=self.csv_files,
-                                              password_gracious_period=self.password_gracious_period)
+        self.health_monitor = HealthMonitor(state_file=self.cache_files['health_state'],
+                                            validity=self.health_check_validity,
+                                            backoff=self.health_check_backoff,
+                                            max_backoff=self.health_check_max_backoff)
 
-        self.ad_handler = ADHandler(ad_settings=self.ad_settings,
-                                    cache_handler=self.cache_handler,
-                                    corporate_email_domains=self.corporate_email_domains)
+        self.sync_plan = SyncPlan(plan_path=self.paths['cache'],
+                                  max_age=self.sync_plan_max_age)
+
+        self.user_diff = UserDiff(is_email_valid=self.is_email_valid,
+                                  ignore_keys_on_sync=self.ignore_keys_on_sync)
+
+        self.freeipa_handler = None
+        self.ad_handler = None
         self.notifier = None
 
         self.menu = Menu(log_file=self.log_file,
@@ -60,6 +82,7 @@ class Utils:
                          valid_sync_email_domains=self.valid_sync_email_domains,
                          cache_path=self.paths['cache'],
                          cache_validity=self.cache_validity,
+                         cache_backends=CacheHandler.cache_backends,
                          password_gracious_period=self.password_gracious_period,
                          notification_days=self.notification_days,
                          )
@@ -101,7 +124,7 @@ class Utils:
 
             return True
 
-        except (socket.timeout, ConnectionRefusedError):
+        except OSError:
             self.log.debug(f'TCP check to {host}:{port} unsuccessful')
 
             return False
@@ -109,94 +132,209 @@ class Utils:
         finally:
             s.close()
 
-    def __diff_freeipa_ad_user(self, user_id: str) -> bool:
+    def __get_user_changes(self) -> dict:
 
-        ad_user = self.ad_handler.get_ad_user(user_id)
-        freeipa_user = self.freeipa_handler.get_freeipa_user(user_id)
+        self.log.debug('Obtaining changes between AD and FreeIPA users')
 
-        return_value = {}
+        # Both directories are loaded once and compared as a whole, instead of looking up each user in them
+        freeipa_users = self.get_freeipa_handler().get_freeipa_users()
+        ad_users = self.get_ad_handler().get_ad_users()
 
-        if self.freeipa_handler.get_freeipa_users() and freeipa_user and ad_user and user_id:
+        if not freeipa_users or not ad_users:
+            self.log.error('AD or FreeIPA users could not be obtained, changes cannot be calculated')
+            return None
 
-            self.log.debug(f'Calculating differences between FreeIPA and AD records for user {user_id}')
+        # Only fields read from AD and kept for FreeIPA users can be synchronized
+        sync_fields = [field for field in self.get_ad_handler().user_fields
+                       if field in self.get_freeipa_handler().user_fields]
 
-            for key in freeipa_user:
-                if key in ad_user and key not in self.ignore_keys_on_sync:
+        return self.user_diff.compare(freeipa_users, ad_users, sync_fields)
 
-                    if ad_user[key] != freeipa_user[key]:
+    def __get_cache_update_times(self) -> dict:
 
-                        if key == 'manager':
-                            if ad_user[key] in self.freeipa_handler.get_freeipa_users():
-                                return_value[key] = ad_user[key]
-                                self.log.debug(f'New value for {key} found: {ad_user[key]}')
-                        else:
-                            return_value[key] = ad_user[key]
-                            self.log.debug(f'New value for {key} found: {ad_user[key]}')
+        # Outdated caches are refreshed first, plans are only applied on top of the data they were calculated from
+        self.get_freeipa_handler().get_freeipa_users()
+        self.get_ad_handler().get_ad_users()
 
-            if return_value != {}:
-                self.log.debug(f'All differences identified for user {user_id}')
-            else:
-                self.log.debug(f'No differences found for user {user_id}')
+        cache_update_times = {}
 
-        else:
-            self.log.warning('No valid data provided for difference calculation')
+        for cache in CacheHandler.user_caches:
+            update_time = self.cache_handler.get_cache_update_time(cache)
+            cache_update_times[cache] = update_time.isoformat() if update_time else None
 
-        return return_value
+        return cache_update_times
 
-    def __get_terminated_users(self) -> list:
+    def __get_terminated_users(self, user_changes: dict) -> dict:
 
         self.log.debug('Obtaining list of terminated users')
-        terminated_users = []
-
-        for user in self.freeipa_handler.get_freeipa_users():
-            if user not in self.ad_handler.get_ad_users() and self.__is_user_synchronizable(user):
-                terminated_users.append(user)
-                self.log.debug(f'User {user} has been terminated')
 
-        if not terminated_users:
-            self.log.debug('No terminated users found')
-        else:
-            self.log.debug('List of terminated users obtained')
+        preserved_users = self.get_freeipa_handler().get_preserved_users()
 
-        return terminated_users
+        if preserved_users is None:
+            return None
 
-    def __is_user_synchronizable(self, user_id: str) -> bool:
+        ad_update_time = self.cache_handler.get_cache_update_time('ad_cache')
+        ad_refresh = ad_update_time.isoformat() if ad_update_time else None
+        now = datetime.datetime.now().isoformat()
 
-        self.log.debug(f'Identifying if user {user_id} can be synchronized with AD')
+        terminated_state = self.cache_handler.get_terminated_users_state() or {}
+        missing_users = {}
 
-        user = self.freeipa_handler.get_freeipa_user(user_id)
+        # Users back in AD are dropped from the state, so only consecutive refreshes count towards the grace window
+        for user in set(user_changes['terminate']) - preserved_users:
+            previous = terminated_state.get(user)
 
-        if user is not None:
-            if self.is_email_valid(user['email']):
-                self.log.debug('User should be in AD, can be synchronized')
-                return True
+            if previous:
+                missing_users[user] = {'missing_since': previous['missing_since'],
+                                       'missing_refreshes': previous['missing_refreshes'] +
+                                       int(previous['ad_refresh'] != ad_refresh),
+                                       'ad_refresh': ad_refresh}
             else:
-                self.log.debug('User will not be in AD, cannot be synchronized')
-                return False
-        else:
-            self.log.warning('No user given to evaluate synchronization')
+                missing_users[user] = {'missing_since': now, 'missing_refreshes': 1, 'ad_refresh': ad_refresh}
+
+        self.cache_handler.save_terminated_users_state(missing_users)
+
+        terminated_users = {user: missing_users[user] for user in sorted(missing_users)
+                            if missing_users[user]['missing_refreshes'] >= self.terminated_grace_refreshes}
+
+        for user in missing_users:
+            if user not in terminated_users:
+                self.log.info(f"User {user} missing from AD in {missing_users[user]['missing_refreshes']} of "
+                              f'{self.terminated_grace_refreshes} refreshes required for deletion')
+
+        return terminated_users
+
+    def __is_deletion_allowed(self, terminated_users: dict) -> bool:
+
+        # A partial AD search looks like a mass termination, it is never acted upon
+        if self.terminated_max_deletions and len(terminated_users) > self.terminated_max_deletions:
+            self.log.error(f'{len(terminated_users)} terminated users found, more than the '
+                           f'{self.terminated_max_deletions} allowed to be deleted at once. No user will be deleted, '
+                           'check that AD returns all users')
             return False
 
+        return True
+
+    def __load_plan(self, action: str) -> dict:
+
+        plan = self.sync_plan.load(action)
+
+        if plan is None:
+            return None
+
+        # Caches refreshed since the plan was calculated may hold users back in AD or newer FreeIPA data
+        if plan['metadata'].get('cache_update_times') != self.__get_cache_update_times():
+            self.log.warning(f"{action} plan {plan['plan_id']} was calculated from AD and FreeIPA caches refreshed "
+                             'since then, it will be calculated again')
+            self.sync_plan.discard(action)
+            return None
+
+        return plan
+
+    def __plan_terminated_users(self, user_changes: dict) -> dict:
+
+        terminated_users = self.__get_terminated_users(user_changes) if user_changes is not None else None
+
+        if terminated_users is None:
+            self.log.error('Terminated users could not be identified')
+            return None
+
+        if not self.__is_deletion_allowed(terminated_users):
+            return None
+
+        return self.sync_plan.create('terminated_users', terminated_users,
+                                     metadata={'cache_update_times': self.__get_cache_update_times()})
+
+    def __plan_user_updates(self, user_changes: dict) -> dict:
+
+        if user_changes is None:
+            self.log.error('User data could not be synchronized from AD')
+            return None
+
+        return self.sync_plan.create('update_from_ad', user_changes['update'],
+                                     metadata={'cache_update_times': self.__get_cache_update_times()})
+
+    def __run_user_deletions(self, terminated_users: dict) -> dict:
+
+        deleted_users, _ = self.get_freeipa_handler().delete_freeipa_users(list(terminated_users))
+
+        return {user: True for user in deleted_users}
+
+    def __run_user_updates(self, updated_user_data: dict) -> dict:
+
+        updated_users, not_updated_users = self.get_freeipa_handler().update_freeipa_users(updated_user_data,
+                                                                                           update_cache=False)
+
+        for user in updated_users:
+            self.log.debug(f'User {user} updated, the following fields were updated successfully:')
+            for key in updated_user_data[user]:
+                self.log.debug(f' - {key}: {updated_user_data[user][key]}')
+
+        for user in not_updated_users:
+            self.log.warning(f'User {user} could not be updated')
+
+        return {user: True for user in updated_users}
+
+    def __get_settings_snapshot_key(self) -> dict:
+
+        config_stat = os.stat(self.config_file)
+
+        return {'version': self.settings_snapshot_version,
+                'config_file': self.config_file,
+                'config_mtime': config_stat.st_mtime_ns,
+                'config_size': config_stat.st_size}
+
+    def __get_settings_snapshot_path(self) -> str:
+
+        return os.path.dirname(self.config_file) + '/cache/' + self.settings_snapshot_file
+
     def __load_config_file(self) -> dict:
 
+        import yaml
+
         settings = None
 
         try:
             self.log.info(f'Loading settings from config file {self.config_file}')
             with open(self.config_file, newline='') as yamlfile:
-                settings = yaml.load(yamlfile, Loader=yaml.FullLoader)
+                # The libyaml based loader is much faster when PyYAML was built with it
+                settings = yaml.load(yamlfile, Loader=getattr(yaml, 'CSafeLoader', yaml.FullLoader))
 
         except (OSError, yaml.YAMLError) as e:
             self.log.error(f'Could not import configs from YAML file {self.config_file} due to an error: {e}')
 
         return settings
 
+    def __load_settings_snapshot(self) -> bool:
+
+        snapshot_path = self.__get_settings_snapshot_path()
+
+        try:
+            with open(snapshot_path, 'r') as fp:
+                snapshot = json.load(fp)
+
+            if snapshot['key'] != self.__get_settings_snapshot_key():
+                self.log.debug('Settings snapshot outdated, loading config file')
+                return False
+
+        except (OSError, KeyError, json.decoder.JSONDecodeError):
+            self.log.debug('No valid settings snapshot available, loading config file')
+            return False
+
+        self.log.info(f'Loading settings from snapshot {snapshot_path}')
+
+        for setting in snapshot['settings']:
+            setattr(self, setting, snapshot['settings'][setting])
+
+        return True
+
     def __load_settings(self, settings: dict) -> None:
 
         root_path = os.path.dirname(self.config_file)
 
         self.paths = {'main': root_path,
                       'cache': root_path+'/cache',
+                      'spool': root_path+'/spool',
                       'templates': root_path+'/templates'}
 
         self.csv_files = {'import_template': 'import_template.csv',
@@ -204,15 +342,33 @@ class Utils:
                           'import_file': 'import_data.csv'}
 
         self.ad_settings = settings['ad_settings']
+        self.ad_sync_mode = settings['ad_settings']['sync_mode']
+        self.ad_full_sync_interval = settings['ad_settings']['full_sync_interval']
 
         self.freeipa_credentials = settings['freeipa_settings']['credentials']
         self.freeipa_gids = settings['freeipa_settings']['gids']
+        self.freeipa_batch_size = settings['freeipa_settings']['batch_size']
+        self.freeipa_fetch_mode = settings['freeipa_settings']['fetch_mode']
+        self.freeipa_fetch_workers = settings['freeipa_settings']['fetch_workers']
+        self.freeipa_update_workers = settings['freeipa_settings']['update_workers']
+        self.freeipa_search_size_limit = settings['freeipa_settings']['search_size_limit']
+        self.freeipa_refresh_mode = settings['freeipa_settings']['refresh_mode']
+        self.freeipa_ldap_settings = settings['freeipa_settings'].get('ldap')
+        self.freeipa_read_engine = settings['freeipa_settings']['read_engine']
+        self.freeipa_throttle_settings = settings['freeipa_settings']['throttle']
 
         self.ignore_keys_on_sync = settings['sync_settings']['ignore_keys_on_sync']
         self.corporate_email_domains = settings['sync_settings']['corporate_email_domains']
         self.valid_sync_email_domains = settings['sync_settings']['valid_sync_email_domains']
+        self.terminated_grace_refreshes = settings['sync_settings']['terminated_users']['grace_refreshes']
+        self.terminated_max_deletions = settings['sync_settings']['terminated_users']['max_deletions']
+        self.sync_plan_max_age = settings['sync_settings']['plan_max_age']
 
         self.smtp_relay_server = settings['notification_settings']['smtp_relay_server']
+        self.smtp_connections = settings['notification_settings']['smtp_connections']
+        self.smtp_messages_per_connection = settings['notification_settings']['smtp_messages_per_connection']
+        self.mail_delivery_mode = settings['notification_settings']['delivery_mode']
+        self.mail_spool_settings = settings['notification_settings']['spool']
         self.from_email = settings['notification_settings']['from_email']
         self.password_gracious_period = settings['notification_settings']['password_gracious_period']
         self.notification_days = settings['notification_settings']['notification_days']
@@ -221,78 +377,117 @@ class Utils:
             self.template_files[file] = self.paths['templates'] + '/' + self.template_files[file]
 
         self.cache_validity = settings['cache_settings']['validity']
+        self.cache_backend = settings['cache_settings']['backend']
         self.cache_files = settings['cache_settings']['files']
         for file in self.cache_files:
             self.cache_files[file] = self.paths['cache'] + '/' + self.cache_files[file]
 
+        self.daemon_settings = settings['daemon_settings']
+
+        self.health_check_validity = settings['health_check_settings']['validity']
+        self.health_check_backoff = settings['health_check_settings']['backoff']
+        self.health_check_max_backoff = settings['health_check_settings']['max_backoff']
+
         self.log_level = settings['log_settings']['level']
         self.log_file = self.paths['main'] + '/' + settings['log_settings']['file']
 
-    def __obtain_updated_user_data(self) -> dict:
+    def __save_settings_snapshot(self) -> None:
 
-        self.log.debug('Obtaining updated data from AD for all FreeIPA users')
+        snapshot_path = self.__get_settings_snapshot_path()
+        settings = {setting: value for setting, value in vars(self).items() if setting not in ['log', 'config_file']}
 
-        new_user_data = {}
+        try:
+            # The snapshot is saved before the required files are checked on a first run
+            if not os.path.isdir(self.paths['cache']):
+                self.log.debug(f"Cache directory {self.paths['cache']} missing, created")
+                os.mkdir(self.paths['cache'])
 
-        for user_id in self.freeipa_handler.get_freeipa_users():
+            # The snapshot holds the server credentials, it must only be readable by its owner
+            with os.fdopen(os.open(snapshot_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as fp:
+                json.dump({'key': self.__get_settings_snapshot_key(), 'settings': settings}, fp)
 
-            freeipa_user = self.freeipa_handler.get_freeipa_user(user_id)
+            self.log.debug(f'Settings snapshot saved to {snapshot_path}')
 
-            if self.is_email_valid(freeipa_user['email']):
-                self.log.debug(f'Checking for new data for user {user_id}')
+        except (OSError, TypeError) as e:
+            self.log.debug(f'Settings snapshot could not be saved: {e}')
 
-                user_diff = self.__diff_freeipa_ad_user(user_id)
-                if user_diff != {}:
-                    new_user_data[user_id] = user_diff
+    def check_server_connectivity(self, servers: list = None, use_health_state: bool = True) -> (bool, bool, bool):
 
-        self.log.debug('Updatable data obtained for all FreeIPA users')
-        return new_user_data
+        if servers is None:
+            servers = self.servers
 
-    def check_server_connectivity(self) -> (bool, bool, bool):
+        self.log.info(f"Testing {', '.join(servers)} server connectivity")
 
-        self.log.info('Testing AD, FreeIPA and SMTP server connectivity')
+        freeipa_hosts = [self.freeipa_credentials['host']] + (self.freeipa_credentials.get('replicas') or [])
 
-        ad_reachable = self.__check_service_status(self.ad_settings['credentials']['host'],
-                                                   self.ad_settings['credentials']['port'])
-        freeipa_reachable = self.__check_service_status(self.freeipa_credentials['host'], 443)
+        ad_credentials = self.ad_settings['credentials']
+        ad_servers = [f"{ad_credentials['host']}:{ad_credentials['port']}"] + \
+            [dc if ':' in str(dc) else f"{dc}:{ad_credentials['port']}"
+             for dc in ad_credentials.get('domain_controllers') or []]
 
-        smtp_reachable = self.__check_service_status(self.smtp_relay_server, 25)
+        # A server is reachable when any of its addresses answers, AD domain controllers and FreeIPA replicas can
+        # take over the main host
+        server_addresses = {'ad': [(server.rsplit(':', 1)[0], int(server.rsplit(':', 1)[1])) for server in ad_servers],
+                            'freeipa': [(host, 443) for host in freeipa_hosts],
+                            'smtp': [(self.smtp_relay_server, 25)]}
 
-        if ad_reachable and freeipa_reachable and smtp_reachable:
-            self.log.info('Connectivity verified to AD, FreeIPA and SMTP servers')
-        else:
-            if not ad_reachable:
-                self.log.warning('Could not connect to AD server during server connectivity check')
-            if not freeipa_reachable:
-                self.log.warning('Could not connect to FreeIPA server during server connectivity check')
-            if not smtp_reachable:
-                self.log.warning('Could not connect to SMTP server during server connectivity check')
+        server_status = {}
 
-        return ad_reachable, freeipa_reachable, smtp_reachable
+        for server in servers:
+            if use_health_state:
+                server_status[server] = self.health_monitor.get_status(server)
+
+        pending_servers = [server for server in servers if server_status.get(server) is None]
+
+        if pending_servers:
+            with ThreadPoolExecutor(max_workers=len(pending_servers)) as executor:
+                results = executor.map(lambda server: any(self.__check_service_status(*address)
+                                                          for address in server_addresses[server]),
+                                       pending_servers)
+
+                for server, reachable in zip(pending_servers, results):
+                    server_status[server] = reachable
+                    self.health_monitor.record(server, reachable)
+
+        if not server_status.get('ad', True):
+            self.log.warning('Could not connect to AD server during server connectivity check')
+        if not server_status.get('freeipa', True):
+            self.log.warning('Could not connect to FreeIPA server during server connectivity check')
+        if not server_status.get('smtp', True):
+            self.log.warning('Could not connect to SMTP server during server connectivity check')
+
+        if False not in server_status.values():
+            self.log.info(f"Connectivity verified to {', '.join(servers)} servers")
+
+        return server_status.get('ad'), server_status.get('freeipa'), server_status.get('smtp')
 
     def delete_terminated_users(self) -> (list, list):
 
         self.log.info('Checking for terminated users')
 
-        terminated_users = self.__get_terminated_users()
+        plan = self.__load_plan('terminated_users') or self.__plan_terminated_users(self.__get_user_changes())
 
-        deleted_users = []
-        not_deleted_users = []
+        if plan is None:
+            return None, None
 
-        for user_id in terminated_users:
-            status = self.freeipa_handler.delete_freeipa_user(user_id)
-            if status:
-                self.log.info(f'User {user_id} deleted from FreeIPA')
-                deleted_users.append(user_id)
-            else:
-                self.log.warning(f'User {user_id} not deleted from FreeIPA')
-                not_deleted_users.append(user_id)
+        # The limit may have been lowered since a pending plan was calculated
+        if not self.__is_deletion_allowed(plan['operations']):
+            self.sync_plan.discard('terminated_users')
+            return None, None
+
+        terminated_users = plan['operations']
+
+        for user in terminated_users:
+            self.log.info(f"User {user} has been terminated: missing from AD since "
+                          f"{terminated_users[user]['missing_since']} "
+                          f"({terminated_users[user]['missing_refreshes']} AD refreshes)")
 
         if terminated_users:
 
-            if deleted_users:
-                self.log.debug('Updating FreeIPA cache')
-                self.freeipa_handler.get_freeipa_users(force_update_cache=True)
+            results = self.sync_plan.apply(plan, self.__run_user_deletions, chunk_size=self.freeipa_batch_size)
+
+            deleted_users = [user for user in results if results[user]]
+            not_deleted_users = [user for user in results if not results[user]]
 
             self.log.debug('Notifying admins of terminated user deletion')
             self.get_notifier().report_terminated(deleted_users, not_deleted_users)
@@ -305,6 +500,16 @@ class Utils:
 
     def get_ad_handler(self) -> ADHandler:
 
+        if not self.ad_handler:
+            from utils.ad_handler import ADHandler
+
+            self.ad_handler = ADHandler(ad_settings=self.ad_settings,
+                                        cache_handler=self.cache_handler,
+                                        corporate_email_domains=self.corporate_email_domains,
+                                        ignore_keys_on_sync=self.ignore_keys_on_sync,
+                                        sync_mode=self.ad_sync_mode,
+                                        full_sync_interval=self.ad_full_sync_interval,
+                                        health_monitor=self.health_monitor)
         return self.ad_handler
 
     def get_cache_handler(self) -> CacheHandler:
@@ -315,8 +520,32 @@ class Utils:
 
         return self.csv_files
 
+    def get_daemon_settings(self) -> dict:
+
+        return self.daemon_settings
+
     def get_freeipa_handler(self) -> FreeIPAHandler:
 
+        if not self.freeipa_handler:
+            from utils.freeipa_handler import FreeIPAHandler
+
+            self.freeipa_handler = FreeIPAHandler(freeipa_credentials=self.freeipa_credentials,
+                                                  freeipa_gids=self.freeipa_gids,
+                                                  cache_handler=self.cache_handler,
+                                                  csv_files=self.csv_files,
+                                                  password_gracious_period=self.password_gracious_period,
+                                                  batch_size=self.freeipa_batch_size,
+                                                  fetch_mode=self.freeipa_fetch_mode,
+                                                  fetch_workers=self.freeipa_fetch_workers,
+                                                  update_workers=self.freeipa_update_workers,
+                                                  search_size_limit=self.freeipa_search_size_limit,
+                                                  refresh_mode=self.freeipa_refresh_mode,
+                                                  ldap_settings=self.freeipa_ldap_settings,
+                                                  read_engine=self.freeipa_read_engine,
+                                                  session_file=self.cache_files['freeipa_session'],
+                                                  throttle_settings=self.freeipa_throttle_settings,
+                                                  health_monitor=self.health_monitor,
+                                                  sync_plan=self.sync_plan)
         return self.freeipa_handler
 
     def get_logger(self) -> Logger:
@@ -330,19 +559,31 @@ class Utils:
     def get_notifier(self) -> Notifier:
 
         if not self.notifier:
+            from utils.notifier import Notifier
+
             self.notifier = Notifier(smtp_relay_server=self.smtp_relay_server,
                                      from_email=self.from_email,
-                                     admin_emails=self.freeipa_handler.get_freeipa_admin_emails(),
+                                     get_admin_emails=lambda: self.get_freeipa_handler().get_freeipa_admin_emails(),
                                      template_files=self.template_files,
-                                     password_gracious_period=self.password_gracious_period)
+                                     password_gracious_period=self.password_gracious_period,
+                                     health_monitor=self.health_monitor,
+                                     smtp_connections=self.smtp_connections,
+                                     smtp_messages_per_connection=self.smtp_messages_per_connection,
+                                     delivery_mode=self.mail_delivery_mode,
+                                     spool_path=self.paths['spool'],
+                                     spool_settings=self.mail_spool_settings)
         return self.notifier
 
+    def get_plan_file(self, action: str) -> str:
+
+        return self.sync_plan.get_plan_file(action)
+
     def get_password_gracious_period(self) -> int:
         return self.password_gracious_period
 
     def import_csv(self, file: str) -> (dict, list, list, list):
 
-        imported_users, updated_users, skipped_users, not_imported_users = self.freeipa_handler.import_from_csv(file)
+        imported_users, updated_users, skipped_users, not_imported_users = self.get_freeipa_handler().import_from_csv(file)
 
         if imported_users:
             self.log.info('Notifying new users of their accounts via email')
@@ -351,7 +592,7 @@ class Utils:
             password = imported_users[user_id]
 
             if password:
-                user = self.freeipa_handler.get_freeipa_user(user_id)
+                user = self.get_freeipa_handler().get_freeipa_user(user_id)
                 alias = user['alias'][0]
                 name = user['name']
                 email = user['email']
@@ -365,6 +606,9 @@ class Utils:
                 else:
                     self.log.warning('Problem found when sending the new account notification, email not sent')
 
+        # The temporary passwords are not kept on disk longer than needed to notify the new users
+        self.sync_plan.discard('import_users')
+
         return imported_users, updated_users, skipped_users, not_imported_users
 
     def is_email_valid(self, email: str) -> bool:
@@ -377,6 +621,14 @@ class Utils:
         self.log.debug(f'Email domain in {email} not valid for synchronization')
         return False
 
+    def plan_user_changes(self) -> (dict, dict):
+
+        self.log.info('Planning user changes from AD')
+
+        user_changes = self.__get_user_changes()
+
+        return self.__plan_user_updates(user_changes), self.__plan_terminated_users(user_changes)
+
     def process_password_expirations(self) -> (list, list, list):
 
         self.log.info('Processing pending password expiration notifications')
@@ -391,39 +643,34 @@ class Utils:
         new_disabled_expired_users = []
         new_notification_history = {}
 
-        freeipa_users = self.freeipa_handler.get_freeipa_users()
+        expiration_index = self.get_freeipa_handler().get_expiration_index()
 
-        for user in freeipa_users:
+        if expiration_index:
+            freeipa_users = expiration_index.freeipa_users
 
-            user_notifications = []
+            upcoming_users = expiration_index.get_users_expiring(0, max(self.notification_days))
+            expired_users = list(expiration_index.get_users_expiring(-self.password_gracious_period, -1))
+            past_gracious_users = list(expiration_index.get_users_expiring(max_days=-self.password_gracious_period - 1))
 
-            if user in notification_history:
-                user_notifications = notification_history[user]
+            update_cache = bool(upcoming_users or expired_users or past_gracious_users)
 
-            delta, exp_date = self.freeipa_handler.get_user_passwd_expiration(user)
-
-            if delta <= max(self.notification_days):
-                update_cache = True
+            for user in upcoming_users:
+                new_notification_history[user] = list(notification_history.get(user, []))
 
-            if 0 <= delta <= max(self.notification_days):
-                if user_notifications:
-                    new_notification_history[user] = user_notifications
-                else:
-                    new_notification_history[user] = []
-
-            elif -self.password_gracious_period <= delta < 0:
-                expired_users.append(user)
+            for user in expired_users:
                 self.log.debug(f'Password for user {user} is expired or has not been changed by the user after a reset')
 
-            elif delta < -self.password_gracious_period:
+            for user in past_gracious_users:
                 new_disabled_expired_users.append(user)
 
                 if user not in disabled_expired_users:
-                    self.freeipa_handler.disable_freeipa_user(user)
+                    self.get_freeipa_handler().disable_freeipa_user(user)
                     self.log.warning(f'Password for user {user} expired or not changed over the gracious period, '
                                      f'user disabled')
 
-            if delta == 359 and delta not in user_notifications:
+            for user, delta in expiration_index.get_users_expiring(359, 359).items():
+                if delta in notification_history.get(user, []):
+                    continue
 
                 self.log.debug(f'Notifying {user} about upcoming expiration')
 
@@ -431,11 +678,13 @@ class Utils:
                                                       freeipa_users[user]['email'],
                                                       freeipa_users[user]['name'],
                                                       delta,
-                                                      exp_date)
+                                                      expiration_index.get_expiration(user)[1])
                 notified_users.append(user)
 
+                # Only users inside max(notification_days) have a history entry yet
                 self.log.debug(f'Updating notification history cache for user {user}')
-                new_notification_history[user].append(delta)
+                new_notification_history.setdefault(user, list(notification_history.get(user, []))).append(delta)
+                update_cache = True
 
         if update_cache:
             if new_notification_history:
@@ -455,15 +704,43 @@ class Utils:
 
         return notified_users, expired_users, new_disabled_expired_users
 
+    def log_request_metrics(self) -> None:
+
+        # Handlers never created did not send any request
+        if not self.freeipa_handler:
+            return
+
+        request_metrics = self.freeipa_handler.get_request_metrics()
+
+        for method in sorted(request_metrics):
+            self.log.info(f"FreeIPA {method} requests: {request_metrics[method]['requests']}, errors: "
+                          f"{request_metrics[method]['errors']}, average latency: "
+                          f"{request_metrics[method]['avg_latency'] * 1000:.0f} ms, maximum latency: "
+                          f"{request_metrics[method]['max_latency'] * 1000:.0f} ms")
+
+    def reconnect(self) -> bool:
+
+        self.log.info('Reconnecting to AD and FreeIPA servers')
+
+        return_value = True
+
+        # Handlers not used yet connect on first use
+        if self.freeipa_handler:
+            return_value = self.freeipa_handler.reconnect() and return_value
+        if self.ad_handler:
+            return_value = self.ad_handler.reconnect() and return_value
+
+        return return_value
+
     def remind_password_change(self) -> (bool, list):
 
         self.log.info('Processing password change reminders')
 
-        users_no_password = self.freeipa_handler.get_users_no_password()
+        users_no_password = self.get_freeipa_handler().get_users_no_password()
 
         for user_id in users_no_password:
             self.log.debug(f'Reminding user {user_id} to reset its password')
-            user = self.freeipa_handler.get_freeipa_user(user_id)
+            user = self.get_freeipa_handler().get_freeipa_user(user_id)
             self.get_notifier().remind_password_reset(user_id, alias=user['alias'][0], name=user['name'],
                                                       email=user['email'])
 
@@ -475,10 +752,10 @@ class Utils:
 
     def reset_user_password(self, user_id: str) -> (bool, str):
 
-        password = self.freeipa_handler.reset_user_password(user_id)
+        password = self.get_freeipa_handler().reset_user_password(user_id)
 
         if password:
-            user = self.freeipa_handler.get_freeipa_user(user_id)
+            user = self.get_freeipa_handler().get_freeipa_user(user_id)
 
             alias = ''
             if user['alias']:
@@ -501,25 +778,21 @@ class Utils:
         updates_success = []
         updates_unsuccessful = []
 
-        updated_user_data = self.__obtain_updated_user_data()
+        plan = self.__load_plan('update_from_ad') or self.__plan_user_updates(self.__get_user_changes())
 
-        for user in updated_user_data:
+        if plan is None:
+            return updates_success, updates_unsuccessful
 
-            if self.__is_user_synchronizable(user):
-                self.log.debug(f'Updating user {user}')
+        updated_user_data = plan['operations']
+        # Each chunk is spread over the update workers, the journal is written after every chunk
+        results = self.sync_plan.apply(plan, self.__run_user_updates,
+                                       chunk_size=self.freeipa_batch_size * self.freeipa_update_workers)
 
-                update_status = self.freeipa_handler.update_freeipa_user(user_id=user, **updated_user_data[user],
-                                                                         update_cache=False)
-                if update_status:
-                    self.log.debug('The following fields were updated successfully:')
-                    for key in updated_user_data[user]:
-                        self.log.debug(f' - {key}: {updated_user_data[user][key]}')
-
-                    updates_success.append(user)
-
-                else:
-                    updates_unsuccessful.append(user)
-                    self.log.warning(f'User {user} could not be updated')
+        for user in results:
+            if results[user]:
+                updates_success.append(user)
+            else:
+                updates_unsuccessful.append(user)
 
         if updated_user_data:
             self.log.info('Data synchronization from AD completed')
@@ -529,29 +802,28 @@ class Utils:
                 self.get_notifier().report_ad_updates(updates_success)
 
             self.log.debug('Updating FreeIPA cache')
-            self.freeipa_handler.get_freeipa_users(force_update_cache=True)
+            self.get_freeipa_handler().get_freeipa_users(force_update_cache=True)
 
         else:
             self.log.info('There is no data to synchronize from AD at this time')
 
         return updates_success, updates_unsuccessful
 
-    def validate_running_environment(self, manual_server_check: bool) -> bool:
+    def validate_running_environment(self, required_servers: list) -> bool:
 
         if not self.__check_required_files():
             self.log.error('The program is missing required files to run and cannot be executed')
             return False
 
-        else:
-            if manual_server_check is False:
-                ad_reachable, freeipa_reachable, smtp_reachable = self.check_server_connectivity()
-                if not (ad_reachable == freeipa_reachable == smtp_reachable is True):
-                    self.log.error('The program cannot connect to one or more servers required to run and cannot be '
-                                   'executed')
-                    return False
-                else:
-                    self.log.info('Running environment validated, all required files and servers available')
-                    return True
+        elif required_servers:
+            if False in self.check_server_connectivity(required_servers):
+                self.log.error('The program cannot connect to one or more servers required to run and cannot be '
+                               'executed')
+                return False
             else:
-                self.log.info('Program files validated, skipping server validation for manual server check request')
+                self.log.info('Running environment validated, all required files and servers available')
                 return True
+
+        else:
+            self.log.info('Program files validated, no server connectivity required for this request')
+            return True